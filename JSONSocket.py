@@ -19,34 +19,160 @@
 import socket
 import json
 import selectors
+import collections
+import itertools
 import os
+import stat
 import abc
 
 
+class JSONFragment:
+    # a value which was encoded already, put in to the output as it is
+    # rather than being decoded and encoded again
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        if type(text) != str:
+            raise TypeError
+        self.text = text
+
+
+# fragments go in as strings starting with this so they can be found in the
+# encoded output
+FRAGMENT_MARK = "\x00fragment "
+FRAGMENT_MARK_ENCODED = json.dumps(FRAGMENT_MARK)[:-1]
+
+
+def encodeJSON(obj):
+    fragments = []
+
+    def mark(value):
+        if type(value) != JSONFragment:
+            raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+        fragments.append(value.text)
+        return FRAGMENT_MARK + str(len(fragments) - 1)
+
+    text = json.dumps(obj, default=mark)
+    if len(fragments) == 0:
+        return text
+    pieces = text.split(FRAGMENT_MARK_ENCODED)
+    if len(pieces) != len(fragments) + 1:
+        # some string happened to start with the mark, so do it the slow way
+        return json.dumps(obj, default=lambda value: json.loads(value.text))
+    out = [pieces[0]]
+    for piece in pieces[1:]:
+        end = piece.index('"')
+        out.append(fragments[int(piece[:end])])
+        out.append(piece[end + 1:])
+    return ''.join(out)
+
+
+class LineBuffer:
+    # received data lives in buffer[start:end], and everything in
+    # buffer[start:scan] is known to contain no newline so searches never
+    # look at the same bytes twice.
+    COMPACT_MIN = 1048576
+
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.scan = 0
+        self.newline = -1
+
+    def __len__(self):
+        return self.end - self.start
+
+    def makeRoom(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+            self.scan = 0
+            self.newline = -1
+            if len(self.buffer) >= size:
+                return
+
+        # only move the unconsumed data down once the consumed prefix is big
+        # enough to be worth it, otherwise just grow the buffer
+        if self.start >= LineBuffer.COMPACT_MIN or self.start >= len(self.buffer) // 2:
+            length = self.end - self.start
+            self.buffer[:length] = self.buffer[self.start:self.end]
+            self.scan -= self.start
+            if self.newline >= 0:
+                self.newline -= self.start
+            self.start = 0
+            self.end = length
+            if len(self.buffer) - self.end >= size:
+                return
+
+        self.buffer.extend(bytes(max(len(self.buffer), size)))
+
+    def recvFrom(self, sock, size):
+        self.makeRoom(size)
+        with memoryview(self.buffer) as view:
+            read = sock.recv_into(view[self.end:])
+        self.end += read
+        return read
+
+    def findNewline(self):
+        if self.newline < 0:
+            self.newline = self.buffer.find(b'\n', self.scan, self.end)
+            if self.newline < 0:
+                self.scan = self.end
+        return self.newline
+
+    def hasLine(self):
+        return self.findNewline() >= 0
+
+    def count(self):
+        if self.findNewline() < 0:
+            return 0
+        return self.buffer.count(b'\n', self.newline, self.end)
+
+    def getLine(self):
+        lineidx = self.findNewline()
+        if lineidx < 0:
+            return None
+
+        with memoryview(self.buffer) as view:
+            line = str(view[self.start:lineidx], 'utf-8', 'replace')
+        self.start = lineidx + 1
+        self.scan = self.start
+        self.newline = -1
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+            self.scan = 0
+
+        return line
+
+
 class JSONSocket(metaclass=abc.ABCMeta):
     RECVREAD = 32768
+    SENDMSG_MAX = 64
+    HIGH_WATER = 4194304
 
     @abc.abstractmethod
     def __init__(self):
         raise NotImplementedError("users must define __init__ to use this base class")
 
-    def accept(self):
+    def acceptConnection(self):
         if self.listenSocket is None:
             raise RuntimeError("Not a listening socket.")
         try:
             sock, addr = self.listenSocket.accept()
         except BlockingIOError:
-            return False
+            return None
 
-        self.listenSocket.shutdown(socket.SHUT_RDWR)
-        self.listenSocket.close()
-        self.listenSocket = None
-        self.socket = sock
-        self.socket.setblocking(False)
-        self.IP = addr
-        self.connected = True
-        self.recvlinebuff = b''
-        return True
+        return JSONConnection(sock, addr)
+
+    def clearSendQueue(self):
+        self.sendqueue = collections.deque()
+        self.sendoffset = 0
+        self.sendqueued = 0
 
     def close(self):
         if self.listenSocket is not None:
@@ -57,6 +183,12 @@ class JSONSocket(metaclass=abc.ABCMeta):
             self.listenSocket.close()
             self.listenSocket = None
         if self.socket is not None:
+            # last chance for anything still queued, like a reply to 'kill'
+            if self.connected:
+                try:
+                    self.flush()
+                except OSError:
+                    pass
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
             except OSError:
@@ -68,48 +200,106 @@ class JSONSocket(metaclass=abc.ABCMeta):
             self.selector = None
         self.connected = False
 
-    def readSocketLine(self):
+    def getSelectable(self):
+        if self.listenSocket is not None:
+            return self.listenSocket, selectors.EVENT_READ
+        if self.socket is None:
+            return None, 0
+        if not self.connected:
+            return self.socket, selectors.EVENT_WRITE
+        if len(self.sendqueue) > 0:
+            # stop reading from a peer which isn't keeping up with what's sent
+            if self.backlogged():
+                return self.socket, selectors.EVENT_WRITE
+            return self.socket, selectors.EVENT_READ | selectors.EVENT_WRITE
+        return self.socket, selectors.EVENT_READ
+
+    def backlogged(self):
+        return self.sendqueued >= JSONSocket.HIGH_WATER
+
+    def hasLine(self):
+        if self.socket is None:
+            return False
+        return self.recvlinebuff.hasLine()
+
+    def pendingLines(self):
+        if self.socket is None:
+            return 0
+        return self.recvlinebuff.count()
+
+    def checkConnected(self):
         if not self.connected:
             if self.selector is None:
                 raise ConnectionError("Not connected.")
 
             if len(self.selector.select(timeout=0)) == 0:
-                return None
+                return False
             else:
                 self.selector.close()
                 self.selector = None
                 self.connected = True
+        return True
+
+    def readSocketLine(self):
+        if not self.checkConnected():
+            return None
+
+        # already buffered lines are handed out without touching the socket
+        if self.recvlinebuff.hasLine():
+            return self.recvlinebuff.getLine()
 
         while True:  # empty the buffer entirely
             try:
-                readbuf = self.socket.recv(JSONSocket.RECVREAD)
                 # when a Unix socket closes, we end up just reading empty buffers
-                if len(readbuf) == 0:
+                if self.recvlinebuff.recvFrom(self.socket, JSONSocket.RECVREAD) == 0:
+                    # hand out whatever the peer sent before closing first
+                    if self.recvlinebuff.hasLine():
+                        break
                     raise ConnectionError("Connection Lost.")
-                self.recvlinebuff += readbuf
             except BlockingIOError:
                 break
 
-        lineidx = 0
-        try:
-            lineidx = self.recvlinebuff.index(b'\n')
-        except ValueError:
-            return None
-
-        line = self.recvlinebuff[:lineidx]
-        self.recvlinebuff = self.recvlinebuff[lineidx + 1:]
-
-        return line.decode('utf-8', errors='replace')
+        return self.recvlinebuff.getLine()
 
     def sendObjAsJSON(self, obj):
+        # only queues, flush() does the sending so everything queued in one
+        # go goes out together.  Returns False once the peer is backlogged.
         if not self.connected:
             if self.selector is None:
                 raise ConnectionError("Not connected.")
-        try:
-            self.socket.send((json.dumps(obj) + "\n").encode('utf-8'))
-        except BrokenPipeError as e:
-            self.connected = False
-            raise e
+        data = (encodeJSON(obj) + "\n").encode('utf-8')
+        self.sendqueue.append(data)
+        self.sendqueued += len(data)
+        return not self.backlogged()
+
+    def flush(self):
+        if self.socket is None or not self.checkConnected():
+            return len(self.sendqueue) == 0
+
+        while len(self.sendqueue) > 0:
+            buffers = list(itertools.islice(self.sendqueue, JSONSocket.SENDMSG_MAX))
+            if self.sendoffset > 0:
+                buffers[0] = memoryview(buffers[0])[self.sendoffset:]
+            try:
+                sent = self.socket.sendmsg(buffers)
+            except BlockingIOError:
+                break
+            except BrokenPipeError as e:
+                self.connected = False
+                raise e
+
+            self.sendqueued -= sent
+            while sent > 0:
+                remaining = len(self.sendqueue[0]) - self.sendoffset
+                if sent >= remaining:
+                    self.sendqueue.popleft()
+                    self.sendoffset = 0
+                    sent -= remaining
+                else:
+                    self.sendoffset += sent
+                    sent = 0
+
+        return len(self.sendqueue) == 0
 
     def getJSONAsObj(self):
         line = self.readSocketLine()
@@ -119,6 +309,23 @@ class JSONSocket(metaclass=abc.ABCMeta):
         return json.loads(line)
 
 
+class JSONConnection(JSONSocket):
+    # a connection accepted from a listening JSONSocket
+    def __init__(self, sock, addr):
+        self.connected = True
+        self.selector = None
+        self.listenSocket = None
+        self.socket = sock
+        self.listening = False
+        self.clearSendQueue()
+
+        self.socket.setblocking(False)
+        if self.socket.family in (socket.AF_INET, socket.AF_INET6):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.IP = addr
+        self.recvlinebuff = LineBuffer(JSONSocket.RECVREAD)
+
+
 class JSONTCPSocket(JSONSocket):
     # Because of getaddrinfo() this method could block for a while, but there's no
     # better way.  Could present a "hung" interface to the user during.
@@ -128,6 +335,7 @@ class JSONTCPSocket(JSONSocket):
         self.listenSocket = None
         self.socket = None
         self.listening = listening
+        self.clearSendQueue()
 
         if host is not None and type(host) != str:
             raise TypeError
@@ -152,6 +360,7 @@ class JSONTCPSocket(JSONSocket):
                     continue
                 try:
                     self.socket.setblocking(False)
+                    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                     self.socket.connect(addrinfo[4])
                 except BlockingIOError:
                     sockaddr = addrinfo[4]
@@ -165,8 +374,7 @@ class JSONTCPSocket(JSONSocket):
             self.IP = sockaddr[1]
             self.selector = selectors.DefaultSelector()
             self.selector.register(self.socket, selectors.EVENT_WRITE)
-            self.recvlinebuff = b''
-            self.preconnectbuff = b''
+            self.recvlinebuff = LineBuffer(JSONSocket.RECVREAD)
         else:
             ais = socket.getaddrinfo(self.host, self.port, family=socket.AF_UNSPEC,
                                      type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
@@ -179,7 +387,7 @@ class JSONTCPSocket(JSONSocket):
                 try:
                     self.listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                     self.listenSocket.bind(addrinfo[4])
-                    self.listenSocket.listen(0)
+                    self.listenSocket.listen(socket.SOMAXCONN)
                     self.listenSocket.setblocking(False)
                 except OSError:
                     self.listenSocket.close()
@@ -201,6 +409,7 @@ class JSONUnixSocket(JSONSocket):
         self.listenSocket = None
         self.socket = None
         self.listening = listening
+        self.clearSendQueue()
 
         if type(path) != str:
             raise TypeError
@@ -212,17 +421,39 @@ class JSONUnixSocket(JSONSocket):
             self.socket.connect(self.path)
             self.selector = selectors.DefaultSelector()
             self.selector.register(self.socket, selectors.EVENT_WRITE)
-            self.recvlinebuff = b''
-            self.preconnectbuff = b''
+            self.recvlinebuff = LineBuffer(JSONSocket.RECVREAD)
         else:
-            os.remove(self.path)
+            # clear out a socket left behind by a server which didn't exit
+            # cleanly, but not one something is still listening on
+            try:
+                if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    probe = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+                    try:
+                        probe.connect(self.path)
+                        raise ConnectionError(self.path + " is already in use.")
+                    except ConnectionRefusedError:
+                        os.remove(self.path)
+                    finally:
+                        probe.close()
+            except FileNotFoundError:
+                pass
 
-            self.listenSocket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM,
-                                              flags=socket.AI_PASSIVE)
-            self.listenSocket.setblocking(False)
-            self.listenSocket.bind(self.path)
-            self.listenSocket.listen(0)
+            self.listenSocket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+            try:
+                self.listenSocket.bind(self.path)
+                self.listenSocket.listen(socket.SOMAXCONN)
+                self.listenSocket.setblocking(False)
+            except OSError:
+                self.listenSocket.close()
+                self.listenSocket = None
+                raise ConnectionError("Couldn't bind to " + self.path + ".")
 
     def close(self):
+        # only the listening end owns the path
+        listening = self.listenSocket is not None
         super().close()
-        os.remove(self.path)
+        if listening:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
@@ -17,11 +17,29 @@
 
 
 import subprocess
+import time
 import JSONSocket
 
 
+class MPVRequest:
+    # a request waiting on mpv's reply, with everything that asked for it
+    __slots__ = ('key', 'callbacks', 'deadline')
+
+    def __init__(self, key, callback, deadline):
+        self.key = key
+        self.callbacks = [callback]
+        self.deadline = deadline
+
+
 class MPV:
     RETRIES = 3
+    # seconds a request waits on mpv before it's given up on
+    REQUEST_TIMEOUT = 10
+    # what watches a property read by each command
+    OBSERVE_COMMANDS = {
+        'get_property':         'observe_property',
+        'get_property_string':  'observe_property_string'
+    }
 
     MPV_FORCED_OPTS = (
         ('config', 'no'),
@@ -49,6 +67,22 @@ class MPV:
         self.run()
         self.socket = None
 
+        # requests sent and not yet answered by request_id.  They all wait
+        # the same time so the dict's order is also the order they expire.
+        self.nextRequestID = 1
+        self.pending = {}
+        # request_ids of identical reads in flight, shared by everyone asking
+        self.inFlight = {}
+        # (command, property) read by each observer ID less one, the IDs of
+        # those still observed, and the last value mpv sent for each with
+        # when it came as [value, monotonic time]
+        self.observers = []
+        self.observed = {}
+        self.mirror = {}
+        # properties only observed while something reads them, with when
+        # each was last read
+        self.reads = {}
+
     def checkMPVRunning(self):
         if self.mpv is None:
             return False
@@ -80,6 +114,7 @@ class MPV:
                                     stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     def terminate(self):
+        self.failRequests('terminated')
         if self.socket is not None:
             self.socket.close()
             self.socket = None
@@ -108,11 +143,171 @@ class MPV:
         print("MPV <-- " + repr(obj))
         self.socket.sendObjAsJSON(obj)
 
+    def request(self, command, args, callback, shared=False):
+        # callback gets mpv's reply, or one with 'error' set to 'timeout' or
+        # 'terminated'.  Shared requests with the same command and args as
+        # one in flight wait on that one's reply instead of sending another.
+        key = None
+        if shared:
+            key = (command,) + tuple(args)
+            if key in self.inFlight:
+                self.pending[self.inFlight[key]].callbacks.append(callback)
+                return self.inFlight[key]
+
+        reqID = self.nextRequestID
+        self.nextRequestID += 1
+        self.sendCommand(command, args, request_id=reqID)
+        self.pending[reqID] = MPVRequest(key, callback, time.monotonic() + MPV.REQUEST_TIMEOUT)
+        if key is not None:
+            self.inFlight[key] = reqID
+        return reqID
+
+    def finishRequest(self, reqID, obj):
+        req = self.pending.pop(reqID)
+        if req.key is not None:
+            del self.inFlight[req.key]
+        for callback in req.callbacks:
+            callback(obj)
+
+    def handleReply(self, obj):
+        # returns False for replies to nothing pending, like ones which
+        # already timed out or to commands sent without an ID
+        if 'request_id' not in obj or obj['request_id'] not in self.pending:
+            return False
+        self.finishRequest(obj['request_id'], obj)
+        return True
+
+    def nextDeadline(self):
+        for req in self.pending.values():
+            return req.deadline
+        return None
+
+    def expireRequests(self, now):
+        while len(self.pending) > 0:
+            reqID = next(iter(self.pending))
+            if self.pending[reqID].deadline > now:
+                break
+            self.finishRequest(reqID, {'error': 'timeout', 'request_id': reqID})
+
+    def failRequests(self, error):
+        while len(self.pending) > 0:
+            reqID = next(iter(self.pending))
+            self.finishRequest(reqID, {'error': error, 'request_id': reqID})
+
+    def observe(self, command, name):
+        # mpv sends the value now and again every time it changes, and
+        # getMirrored() has it from then on, for as long as mpv runs
+        key = (command, name)
+        self.reads.pop(key, None)
+        if key in self.observed:
+            return
+        if key in self.observers:
+            # mpv takes an ID again once it's been unobserved
+            obsID = self.observers.index(key) + 1
+        else:
+            self.observers.append(key)
+            obsID = len(self.observers)
+        self.observed[key] = obsID
+
+        def observing(reply):
+            if reply['error'] != 'success' and self.observed.get(key) == obsID:
+                del self.observed[key]
+                self.mirror.pop(key, None)
+        self.request(MPV.OBSERVE_COMMANDS[command], [obsID, name], observing)
+
+    def read(self, command, name):
+        # observed from the first read until none come for a while, as some
+        # properties change every frame
+        key = (command, name)
+        if key in self.observed and key not in self.reads:
+            # observed for good already
+            return
+        self.observe(command, name)
+        self.reads[key] = time.monotonic()
+
+    def nextUnobserve(self, idle):
+        if len(self.reads) == 0:
+            return None
+        return min(self.reads.values()) + idle
+
+    def unobserveUnread(self, now, idle):
+        for key, when in list(self.reads.items()):
+            if now - when < idle:
+                continue
+            del self.reads[key]
+            self.mirror.pop(key, None)
+            obsID = self.observed.pop(key, None)
+            if obsID is not None:
+                self.sendCommand('unobserve_property', [obsID])
+
+    def propertyChanged(self, obj):
+        if 'id' not in obj or type(obj['id']) != int or obj['id'] < 1 or obj['id'] > len(self.observers):
+            return
+        key = self.observers[obj['id'] - 1]
+        if self.observed.get(key) != obj['id']:
+            return
+        # no data means the property isn't available right now
+        self.mirror[key] = [obj.get('data'), time.monotonic()]
+
+    def getMirrored(self, command, name):
+        # [value, when it came] or None if there's nothing to go on yet
+        return self.mirror.get((command, name))
+
     def play(self, uri):
         self.sendCommand('loadfile', [uri])
 
+    def append(self, uri, callback):
+        # goes on after whatever is playing without stopping in between
+        return self.request('loadfile', [uri, 'append'], callback)
+
+    def clearQueue(self):
+        # everything but what's playing
+        self.sendCommand('playlist-clear')
+
+    def removePlayed(self):
+        # once mpv goes on to what was appended, what played before it is
+        # first and only kept until now so the playlist doesn't grow forever
+        self.sendCommand('playlist-remove', [0])
+
     def stop(self):
         self.sendCommand('stop')
 
     def getNextObj(self):
         return self.socket.getJSONAsObj()
+
+
+class MPVDeck(MPV):
+    # one of the two mpv instances which take turns being on air.  Files stay
+    # on their last frame when they end so the other deck can take over
+    # without anything in between, and windows stay open while idle so one
+    # showing up doesn't put it above the other.
+    MPV_DECK_OPTS = (
+        ('keep-open', 'yes'),
+        ('force-window', 'yes')
+    )
+
+    def __init__(self, path, socket, opts):
+        if type(opts) != list:
+            raise TypeError
+        super().__init__(path, socket, opts + list(MPVDeck.MPV_DECK_OPTS))
+
+    def setVolume(self, volume):
+        self.sendCommand('set_property', ['volume', volume])
+
+    def preload(self, uri, callback):
+        # loaded paused out of sight, shows its first frame when ready
+        self.sendCommand('set_property', ['pause', True])
+        self.lower()
+        return self.request('loadfile', [uri], callback)
+
+    def goLive(self, volume):
+        self.setVolume(volume)
+        self.sendCommand('set_property', ['ontop', True])
+        self.sendCommand('set_property', ['pause', False])
+
+    def lower(self):
+        self.sendCommand('set_property', ['ontop', False])
+
+    def play(self, uri):
+        self.goLive(100)
+        super().play(uri)
@@ -0,0 +1,312 @@
+# MPV-VJ3 Copyright 2017 paulguy <paulguy119@gmail.com>
+#
+# This file is part of MPV-VJ3.
+#
+# MPV-VJ3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MPV-VJ3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MPV-VJ3.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import json
+import os
+import signal
+import stat
+import time
+
+import JSONSocket
+import MPVVJServer
+
+
+class JSONStream:
+    # the parts of JSONSocket the server uses, on top of asyncio streams
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.connected = True
+        self.IP = writer.get_extra_info('peername')
+
+    def sendObjAsJSON(self, obj):
+        if not self.connected:
+            raise ConnectionError("Not connected.")
+        self.writer.write((JSONSocket.encodeJSON(obj) + "\n").encode('utf-8'))
+        return not self.backlogged()
+
+    def queued(self):
+        if self.writer.transport is None:
+            return 0
+        return self.writer.transport.get_write_buffer_size()
+
+    def backlogged(self):
+        return self.queued() >= JSONSocket.JSONSocket.HIGH_WATER
+
+    async def getJSONAsObj(self):
+        line = await self.reader.readline()
+        if len(line) == 0:
+            raise ConnectionError("Connection Lost.")
+        return json.loads(line.decode('utf-8', errors='replace'))
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            self.writer.close()
+
+
+class MPVVJAsyncClient(MPVVJServer.MPVVJClient):
+    def queued(self):
+        return self.socket.queued()
+
+
+class MPVVJAsyncServer(MPVVJServer.MPVVJServer):
+    # asyncio.StreamReader refuses longer lines, add-items can be big
+    LINE_LIMIT = 268435456
+
+    def startTransport(self):
+        # nothing is left buffered between wakeups to count here, each client
+        # and mpv reads in its own task as lines come in
+        for channel in ('client', 'mpv'):
+            del self.stats[channel + '-backlog']
+            del self.stats[channel + '-backlog-max']
+        self.servers = []
+        self.stopped = None
+        self.mpvWake = None
+        self.closing = []
+        self.expiry = None
+        self.expiryDeadline = None
+
+    async def startServer(self):
+        if self.tcp:
+            self.print("Binding to " + self.bindAddress + " (" + str(self.port) + ").")
+            self.servers.append(await asyncio.start_server(self.serveClient, host=self.bindAddress,
+                                                           port=self.port, limit=self.LINE_LIMIT,
+                                                           reuse_address=True))
+        if self.controlPath is not None:
+            self.print("Binding to " + self.controlPath + ".")
+            # same stale socket check as JSONUnixSocket
+            try:
+                if stat.S_ISSOCK(os.stat(self.controlPath).st_mode):
+                    try:
+                        reader, writer = await asyncio.open_unix_connection(self.controlPath)
+                        writer.close()
+                        raise ConnectionError(self.controlPath + " is already in use.")
+                    except ConnectionRefusedError:
+                        os.remove(self.controlPath)
+            except FileNotFoundError:
+                pass
+            self.servers.append(await asyncio.start_unix_server(self.serveClient, path=self.controlPath,
+                                                                limit=self.LINE_LIMIT))
+
+    def disconnectSocket(self):
+        self.closing = []
+        for client in self.clients:
+            if client.socket is not None:
+                self.closing.append(client.socket.writer)
+            client.close()
+        self.clients = []
+        self.closeListeners()
+
+    def closeListeners(self):
+        for server in self.servers:
+            server.close()
+        if len(self.servers) > 0 and self.controlPath is not None:
+            try:
+                os.remove(self.controlPath)
+            except FileNotFoundError:
+                pass
+        self.servers = []
+
+    def reconnectSocket(self):
+        # clients already connected stay connected
+        self.closeListeners()
+        asyncio.get_running_loop().create_task(self.startServer())
+
+    def hup(self):
+        print("SIGHUP received.")
+        self.reconnectSocket()
+        print("Listening socket forcibly closed and reopened")
+
+    def fail(self, e):
+        # tasks nothing waits on fail the whole server like the select
+        # engine does, rather than the exception going nowhere
+        if not self.stopped.done():
+            self.stopped.set_exception(e)
+
+    def dropClient(self, client, reason):
+        if client in self.clients:
+            super().dropClient(client, reason)
+
+    def cleanUp(self):
+        self.terminateMpv()
+        self.stopPrefetch()
+        self.disconnectSocket()
+        if self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def handleClientObj(self, client, obj):
+        ret = super().handleClientObj(client, obj)
+        if self.mpv is not None and not self.decksConnected():
+            self.mpvWake.set()
+        return ret
+
+    def updateMpvRequests(self):
+        super().updateMpvRequests()
+        # the select engine wakes up for the next request to time out, property
+        # to be unobserved or the decks to switch, here it's a timer moved
+        # whenever that changes
+        deadline = self.nextWake()
+        if deadline != self.expiryDeadline:
+            if self.expiry is not None:
+                self.expiry.cancel()
+                self.expiry = None
+            if deadline is not None:
+                self.expiry = asyncio.get_running_loop().call_later(max(0, deadline - time.monotonic()),
+                                                                     self.expireMpvRequests)
+            self.expiryDeadline = deadline
+
+    def expireMpvRequests(self):
+        self.expiry = None
+        self.expiryDeadline = None
+        self.updateMpvRequests()
+
+    async def serveClient(self, reader, writer):
+        sock = JSONStream(reader, writer)
+        client = MPVVJAsyncClient(sock, self.nextClientID)
+        self.nextClientID += 1
+        self.clients.append(client)
+        self.print_debug(client.name + " connected from " + repr(sock.IP))
+
+        count = 0
+        while client.isConnected():
+            try:
+                # leave requests unread while replies pile up unsent
+                if sock.backlogged():
+                    self.stats['client-backpressure'] += 1
+                    self.print_debug(client.name + " is backlogged")
+                    await writer.drain()
+                timeout = client.lastAct + self.TIMEOUT - time.monotonic()
+                obj = await asyncio.wait_for(sock.getJSONAsObj(), max(0, timeout))
+            except asyncio.TimeoutError:
+                self.dropClient(client, "Connection timed out!")
+                return
+            except json.decoder.JSONDecodeError as e:
+                self.sendFailureResponse(client, "Bad JSON: " + e.args[0])
+                continue
+            except (ConnectionError, ValueError) as e:
+                self.dropClient(client, "Connection error: " + str(e))
+                return
+
+            client.lastAct = time.monotonic()
+            self.stats['client-messages'] += 1
+            try:
+                if not self.handleClientObj(client, obj):
+                    return
+                self.updateMpvRequests()
+            except Exception as e:
+                self.fail(e)
+                return
+
+            # buffered lines don't yield to the loop, so give others a turn
+            count += 1
+            if count >= self.budget:
+                count = 0
+                await asyncio.sleep(0)
+
+    async def readMpv(self, mpv):
+        sock = mpv.socket
+        count = 0
+        while mpv in self.getDecks():
+            try:
+                obj = await sock.getJSONAsObj()
+            except (ConnectionError, ValueError) as e:
+                if mpv in self.getDecks():
+                    self.print("MPV connection error: " + str(e))
+                    try:
+                        self.clientMpvUnexpectedTerminated()
+                        self.updateMpvRequests()
+                    except Exception as e:
+                        self.fail(e)
+                return
+
+            self.stats['mpv-messages'] += 1
+            try:
+                self.handleMpvObj(obj, mpv)
+                self.updateMpvRequests()
+            except Exception as e:
+                self.fail(e)
+                return
+
+            count += 1
+            if count >= self.budget:
+                count = 0
+                await asyncio.sleep(0)
+
+    async def superviseMpv(self):
+        try:
+            await self.connectMpv()
+        except Exception as e:
+            self.fail(e)
+
+    async def connectMpv(self):
+        while True:
+            await self.mpvWake.wait()
+            self.mpvWake.clear()
+
+            while self.mpv is not None and not self.decksConnected():
+                await asyncio.sleep(self.CONNECT_INTERVAL)
+                for mpv in self.getDecks():
+                    if not mpv.checkMPVRunning():
+                        self.print("MPV terminated unexpectedly.")
+                        self.clientMpvUnexpectedTerminated()
+                        self.updateMpvRequests()
+                        break
+                for mpv in self.getDecks():
+                    if mpv.socket is not None:
+                        continue
+                    try:
+                        reader, writer = await asyncio.open_unix_connection(mpv.socketName,
+                                                                            limit=self.LINE_LIMIT)
+                    except ConnectionRefusedError:
+                        self.print("Connection refused, socket not ready?")
+                        continue
+                    except FileNotFoundError:
+                        self.print("File not found, waiting on mpv...")
+                        continue
+                    if mpv not in self.getDecks():
+                        # terminated while connecting
+                        writer.close()
+                        break
+
+                    mpv.socket = JSONStream(reader, writer)
+                    self.updateMpvRequests()
+                    asyncio.get_running_loop().create_task(self.readMpv(mpv))
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        self.mpvWake = asyncio.Event()
+        loop.add_signal_handler(signal.SIGHUP, self.hup)
+        await self.startServer()
+        supervisor = loop.create_task(self.superviseMpv())
+        try:
+            await self.stopped
+            # let replies like the one to 'kill' get out before the loop goes
+            if len(self.closing) > 0:
+                await asyncio.wait([loop.create_task(writer.wait_closed()) for writer in self.closing],
+                                   timeout=1)
+        finally:
+            # close everything while there's still a loop to close it on
+            self.cleanUp()
+            supervisor.cancel()
+            loop.remove_signal_handler(signal.SIGHUP)
+
+    def run(self):
+        asyncio.run(self.serve())
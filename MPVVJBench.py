@@ -0,0 +1,963 @@
+# MPV-VJ3 Copyright 2017 paulguy <paulguy119@gmail.com>
+#
+# This file is part of MPV-VJ3.
+#
+# MPV-VJ3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MPV-VJ3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MPV-VJ3.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import array
+import gc
+import json
+import os
+import os.path
+import queue
+import socket
+import selectors
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import JSONSocket
+import MPVVJRequest
+import MPVVJState
+
+
+DEFAULT_PORT = 12346
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def printTimes(name, times):
+    print("{}: n={} p50={:.3f}ms p99={:.3f}ms max={:.3f}ms".format(
+          name, len(times), percentile(times, 50) * 1000,
+          percentile(times, 99) * 1000, max(times) * 1000))
+
+
+def processCPUTime(pid):
+    with open("/proc/" + str(pid) + "/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def processWakeups(pid):
+    with open("/proc/" + str(pid) + "/status") as f:
+        for line in f:
+            if line.startswith("voluntary_ctxt_switches:"):
+                return int(line.split()[1])
+    return 0
+
+
+class BenchServer:
+    engine = None
+
+    def __init__(self, port, extraArgs=None):
+        args = [sys.executable, os.path.join(BASE_DIR, 'MPVVJServer.py'), '-q',
+                '--bind-port', str(port)]
+        if BenchServer.engine is not None:
+            args.extend(('--engine', BenchServer.engine))
+        if extraArgs is not None:
+            args.extend(extraArgs)
+        self.process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+        self.port = port
+
+    def connect(self):
+        start = time.monotonic()
+        while True:
+            try:
+                return BenchClient(socket.create_connection(('127.0.0.1', self.port)))
+            except ConnectionRefusedError:
+                if time.monotonic() - start > 10:
+                    raise
+                time.sleep(0.05)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class BenchClient:
+    def __init__(self, sock):
+        self.socket = sock
+        if sock.family != socket.AF_UNIX:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = sock.makefile('rb')
+
+    def send(self, obj):
+        self.socket.sendall((json.dumps(obj) + "\n").encode('utf-8'))
+
+    def recv(self):
+        line = self.file.readline()
+        if len(line) == 0:
+            raise ConnectionError("Connection Lost.")
+        return json.loads(line)
+
+    def request(self, obj):
+        self.send(obj)
+        return self.recv()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def benchLatency(args):
+    server = BenchServer(args.port)
+    try:
+        client = server.connect()
+        client.request({'command': 'get-version'})
+
+        times = []
+        for i in range(args.count):
+            start = time.perf_counter()
+            client.request({'command': 'get-version'})
+            times.append(time.perf_counter() - start)
+        printTimes("get-version round trip", times)
+
+        cpuStart = processCPUTime(server.process.pid)
+        wakeStart = processWakeups(server.process.pid)
+        time.sleep(args.idle)
+        cpu = processCPUTime(server.process.pid) - cpuStart
+        wakeups = processWakeups(server.process.pid) - wakeStart
+        print("idle CPU: {:.3f}s over {}s ({:.2f}%), {} wakeups".format(cpu, args.idle, cpu / args.idle * 100, wakeups))
+        client.close()
+    finally:
+        server.stop()
+
+
+def benchBurst(args):
+    server = BenchServer(args.port)
+    try:
+        client = server.connect()
+        client.request({'command': 'get-version'})
+
+        start = time.perf_counter()
+        client.socket.sendall(("".join([json.dumps({'command': 'get-version'}) + "\n"] * args.count)).encode('utf-8'))
+        for i in range(args.count):
+            client.recv()
+        elapsed = time.perf_counter() - start
+        print("burst of {} commands: {:.3f}s ({:.0f} msg/s)".format(args.count, elapsed, args.count / elapsed))
+        stats = client.request({'command': 'get-stats'})
+        if 'data' in stats:
+            print("server stats: " + repr(stats['data']))
+        client.close()
+    finally:
+        server.stop()
+
+
+class LoadClient:
+    def __init__(self, port, count):
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(False)
+        self.buffer = b''
+        self.remaining = count
+        self.sent = None
+
+    def send(self):
+        self.sent = time.perf_counter()
+        self.socket.send(b'{"command": "get-version"}\n')
+
+    def receive(self, times):
+        data = self.socket.recv(65536)
+        if len(data) == 0:
+            raise ConnectionError("Connection Lost.")
+        self.buffer += data
+        while b'\n' in self.buffer:
+            self.buffer = self.buffer[self.buffer.index(b'\n') + 1:]
+            times.append(time.perf_counter() - self.sent)
+            self.remaining -= 1
+            if self.remaining > 0:
+                self.send()
+
+
+def benchLoad(args):
+    server = BenchServer(args.port)
+    try:
+        server.connect().close()
+
+        # every client keeps one command in flight at a time
+        selector = selectors.DefaultSelector()
+        clients = []
+        for i in range(args.clients):
+            client = LoadClient(args.port, args.count)
+            clients.append(client)
+            selector.register(client.socket, selectors.EVENT_READ, client)
+
+        times = []
+        start = time.perf_counter()
+        for client in clients:
+            client.send()
+        active = len(clients)
+        while active > 0:
+            for key, events in selector.select():
+                key.data.receive(times)
+                if key.data.remaining == 0:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    active -= 1
+        elapsed = time.perf_counter() - start
+        selector.close()
+
+        printTimes("{} clients x {} get-version".format(args.clients, args.count), times)
+        print("throughput: {:.0f} commands/s".format(len(times) / elapsed))
+    finally:
+        server.stop()
+
+
+def benchPipeline(args):
+    server = BenchServer(args.port)
+    try:
+        server.connect().close()
+        request = MPVVJRequest.MPVVJRequest(True, False)
+        request.connect('127.0.0.1', args.port)
+
+        start = time.perf_counter()
+        for i in range(args.count):
+            request.collect([request.sendPipelined('get-version')])
+        lockstep = time.perf_counter() - start
+        print("lock-step: {} commands in {:.3f}s ({:.0f} commands/s)".format(
+              args.count, lockstep, args.count / lockstep))
+
+        # keep up to --window commands in flight, collecting the oldest first
+        start = time.perf_counter()
+        ids = []
+        for i in range(args.count):
+            ids.append(request.sendPipelined('get-version'))
+            if len(ids) >= args.window:
+                request.collect(ids[:len(ids) // 2])
+                ids = ids[len(ids) // 2:]
+        request.collect(ids)
+        pipelined = time.perf_counter() - start
+        print("pipelined (window {}): {} commands in {:.3f}s ({:.0f} commands/s, {:.1f}x)".format(
+              args.window, args.count, pipelined, args.count / pipelined, lockstep / pipelined))
+        request.disconnect()
+    finally:
+        server.stop()
+
+
+def benchTransport(args):
+    path = os.path.join(tempfile.mkdtemp(), 'control.sock')
+    server = BenchServer(args.port, ['--control-socket', path])
+    try:
+        server.connect().close()
+
+        def connectTCP():
+            return socket.create_connection(('127.0.0.1', args.port))
+        def connectUnix():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            return sock
+
+        for transport, connect in (('TCP', connectTCP), ('Unix', connectUnix)):
+            client = BenchClient(connect())
+            client.request({'command': 'get-version'})
+            times = []
+            for i in range(args.count):
+                start = time.perf_counter()
+                client.request({'command': 'get-version'})
+                times.append(time.perf_counter() - start)
+            client.close()
+            printTimes(transport + " get-version round trip", times)
+
+        # what each MPVVJCLI.py run pays before its first command
+        for transport in ('TCP', 'Unix'):
+            times = []
+            for i in range(args.connects):
+                request = MPVVJRequest.MPVVJRequest(True, False)
+                start = time.perf_counter()
+                if transport == 'TCP':
+                    request.connect('localhost', args.port)
+                else:
+                    request.connectUnix(path)
+                times.append(time.perf_counter() - start)
+                request.disconnect()
+            printTimes(transport + " connect and version check", times)
+    finally:
+        server.stop()
+
+
+def benchPlaylists(args):
+    print("{:>8} {:>12} {:>12} {:>12} {:>12}".format("count", "new (total)", "select", "tv-playlist", "delete"))
+    for count in args.sizes:
+        state = MPVVJState.MPVVJState()
+        names = ["segment " + str(i) for i in range(count)]
+
+        start = time.perf_counter()
+        state.newPlaylists({'playlists': [{'name': name} for name in names]})
+        new = time.perf_counter() - start
+
+        picks = [names[(i * 7919) % count] for i in range(args.ops)]
+        start = time.perf_counter()
+        for name in picks:
+            state.setSelectedPlaylist({'playlist': name})
+        select = (time.perf_counter() - start) / args.ops
+
+        start = time.perf_counter()
+        for name in picks:
+            state.setInterPlaylist(name)
+        inter = (time.perf_counter() - start) / args.ops
+
+        # delete from the middle, with playlists on either side selected
+        deletes = min(args.ops, count - 2)
+        state.setSelectedPlaylist({'playlist': names[0]})
+        state.setInterPlaylist(names[-1])
+        start = time.perf_counter()
+        for i in range(deletes):
+            state.deletePlaylists({'playlists': [names[1 + i]]})
+        delete = (time.perf_counter() - start) / max(deletes, 1)
+
+        print("{:>8} {:>10.3f}ms {:>10.2f}us {:>10.2f}us {:>10.2f}us".format(
+              count, new * 1000, select * 1000000, inter * 1000000, delete * 1000000))
+
+
+def benchEntries(args):
+    print("{:>8} {:>12} {:>12} {:>14} {:>14}".format("entries", "contains", "first index", "track-by-name", "after delete"))
+    for count in args.sizes:
+        state = MPVVJState.MPVVJState()
+        state.newPlaylists({'playlists': [{'name': 'show'}]})
+        state.setSelectedPlaylist({'playlist': 'show'})
+        # every name appears twice
+        state.addItems({'items': [{'name': "file " + str(i % (count // 2))} for i in range(count)]})
+        pl = state.getSelected()
+        picks = ["file " + str((i * 7919) % (count // 2)) for i in range(args.ops)]
+
+        start = time.perf_counter()
+        for name in picks:
+            name in pl
+        contains = (time.perf_counter() - start) / args.ops
+
+        start = time.perf_counter()
+        for name in picks:
+            pl[name]
+        first = (time.perf_counter() - start) / args.ops
+
+        start = time.perf_counter()
+        for name in picks:
+            state.setPlaylistCurrentItemByName({'name': name, 'occurrence': 1})
+        track = (time.perf_counter() - start) / args.ops
+
+        # the first lookup after a delete pays to find positions again
+        state.deleteItems({'items': [count // 2]})
+        start = time.perf_counter()
+        pl[picks[0]]
+        rebuild = time.perf_counter() - start
+
+        print("{:>8} {:>10.2f}us {:>10.2f}us {:>12.2f}us {:>12.3f}ms".format(
+              count, contains * 1000000, first * 1000000, track * 1000000, rebuild * 1000))
+
+
+def benchShuffle(args):
+    pl = MPVVJState.Playlist('shuffle', True, True)
+    for i in range(args.entries):
+        pl.insertEntry("file " + str(i))
+    advances = args.advances
+    if advances == None:
+        advances = args.entries - 1
+
+    # the first advance pays to build the pool of unplayed entries
+    start = time.perf_counter()
+    pl.advance()
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(advances - 1):
+        pl.advance()
+    advance = (time.perf_counter() - start) / max(advances - 1, 1)
+
+    # run out the pass, only the cued entry is left, then start again
+    while len(pl.pool) > 1:
+        pl.advance()
+    start = time.perf_counter()
+    pl.advance()
+    wrap = time.perf_counter() - start
+
+    # entries marked played by hand come out of the pool as they go
+    marks = min(args.entries, 10000)
+    start = time.perf_counter()
+    for i in range(marks):
+        pl.setPlayed((i * 7919) % args.entries, True)
+    mark = (time.perf_counter() - start) / marks
+
+    start = time.perf_counter()
+    pl.setPlayedRange(0, args.entries // 2, True)
+    half = time.perf_counter() - start
+
+    print("{:>8} {:>10} {:>12} {:>12} {:>12} {:>12} {:>12}".format("entries", "advances", "first", "advance",
+                                                                "set-played", "half played", "loop"))
+    print("{:>8} {:>10} {:>10.3f}ms {:>10.2f}us {:>10.2f}us {:>10.3f}ms {:>10.3f}ms".format(
+          args.entries, advances, first * 1000, advance * 1000000, mark * 1000000, half * 1000, wrap * 1000))
+
+
+def benchBulk(args):
+    def makeState():
+        state = MPVVJState.MPVVJState()
+        state.newPlaylists({'playlists': [{'name': 'show'}, {'name': 'spare'}]})
+        state.setSelectedPlaylist({'playlist': 'show'})
+        state.addItems({'items': [{'name': "file " + str(i)} for i in range(args.entries)]})
+        state.getSelected().setCurrent(args.entries - 1)
+        return state
+
+    # every nth entry, spread through the whole playlist
+    step = args.entries // args.count
+    items = list(range(0, step * args.count, step))
+
+    print("{:>8} {:>8} {:>12} {:>12} {:>12} {:>12} {:>12}".format("entries", "items", "delete", "move", "move away",
+                                                                "delete range", "list bytes"))
+    state = makeState()
+    start = time.perf_counter()
+    state.deleteItems({'items': items})
+    delete = time.perf_counter() - start
+
+    state = makeState()
+    start = time.perf_counter()
+    state.moveItems({'items': items, 'location': (args.entries - args.count) // 2})
+    move = time.perf_counter() - start
+
+    state = makeState()
+    start = time.perf_counter()
+    state.moveItems({'items': items, 'playlist': 'spare'})
+    away = time.perf_counter() - start
+
+    # one range as MPVVJRequest sends it, against the list it used to send
+    state = makeState()
+    start = time.perf_counter()
+    state.deleteItems({'items': [[0, args.count - 1]]})
+    deleteRange = time.perf_counter() - start
+    listBytes = len(json.dumps({'command': 'delete-items', 'items': list(range(args.count))}))
+
+    print("{:>8} {:>8} {:>10.3f}ms {:>10.3f}ms {:>10.3f}ms {:>10.3f}ms {:>12}".format(
+          args.entries, args.count, delete * 1000, move * 1000, away * 1000, deleteRange * 1000, listBytes))
+
+
+def benchSnapshot(args):
+    state = MPVVJState.MPVVJState()
+    state.newPlaylists({'playlists': [{'name': "playlist " + str(i)} for i in range(args.playlists)]})
+    state.setSelectedPlaylist({'playlist': 'playlist 0'})
+    state.addItems({'items': [{'name': "/media/show/file " + str(i)} for i in range(args.entries)]})
+    selected = state.getSelected()
+
+    def fresh():
+        return json.dumps({'playlists': state.getPlaylists(), 'playlist': state.getPlaylist(), 'event': 'list'})
+
+    def cached():
+        return JSONSocket.encodeJSON({'playlists': JSONSocket.JSONFragment(state.getPlaylistsJSON()),
+                                      'playlist': JSONSocket.JSONFragment(state.getPlaylistJSON()), 'event': 'list'})
+
+    def timed(func):
+        start = time.perf_counter()
+        for i in range(args.ops):
+            func()
+        return (time.perf_counter() - start) / args.ops
+
+    def changed():
+        selected.setPlayed(0)
+        return cached()
+
+    def notModified():
+        return json.dumps({'not-modified': True, 'version': state.getVersion(), 'event': 'list'})
+
+    if fresh() != cached():
+        raise RuntimeError("Cached reply differs.")
+    print("{:>8} {:>9} {:>12} {:>12} {:>12} {:>12} {:>14}".format("entries", "playlists", "fresh", "cached", "changed",
+                                                                 "reply bytes", "not-modified"))
+    print("{:>8} {:>9} {:>10.3f}ms {:>10.3f}ms {:>10.3f}ms {:>12} {:>14}".format(
+          args.entries, args.playlists, timed(fresh) * 1000, timed(cached) * 1000, timed(changed) * 1000,
+          len(cached()), len(notModified())))
+
+
+class DictEntry:
+    # how playlist entries used to be kept
+    def __init__(self, name, played=False):
+        self.name = name
+        self.played = played
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return size, kept
+
+
+def benchMemory(args):
+    # names arrive as separate strings off the wire, whatever keeps them
+    # pays for them
+    def makeNames():
+        return ["/srv/media/shows/show " + str(i // 1000) + "/season " + str(i // 100 % 10) +
+                "/episode " + str(i % 100) + ".mkv" for i in range(args.entries)]
+
+    def objects(copies):
+        return [[DictEntry(name) for name in makeNames()] for i in range(copies)]
+
+    def arrays(copies):
+        return [(makeNames(), array.array('I', bytes(args.entries * 4))) for i in range(copies)]
+
+    def state(copies):
+        state = MPVVJState.MPVVJState()
+        for i in range(copies):
+            state.newPlaylists({'playlists': [{'name': str(i)}]})
+            state.setSelectedPlaylist({'playlist': str(i)})
+            state.getSelected().insertEntries(makeNames())
+        return state
+
+    print("{:>8} {:>9} {:>14} {:>14} {:>14}".format("entries", "playlists", "objects", "arrays", "path store"))
+    for copies in (1, 2):
+        sizes = []
+        for build in (objects, arrays, state):
+            size, kept = measure(lambda: build(copies))
+            sizes.append(size / (args.entries * copies))
+            del kept
+        print("{:>8} {:>9} {:>8.1f} B/entry {:>8.1f} B/entry {:>8.1f} B/entry".format(args.entries, copies, *sizes))
+
+
+def framingPairTCP(port):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(1)
+    reader = JSONSocket.JSONTCPSocket(listening=False, host='127.0.0.1', port=port)
+    writer = listener.accept()[0]
+    listener.close()
+    return reader, writer
+
+
+def framingPairUnix(port):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    reader = JSONSocket.JSONUnixSocket(listening=False, path=path)
+    writer = listener.accept()[0]
+    listener.close()
+    return reader, writer
+
+
+def framingRun(makePair, port, line, count):
+    reader, writer = makePair(port)
+    payload = (line + b'\n') * count
+    sender = threading.Thread(target=writer.sendall, args=(payload,))
+
+    selector = selectors.DefaultSelector()
+    selector.register(reader.socket, selectors.EVENT_READ | selectors.EVENT_WRITE)
+    start = time.perf_counter()
+    sender.start()
+    received = 0
+    while received < count:
+        got = reader.readSocketLine()
+        if got is None:
+            if reader.connected:
+                selector.modify(reader.socket, selectors.EVENT_READ)
+            selector.select()
+        else:
+            received += 1
+    elapsed = time.perf_counter() - start
+    sender.join()
+    selector.close()
+    writer.close()
+    reader.close()
+    return elapsed, len(payload)
+
+
+def benchFraming(args):
+    for transport, makePair in (('JSONTCPSocket', framingPairTCP), ('JSONUnixSocket', framingPairUnix)):
+        for label, line, count in (("10MB lines", b'x' * 10485760, args.big),
+                                   ("small lines", b'{"command": "get-version"}', args.small)):
+            elapsed, size = framingRun(makePair, args.port, line, count)
+            print("{} {} x{}: {:.3f}s ({:.1f} MB/s, {:.0f} lines/s)".format(
+                  transport, label, count, elapsed, size / elapsed / 1048576, count / elapsed))
+
+
+class FakeMpv:
+    # stands in for mpv in the gap benchmark.  Every file plays for the same
+    # length, and there's just enough of mpv's IPC for the server and for
+    # the benchmark watching events from a connection of its own.  Only
+    # pause and eof-reached are ever observed with a value.
+    def __init__(self, argv):
+        opts = {}
+        for arg in argv:
+            if arg.startswith('--') and '=' in arg:
+                opts[arg[2:].split('=', 1)[0]] = arg.split('=', 1)[1]
+        self.length = float(opts.get('fake-clip-length', '0.1'))
+        self.keepOpen = opts.get('keep-open') == 'yes'
+        self.path = opts['input-ipc-server']
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        # [entry ID, name] for each item, and which is playing
+        self.playlist = []
+        self.current = None
+        self.nextEntry = 1
+        self.ends = None
+        # what's left of the playing file while paused or at its end
+        self.left = None
+        self.props = {'pause': False, 'eof-reached': False}
+        # [connection, ID, name] for each observer
+        self.observers = []
+
+    def send(self, conn, obj):
+        try:
+            conn.sendall((json.dumps(obj) + "\n").encode('utf-8'))
+        except OSError:
+            pass
+
+    def broadcast(self, obj):
+        for conn in list(self.buffers):
+            self.send(conn, obj)
+
+    def setProp(self, name, value):
+        if self.props[name] == value:
+            return
+        self.props[name] = value
+        for observer in self.observers:
+            if observer[2] == name:
+                self.send(observer[0], {'event': 'property-change', 'id': observer[1],
+                                        'name': name, 'data': value})
+
+    def start(self, idx):
+        self.current = idx
+        self.setProp('eof-reached', False)
+        if self.props['pause']:
+            self.ends = None
+            self.left = self.length
+        else:
+            self.ends = time.monotonic() + self.length
+        self.broadcast({'event': 'start-file', 'playlist_entry_id': self.playlist[idx][0]})
+        self.broadcast({'event': 'playback-restart'})
+
+    def setPause(self, pause):
+        if self.current is not None and not self.props['eof-reached']:
+            if pause and self.ends is not None:
+                self.left = self.ends - time.monotonic()
+                self.ends = None
+            elif not pause and self.ends is None:
+                self.ends = time.monotonic() + self.left
+        self.setProp('pause', pause)
+
+    def end(self, reason):
+        if reason == 'eof' and self.keepOpen:
+            # stays on the last frame
+            self.ends = None
+            self.left = 0
+            self.setProp('pause', True)
+            self.setProp('eof-reached', True)
+            return
+        self.broadcast({'event': 'end-file', 'reason': reason, 'playlist_entry_id': self.playlist[self.current][0]})
+        self.ends = None
+        self.setProp('eof-reached', False)
+        if reason == 'eof' and self.current + 1 < len(self.playlist):
+            self.start(self.current + 1)
+        else:
+            self.current = None
+            self.broadcast({'event': 'idle'})
+
+    def handle(self, conn, obj):
+        command = obj['command']
+        reply = {'error': 'success'}
+        change = None
+        if command[0] == 'loadfile':
+            entry = [self.nextEntry, command[1]]
+            self.nextEntry += 1
+            reply['data'] = {'playlist_entry_id': entry[0]}
+            if len(command) > 2 and command[2] == 'append':
+                self.playlist.append(entry)
+            else:
+                if self.current is not None:
+                    self.end('stop')
+                self.playlist = [entry]
+                # like mpv, it's started after loadfile is answered
+                change = 'start'
+        elif command[0] == 'playlist-clear':
+            if self.current is None:
+                self.playlist = []
+            else:
+                self.playlist = [self.playlist[self.current]]
+                self.current = 0
+        elif command[0] == 'playlist-remove':
+            if command[1] == self.current or command[1] >= len(self.playlist):
+                reply = {'error': 'error running command'}
+            else:
+                del self.playlist[command[1]]
+                if self.current is not None and command[1] < self.current:
+                    self.current -= 1
+        elif command[0] == 'stop':
+            if self.current is not None:
+                self.end('stop')
+            self.playlist = []
+        elif command[0] == 'set_property':
+            if command[1] == 'pause':
+                self.setPause(command[2])
+        elif command[0] == 'unobserve_property':
+            self.observers = [observer for observer in self.observers
+                              if observer[0] is not conn or observer[1] != command[1]]
+        elif command[0] in ('observe_property', 'observe_property_string'):
+            self.observers.append([conn, command[1], command[2]])
+            change = {'event': 'property-change', 'id': command[1], 'name': command[2]}
+            if command[2] in self.props:
+                change['data'] = self.props[command[2]]
+        elif command[0] == 'get_property' and command[1] == 'playtime-remaining' and \
+             self.current is not None:
+            if self.ends is not None:
+                reply['data'] = max(0, self.ends - time.monotonic())
+            else:
+                reply['data'] = self.left
+        elif command[0] == 'get_property' and command[1] == 'playlist-count':
+            reply['data'] = len(self.playlist)
+        elif command[0] in ('get_property', 'get_property_string'):
+            reply = {'error': 'property unavailable'}
+        if 'request_id' in obj:
+            reply['request_id'] = obj['request_id']
+        self.send(conn, reply)
+        if change == 'start':
+            self.start(0)
+        elif change is not None:
+            self.send(conn, change)
+
+    def run(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX)
+        listener.bind(self.path)
+        listener.listen(4)
+        self.selector.register(listener, selectors.EVENT_READ)
+        while True:
+            timeout = None
+            if self.ends is not None:
+                timeout = max(0, self.ends - time.monotonic())
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is listener:
+                    conn = listener.accept()[0]
+                    self.buffers[conn] = b''
+                    self.selector.register(conn, selectors.EVENT_READ)
+                    continue
+                conn = key.fileobj
+                data = conn.recv(65536)
+                if len(data) == 0:
+                    self.selector.unregister(conn)
+                    del self.buffers[conn]
+                    self.observers = [observer for observer in self.observers if observer[0] is not conn]
+                    conn.close()
+                    continue
+                lines = (self.buffers[conn] + data).split(b'\n')
+                self.buffers[conn] = lines.pop()
+                for line in lines:
+                    self.handle(conn, json.loads(line))
+            if self.ends is not None and time.monotonic() >= self.ends:
+                self.end('eof')
+
+
+def timeDeckSwitches(client, socketPaths, items, length, crossfade):
+    # how far from when it was due each deck went on air, the first by its
+    # first frame and the rest by being unpaused
+    events = queue.Queue()
+    conns = []
+    watchers = []
+
+    def watch(deck, conn):
+        try:
+            while True:
+                obj = conn.recv()
+                events.put((time.perf_counter(), deck, obj))
+        except (ConnectionError, ValueError, OSError):
+            pass
+    for item in enumerate(socketPaths):
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(item[1])
+        conn = BenchClient(sock)
+        conn.send({'command': ['observe_property', 1, 'pause']})
+        conns.append(conn)
+        watchers.append(threading.Thread(target=watch, args=(item[0], conn)))
+        watchers[-1].start()
+
+    client.request({'command': 'play'})
+    late = []
+    onAir = None
+    while len(late) < items - 1:
+        when, deck, obj = events.get()
+        if obj.get('event') == 'playback-restart':
+            if onAir is None:
+                onAir = when
+        elif obj.get('event') == 'property-change' and obj.get('data') == False and onAir is not None:
+            late.append(when - (onAir + length - crossfade))
+            onAir = when
+    # readers blocked on a connection only let go of it once it's shut down
+    for conn in conns:
+        conn.socket.shutdown(socket.SHUT_RDWR)
+    for watcher in watchers:
+        watcher.join()
+    for conn in conns:
+        conn.close()
+    return late
+
+
+def benchGap(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        mpvPath = args.mpv
+        clips = args.clips
+        opts = []
+        if mpvPath is None:
+            # this script stands in for mpv
+            mpvPath = os.path.join(tmp, 'fake-mpv')
+            with open(mpvPath, 'w') as f:
+                f.write("#!/bin/sh\nexec '" + sys.executable + "' '" + os.path.abspath(__file__) + "' fake-mpv \"$@\"\n")
+            os.chmod(mpvPath, 0o755)
+            clips = ["clip " + str(i) for i in range(args.count)]
+            opts.append(['fake-clip-length', str(args.length)])
+        elif clips is None:
+            raise ValueError("A real mpv needs --clips to play.")
+        socketPath = os.path.join(tmp, 'mpv.sock')
+        serverArgs = ['--mpv-path', mpvPath, '--mpv-socket-path', socketPath]
+        if args.dual_deck:
+            serverArgs.extend(('--dual-deck', '--crossfade', str(args.crossfade)))
+        server = BenchServer(args.port, serverArgs)
+        try:
+            client = server.connect()
+            client.request({'command': 'set-mpv-opts', 'opts': opts})
+            client.request({'command': 'new-playlists', 'playlists': [{'name': 'gap'}]})
+            client.request({'command': 'select-playlist', 'playlist': 'gap'})
+            client.request({'command': 'add-items', 'items': [{'name': clip} for clip in clips]})
+            client.request({'command': 'cue-playlist', 'playlist': 'gap'})
+            client.request({'command': 'run-mpv'})
+
+            if args.dual_deck:
+                late = timeDeckSwitches(client, (socketPath, socketPath + '.b'), len(clips),
+                                        args.length, args.crossfade)
+                printTimes("deck switch against when it was due", late)
+                client.request({'command': 'terminate-mpv'})
+                return
+
+            # watch mpv's events from a connection of our own
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(socketPath)
+            events = BenchClient(sock)
+            client.request({'command': 'play'})
+            gaps = []
+            ended = None
+            starts = 0
+            while starts < len(clips):
+                obj = events.recv()
+                if 'event' not in obj:
+                    continue
+                if obj['event'] == 'end-file' and obj.get('reason') == 'eof':
+                    ended = time.perf_counter()
+                elif obj['event'] == 'playback-restart':
+                    starts += 1
+                    if ended is not None:
+                        gaps.append(time.perf_counter() - ended)
+                        ended = None
+            printTimes("end of one item to playback of the next", gaps)
+            events.close()
+            client.request({'command': 'terminate-mpv'})
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'fake-mpv':
+        FakeMpv(sys.argv[2:]).run()
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="MPV-VJ3 - Benchmarks.")
+    parser.add_argument('--port', metavar="<port>", type=int,
+                        help="Port for benchmark servers.", default=DEFAULT_PORT)
+    parser.add_argument('--engine', choices=('select', 'asyncio'),
+                        help="Server event loop to benchmark.", default=None)
+    benches = parser.add_subparsers(dest='bench', metavar="<benchmark>")
+    benches.required = True
+
+    latency = benches.add_parser('latency', help="Command round trip latency and idle server CPU.")
+    latency.add_argument('--count', type=int, default=200, help="Number of commands.")
+    latency.add_argument('--idle', type=float, default=5, help="Seconds to measure idle CPU over.")
+    latency.set_defaults(func=benchLatency)
+
+    burst = benches.add_parser('burst', help="Throughput of a burst of commands sent at once.")
+    burst.add_argument('--count', type=int, default=1000, help="Number of commands.")
+    burst.set_defaults(func=benchBurst)
+
+    load = benches.add_parser('load', help="Command latency with many concurrent clients.")
+    load.add_argument('--clients', type=int, default=300, help="Number of concurrent clients.")
+    load.add_argument('--count', type=int, default=50, help="Commands per client.")
+    load.set_defaults(func=benchLoad)
+
+    pipeline = benches.add_parser('pipeline', help="Lock-step against pipelined command throughput.")
+    pipeline.add_argument('--count', type=int, default=5000, help="Number of commands each way.")
+    pipeline.add_argument('--window', type=int, default=64, help="Most commands in flight when pipelining.")
+    pipeline.set_defaults(func=benchPipeline)
+
+    transport = benches.add_parser('transport', help="Latency over TCP against the Unix control socket.")
+    transport.add_argument('--count', type=int, default=2000, help="Number of commands each way.")
+    transport.add_argument('--connects', type=int, default=200, help="Number of connections each way.")
+    transport.set_defaults(func=benchTransport)
+
+    playlists = benches.add_parser('playlists', help="MPVVJState playlist operations against playlist count.")
+    playlists.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000],
+                           help="Playlist counts to measure.")
+    playlists.add_argument('--ops', type=int, default=200, help="Operations timed at each count.")
+    playlists.set_defaults(func=benchPlaylists)
+
+    entries = benches.add_parser('entries', help="Playlist entry lookups by name against playlist length.")
+    entries.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 500000],
+                         help="Playlist lengths to measure.")
+    entries.add_argument('--ops', type=int, default=200, help="Lookups timed at each length.")
+    entries.set_defaults(func=benchEntries)
+
+    shuffle = benches.add_parser('shuffle', help="Advancing through a long shuffled playlist.")
+    shuffle.add_argument('--entries', type=int, default=1000000, help="Playlist length.")
+    shuffle.add_argument('--advances', type=int, default=None, help="Number of advances, default one full pass.")
+    shuffle.set_defaults(func=benchShuffle)
+
+    bulk = benches.add_parser('bulk', help="Deleting and moving many items out of a long playlist.")
+    bulk.add_argument('--entries', type=int, default=1000000, help="Playlist length.")
+    bulk.add_argument('--count', type=int, default=100000, help="Items deleted or moved.")
+    bulk.set_defaults(func=benchBulk)
+
+    snapshot = benches.add_parser('snapshot', help="Encoding 'list' replies fresh against from cached fragments.")
+    snapshot.add_argument('--entries', type=int, default=100000, help="Length of the listed playlist.")
+    snapshot.add_argument('--playlists', type=int, default=1000, help="Number of playlists.")
+    snapshot.add_argument('--ops', type=int, default=20, help="Replies encoded for each column.")
+    snapshot.set_defaults(func=benchSnapshot)
+
+    memory = benches.add_parser('memory', help="Bytes per playlist entry, names included, for each way of keeping them.")
+    memory.add_argument('--entries', type=int, default=1000000, help="Playlist length.")
+    memory.set_defaults(func=benchMemory)
+
+    gap = benches.add_parser('gap', help="Time between one playlist item ending and the next playing.")
+    gap.add_argument('--mpv', metavar="<PATH>", type=str, default=None,
+                     help="Real mpv to play --clips with, a stand-in is used otherwise.")
+    gap.add_argument('--clips', metavar="<file>", nargs='+', default=None, help="Files for a real mpv to play.")
+    gap.add_argument('--count', type=int, default=50, help="Items the stand-in plays.")
+    gap.add_argument('--length', type=float, default=0.1,
+                     help="Seconds each item plays for on the stand-in, or lasts with --clips in dual deck mode.")
+    gap.add_argument('--dual-deck', action='store_true', help="Switch between two mpvs instead.")
+    gap.add_argument('--crossfade', type=float, default=0, help="Seconds to crossfade for in dual deck mode.")
+    gap.set_defaults(func=benchGap)
+
+    framing = benches.add_parser('framing', help="Line framing throughput of JSONSocket readers.")
+    framing.add_argument('--big', type=int, default=3, help="Number of 10MB lines.")
+    framing.add_argument('--small', type=int, default=100000, help="Number of small lines.")
+    framing.set_defaults(func=benchFraming)
+
+    args = parser.parse_args()
+    BenchServer.engine = args.engine
+    args.func(args)
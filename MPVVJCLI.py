@@ -16,6 +16,9 @@
 # along with MPV-VJ3.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import os
+import shlex
+import stat
 import sys
 
 import MPVVJRequest
@@ -24,7 +27,7 @@ import MPVVJRequest
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = "12345"
 
-if __name__ == '__main__':
+def buildParser():
     parser = argparse.ArgumentParser(description="MPV-VJ3 - Remotely control mpv and manage playlists with an mpvc-like interface.", epilog="""<playlist> refers to a name of a playlist.
 <range> refers to a comma separated list of single values or ranges denoted by <start>-<end>.
 <format string> refers to a string containing replacement strings for various values.  These include
@@ -39,6 +42,11 @@ May be called with no arguments for a generic status output.""")
                         help="Address to connect to.", default=DEFAULT_HOST)
     clientopts.add_argument('--port', metavar="<port>", type=int,
                         help="Port to connect to.", default=DEFAULT_PORT)
+    clientopts.add_argument('--socket', metavar="<path>", type=str,
+                        help="Connect to the server's control socket instead of over TCP.", default=None)
+    clientopts.add_argument('-i', '--interactive', action='store_true', help="Read commands from the terminal, one command line at a time, over one connection.")
+    clientopts.add_argument('--script', type=str, metavar="<file>", help="Read command lines from a file, or - for stdin, over one connection.  Stops at the first failure.")
+    clientopts.add_argument('--atomic', action='store_true', help="Undo all playlist changes if any action fails.  Can't be used with actions which wait on or control mpv.")
     mpvacts = parser.add_argument_group(title="MPV Actions")
     mpvacts.add_argument('-O', '--mpv-opts', type=str, nargs=argparse.REMAINDER, help="Set mpv arguments.  Must be last option.  Format: <option[=value]> [option[=value]] ...")
     mpvacts.add_argument('-r', '--run', action='store_true', help="Run MPV.")
@@ -56,6 +64,7 @@ May be called with no arguments for a generic status output.""")
     playlistacts.add_argument('-Y', '--set-not-played', type=str, metavar="<range>", help="Flag files as not played.")
     playlistacts.add_argument('-j', '--track', type=int, help="Go forwards/backwards through the playlist queue.")
     playlistacts.add_argument('-J', '--tracknum', type=int, help="Jump to playlist item number.")
+    playlistacts.add_argument('--track-name', type=str, metavar="<name>", help="Jump to the first playlist item with this name.")
     playbackacts = parser.add_argument_group(title="Playback Actions")
     playbackacts.add_argument('-L', '--loopfile', action='store_true', help="Loop currently playing file.")
     playbackacts.add_argument('-t', '--seek', type=str, metavar="<reltime>", help="Increase/decrease time relative to the current time.")
@@ -70,19 +79,194 @@ May be called with no arguments for a generic status output.""")
     infoacts = parser.add_argument_group(title="Information Actions")
     infoacts.add_argument('-f', '--format', type=str, metavar="<format string>", help="Enter a formatting string.")
     infoacts.add_argument('-S', '--list', action='store_true', help="Print all playlists and tracks in selected playlist.")
+    infoacts.add_argument('--range', type=str, metavar="<range>", help="List only these tracks in selected playlist.  Format: <start>[-<end>]")
+    infoacts.add_argument('--around-cue', type=int, metavar="<count>", help="List only this many tracks either side of the cued track.")
     serveracts = parser.add_argument_group(title="Server Actions")
     serveracts.add_argument('--clear', action='store_true', help="Clear all server state.")
+    serveracts.add_argument('--stats', action='store_true', help="Print server message counters.")
     serveracts.add_argument('--kill-server', action='store_true', help="Kill server.")
     serveracts.add_argument('--tv-intervals', type=int, nargs=2, help="TV mode intervals in seconds.  1st: Main program  2nd: Intermission")
     serveracts.add_argument('--tv-playlist', type=str, metavar='<playlist>', help="Set TV mode playlist.")
     serveracts.add_argument('--tv-mode', action='store_true', help="Toggle TV mode.")
+    serveracts.add_argument('--crossfade', type=float, metavar='<seconds>',
+                            help="Seconds to crossfade between decks for, 0 to cut.  Server must be in dual deck mode.")
+
+    return parser
+
+
+def hasAction(args):
+    return (args.mpv_opts or args.run or args.kill or args.new or args.delete or
+            args.select or args.loop or args.shuffle or args.add or args.delete_items or
+            args.move or args.set_played or args.set_not_played or args.track != None or args.tracknum != None or args.track_name or
+            args.loopfile or args.seek or args.time or args.vol != None or args.volume != None or
+            args.mute or args.cue or args.play or args.stop or args.toggle or
+            args.format or args.list or args.range or args.around_cue != None or args.clear or args.stats or args.kill_server or args.tv_intervals or
+            args.tv_playlist or args.tv_mode or args.crossfade != None)
+
+
+def runActions(request, args):
+    response = True
+    if hasAction(args):
+        # everything goes to the server in one batch, which stops at the
+        # first failure like sending the commands one by one did
+        request.beginBatch()
+        if args.mpv_opts:
+            request.mpvOpts(args.mpv_opts)
+        if args.run:
+            request.run()
+        if args.kill:
+            request.kill()
+        if args.new:
+            request.newPlaylist(args.new)
+        if args.delete:
+            request.deletePlaylist(args.delete)
+        if args.select:
+            request.selectPlaylist(args.select)
+        if args.loop:
+            request.loop()
+        if args.shuffle:
+            request.shuffle()
+        if args.add:
+            request.addItems(args.add)
+        if args.delete_items:
+            request.deleteItems(args.delete_items)
+        if args.move:
+            request.move(args.move)
+        if args.set_played:
+            request.setPlayed(args.set_played)
+        if args.set_not_played:
+            request.setNotPlayed(args.set_not_played)
+        if args.track != None:
+            request.track(args.track)
+        if args.tracknum != None:
+            request.trackNum(args.tracknum)
+        if args.track_name:
+            request.trackName(args.track_name)
+        if args.loopfile:
+            request.loopFile()
+        if args.seek:
+            request.seek(args.seek)
+        if args.time:
+            request.time(args.time)
+        if args.vol != None:
+            request.vol(args.vol)
+        if args.volume != None:
+            request.volume(args.volume)
+        if args.mute:
+            request.mute()
+        if args.cue:
+            request.cue(args.cue)
+        if args.play:
+            request.play()
+        if args.stop:
+            request.stop()
+        if args.toggle:
+            request.toggle()
+        if args.format:
+            request.format(args.format)
+        if args.list or args.range or args.around_cue != None:
+            request.list(args.range, args.around_cue)
+        if args.clear:
+            request.clear()
+        if args.stats:
+            request.stats()
+        if args.tv_intervals:
+            request.TVIntervals(args.tv_intervals)
+        if args.tv_playlist:
+            request.TVPlaylist(args.tv_playlist)
+        if args.tv_mode:
+            request.TVMode()
+        if args.crossfade != None:
+            request.crossfade(args.crossfade)
+        reqID = request.endBatch(args.atomic)
+        if reqID is not None:
+            response = request.waitForResponse(reqID)
+        if response == True and args.kill_server:
+            request.killServer()
+            response = request.waitForResponse()
+    else:
+        request.beginBatch()
+        request.status()
+        response = request.waitForResponse(request.endBatch())
+    return response
+
+
+def runLine(request, parser, line):
+    try:
+        words = shlex.split(line, comments=True)
+    except ValueError as e:
+        request.print("Error: " + e.args[0])
+        return False
+    if len(words) == 0:
+        return True
+    try:
+        args = parser.parse_args(words)
+    except SystemExit as e:
+        # argparse has already said what was wrong, or printed the help
+        return e.code == 0
+    try:
+        return runActions(request, args)
+    except ValueError as e:
+        request.print("Error: " + e.args[0])
+        return False
+
+
+def runSession(request, parser, infile, interactive):
+    # command lines are read straight from the fd so a selector can wait on
+    # them and the server at once, printing what the server sends meanwhile
+    # and keeping the connection alive while nothing is typed
+    fd = infile.fileno()
+    # regular files are always readable and can't be waited on anyway
+    regular = stat.S_ISREG(os.fstat(fd).st_mode)
+    buffer = b''
+    eof = False
+    response = True
+    prompt = True
+    while True:
+        while True:
+            newline = buffer.find(b'\n')
+            if newline >= 0:
+                line = buffer[:newline]
+                buffer = buffer[newline+1:]
+            elif eof and len(buffer) > 0:
+                line = buffer
+                buffer = b''
+            else:
+                break
+            if not runLine(request, parser, str(line, 'utf-8', 'replace')):
+                response = False
+                if not interactive:
+                    return False
+            prompt = True
+        if eof:
+            return response
 
+        if interactive and prompt:
+            request.print("> ", end='')
+            sys.stdout.flush()
+            prompt = False
+        if regular or request.waitForSocket(request.KEEPALIVE_PERIOD, fd):
+            data = os.read(fd, 65536)
+            if len(data) == 0:
+                eof = True
+                if interactive:
+                    request.print()
+            buffer += data
+        request.poll()
+        request.keepalive()
+
+
+if __name__ == '__main__':
+    parser = buildParser()
     args = parser.parse_args()
 
     request = MPVVJRequest.MPVVJRequest(args.quiet, args.verbose)
-    def try_connect(request, host, port, quiet):
+    def try_connect(request, host, port, path, quiet):
         try:
-            request.connect(host, port)
+            if path is not None:
+                request.connectUnix(path)
+            else:
+                request.connect(host, port)
         except ConnectionRefusedError:
             if not quiet:
                 print("Connection Failed: Connection Refused!")
@@ -94,117 +278,26 @@ May be called with no arguments for a generic status output.""")
         return True
 
     response = True
-    if try_connect(request, args.address, args.port, args.quiet):
+    if try_connect(request, args.address, args.port, args.socket, args.quiet):
         try:
-            if (args.mpv_opts or args.run or args.kill or args.new or args.delete or
-                args.select or args.loop or args.shuffle or args.add or args.delete_items or
-                args.move or args.set_played or args.set_not_played or args.track != None or args.tracknum != None or
-                args.loopfile or args.seek or args.time or args.vol != None or args.volume != None or
-                args.mute or args.cue or args.play or args.stop or args.toggle or
-                args.format or args.list or args.clear or args.kill_server or args.tv_intervals or
-                args.tv_playlist or args.tv_mode):
-                if args.mpv_opts:
-                    request.mpvOpts(args.mpv_opts)
-                    response = request.waitForResponse()
-                if response == True and args.run:
-                    request.run()
-                    response = request.waitForResponse()
-                if response == True and args.kill:
-                    request.kill()
-                    response = request.waitForResponse()
-                if response == True and args.new:
-                    request.newPlaylist(args.new)
-                    response = request.waitForResponse()
-                if response == True and args.delete:
-                    request.deletePlaylist(args.delete)
-                    response = request.waitForResponse()
-                if response == True and args.select:
-                    request.selectPlaylist(args.select)
-                    response = request.waitForResponse()
-                if response == True and args.loop:
-                    request.loop()
-                    response = request.waitForResponse()
-                if response == True and args.shuffle:
-                    request.shuffle()
-                    response = request.waitForResponse()
-                if response == True and args.add:
-                    request.addItems(args.add)
-                    response = request.waitForResponse()
-                if response == True and args.delete_items:
-                    request.deleteItems(args.delete_items)
-                    response = request.waitForResponse()
-                if response == True and args.move:
-                    request.move(args.move)
-                    response = request.waitForResponse()
-                if response == True and args.set_played:
-                    request.setPlayed(args.set_played)
-                    response = request.waitForResponse()
-                if response == True and args.set_not_played:
-                    request.setNotPlayed(args.set_not_played)
-                    response = request.waitForResponse()
-                if response == True and args.track != None:
-                    request.track(args.track)
-                    response = request.waitForResponse()
-                if response == True and args.tracknum != None:
-                    request.trackNum(args.tracknum)
-                    response = request.waitForResponse()
-                if response == True and args.loopfile:
-                    request.loopFile()
-                    response = request.waitForResponse()
-                if response == True and args.seek:
-                    request.seek(args.seek)
-                    response = request.waitForResponse()
-                if response == True and args.time:
-                    request.time(args.time)
-                    response = request.waitForResponse()
-                if response == True and args.vol != None:
-                    request.vol(args.vol)
-                    response = request.waitForResponse()
-                if response == True and args.volume != None:
-                    request.volume(args.volume)
-                    response = request.waitForResponse()
-                if response == True and args.mute:
-                    request.mute()
-                    response = request.waitForResponse()
-                if response == True and args.cue:
-                    request.cue(args.cue)
-                    response = request.waitForResponse()
-                if response == True and args.play:
-                    request.play()
-                    response = request.waitForResponse()
-                if response == True and args.stop:
-                    request.stop()
-                    response = request.waitForResponse()
-                if response == True and args.toggle:
-                    request.toggle()
-                    response = request.waitForResponse()
-                if response == True and args.format:
-                    request.format(args.format)
-                    response = request.waitForResponse()
-                if response == True and args.list:
-                    request.list()
-                    response = request.waitForResponse()
-                if response == True and args.clear:
-                    request.clear()
-                    response = request.waitForResponse()
-                if response == True and args.kill_server:
-                    request.killServer()
-                    response = request.waitForResponse()
-                if response == True and args.tv_intervals:
-                    request.TVIntervals(args.tv_intervals)
-                    response = request.waitForResponse()
-                if response == True and args.tv_playlist:
-                    request.TVPlaylist(args.tv_playlist)
-                    response = request.waitForResponse()
-                if response == True and args.tv_mode:
-                    request.TVMode()
-                    response = request.waitForResponse()
+            if args.interactive:
+                response = runSession(request, parser, sys.stdin, True)
+            elif args.script == '-':
+                response = runSession(request, parser, sys.stdin, False)
+            elif args.script is not None:
+                with open(args.script, 'rb') as script:
+                    response = runSession(request, parser, script, False)
             else:
-                request.status()
-                response = request.waitForResponse()
+                response = runActions(request, args)
+        except ValueError as e:
+            if not args.quiet:
+                print("Error: " + e.args[0])
+            response = False
         except ConnectionError as e:
             if not args.quiet:
                 print("Connection lost: " + e.args[0])
+        except KeyboardInterrupt:
+            pass
     else:
         sys.exit(2)
 
@@ -0,0 +1,160 @@
+# MPV-VJ3 Copyright 2017 paulguy <paulguy119@gmail.com>
+#
+# This file is part of MPV-VJ3.
+#
+# MPV-VJ3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MPV-VJ3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with MPV-VJ3.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import stat
+import threading
+import concurrent.futures
+
+
+class MPVVJPrefetcher:
+    # gets the start of files about to be played in to the page cache on a
+    # pool of threads, so mpv doesn't stall on cold reads from slow disks.
+    # Each plan replaces the last, and work for an old plan stops at its
+    # next chunk.
+    WORKERS = 2
+    # most of each file warmed, and how much is done between checks for a
+    # newer plan
+    HEAD_BYTES = 16777216
+    CHUNK = 1048576
+
+    def __init__(self, base, budget, workers=WORKERS):
+        if type(base) != str or type(budget) != int or type(workers) != int:
+            raise TypeError
+        if budget < 0:
+            raise ValueError("budget can't be negative.")
+        if workers < 1:
+            raise ValueError("workers must be at least 1.")
+        # relative names are found from where mpv was started
+        self.base = base
+        self.budget = budget
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix='prefetch')
+        self.futures = []
+        self.names = []
+
+        # everything below is shared with the workers
+        self.lock = threading.Lock()
+        self.generation = 0
+        # names warmed for the current or last plan
+        self.warmed = set()
+        # bytes of the budget each name being or already warmed took
+        self.claimed = {}
+        self.stats = {'prefetch-hits': 0, 'prefetch-misses': 0,
+                      'prefetch-bytes': 0, 'prefetch-cancelled': 0}
+
+    def plan(self, names):
+        # names in the order they'll be wanted, nothing is done again for
+        # what's unchanged since the last plan
+        if names == self.names:
+            return
+        self.names = names
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.warmed.intersection_update(names)
+            warmed = set(self.warmed)
+            for name in list(self.claimed):
+                if name not in warmed:
+                    del self.claimed[name]
+        for future in self.futures:
+            if future.cancel():
+                self.count('prefetch-cancelled', 1)
+        self.futures = []
+
+        # what's left of the budget is handed out as the workers find out
+        # how big each file is
+        for name in names:
+            if name in warmed:
+                continue
+            warmed.add(name)
+            self.futures.append(self.executor.submit(self.warm, generation, name))
+
+    def count(self, stat, value):
+        with self.lock:
+            self.stats[stat] += value
+
+    def used(self, name):
+        # called with each item handed to mpv
+        with self.lock:
+            if name in self.warmed:
+                self.stats['prefetch-hits'] += 1
+            else:
+                self.stats['prefetch-misses'] += 1
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def stale(self, generation):
+        return generation != self.generation
+
+    def claim(self, generation, name, size):
+        with self.lock:
+            if self.stale(generation):
+                return 0
+            size = min(size, self.HEAD_BYTES, self.budget - sum(self.claimed.values()))
+            if size <= 0:
+                return 0
+            self.claimed[name] = size
+            return size
+
+    def warm(self, generation, name):
+        # URLs and anything else mpv opens itself are left alone
+        if '://' in name:
+            return
+        path = os.path.join(self.base, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            info = os.fstat(fd)
+            if not stat.S_ISREG(info.st_mode):
+                return
+            size = self.claim(generation, name, info.st_size)
+            offset = 0
+            while offset < size:
+                if self.stale(generation):
+                    self.count('prefetch-cancelled', 1)
+                    return
+                length = min(self.CHUNK, size - offset)
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+                else:
+                    # read and thrown away, it's the cache being filled
+                    length = len(os.pread(fd, length, offset))
+                    if length == 0:
+                        break
+                offset += length
+                self.count('prefetch-bytes', length)
+        except OSError:
+            return
+        finally:
+            os.close(fd)
+        if size == 0:
+            # left for a later plan to try again once there's budget
+            return
+        with self.lock:
+            if not self.stale(generation):
+                self.warmed.add(name)
+
+    def shutdown(self):
+        with self.lock:
+            self.generation += 1
+        self.executor.shutdown(wait=False, cancel_futures=True)
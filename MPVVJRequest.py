@@ -16,15 +16,20 @@
 # along with MPV-VJ3.  If not, see <http://www.gnu.org/licenses/>.
 
 import time
+import selectors
 
 import JSONSocket
 import MPVVJUtils
 
 class MPVVJRequest:
-    TPS = 20
     CONNECT_TIMEOUT = 30
     TIMEOUT_PERIOD = 45
+    # well inside the server's timeout for idle clients
+    KEEPALIVE_PERIOD = 15
     VERSION = 0
+    # answered with several messages, and nothing says which is the last, so
+    # these can't be pipelined
+    MULTI_MESSAGE = ('get-all-state',)
 
     def print(self, text='', end='\n'):
         if not self.quiet:
@@ -46,6 +51,12 @@ class MPVVJRequest:
         self.lastAct = 0
         self.formatStringParts = None
         self.fd = None
+        self.batch = None
+        self.nextID = 0
+        self.inFlight = set()
+        self.replies = {}
+        self.lastSend = 0
+        self.keepalives = set()
 
     def connectStart(self, host, port):
         if type(host) != str:
@@ -66,10 +77,26 @@ class MPVVJRequest:
         self.lastAct = time.monotonic()
         self.versionCheck()
 
+    def connectUnixStart(self, path):
+        if type(path) != str:
+            raise TypeError
+        if self.socket is not None:
+            self.print("Already connected or connection in progress.")
+            return False
+        self.print_debug("Connecting to " + path + "...")
+        try:
+            self.socket = JSONSocket.JSONUnixSocket(listening=False, path=path)
+        except FileNotFoundError:
+            raise ConnectionError("No socket at " + path + ".")
+        self.connectTime = time.monotonic()
+        self.lastAct = time.monotonic()
+        self.versionCheck()
+
     def connectCheck(self):
         if self.socket is not None:
             obj = None
             try:
+                self.socket.flush()
                 obj = self.socket.getJSONAsObj()
             except ConnectionRefusedError as e:
                 self.disconnect()
@@ -110,7 +137,29 @@ class MPVVJRequest:
     def connect(self, host, port):
         self.connectStart(host, port)
         while self.connectCheck():
-            time.sleep(1/self.TPS)
+            self.waitForSocket(self.CONNECT_TIMEOUT)
+
+    def connectUnix(self, path):
+        self.connectUnixStart(path)
+        while self.connectCheck():
+            self.waitForSocket(self.CONNECT_TIMEOUT)
+
+    def waitForSocket(self, timeout, fd=None):
+        # also waits on fd if given, returning True if that's readable
+        fileobj = None
+        if self.socket is not None:
+            fileobj, events = self.socket.getSelectable()
+        if fileobj is None and fd is None:
+            return False
+        with selectors.DefaultSelector() as selector:
+            if fileobj is not None:
+                selector.register(fileobj, events)
+            if fd is not None:
+                selector.register(fd, selectors.EVENT_READ)
+            for key, events in selector.select(timeout):
+                if fd is not None and key.fileobj == fd:
+                    return True
+        return False
 
     def disconnect(self):
         if self.socket is not None:
@@ -132,6 +181,7 @@ class MPVVJRequest:
             try:
                 self.socket.sendObjAsJSON(args)
                 self.connectTime = time.monotonic()
+                self.lastSend = self.connectTime
             except ConnectionRefusedError:
                 self.print("Connection refused.")
                 self.disconnect()
@@ -142,7 +192,105 @@ class MPVVJRequest:
             self.print_debug("nobody <-- " + repr(args))
 
     def sendCommand(self, command, args=None):
+        if self.batch is not None:
+            if args is None:
+                args = {}
+            args['command'] = command
+            self.batch.append(args)
+        else:
+            self.sendResponse('command', command, args)
+
+    def beginBatch(self):
+        # commands are collected until endBatch() sends them all at once
+        self.batch = []
+
+    def endBatch(self, atomic=False, stopOnFailure=True):
+        if type(atomic) != bool:
+            raise TypeError
+        if type(stopOnFailure) != bool:
+            raise TypeError
+        commands = self.batch
+        self.batch = None
+        if len(commands) == 0:
+            return None
+        return self.sendPipelined('batch', {'commands': commands, 'atomic': atomic,
+                                            'stop-on-failure': stopOnFailure})
+
+    def sendPipelined(self, command, args=None):
+        # sends without waiting, the returned id picks the reply out of
+        # collect() in whatever order replies arrive
+        if command in self.MULTI_MESSAGE:
+            raise ValueError(command + " can't be pipelined.")
+        if args is None:
+            args = {}
+        reqID = self.nextID
+        self.nextID += 1
+        args['id'] = reqID
+        self.inFlight.add(reqID)
         self.sendResponse('command', command, args)
+        return reqID
+
+    def collect(self, ids=None):
+        # waits for replies to the ids given or everything in flight and
+        # returns them by id.  Anything else arriving is handled along the way
+        # like waitForResponse() does.
+        if ids is None:
+            ids = list(self.inFlight - self.keepalives)
+        replies = {}
+        for reqID in ids:
+            if reqID in self.replies:
+                replies[reqID] = self.replies.pop(reqID)
+            elif reqID not in self.inFlight:
+                raise ValueError("No command in flight with id " + str(reqID) + ".")
+        while len(replies) < len(ids):
+            obj = self.receive()
+            if obj is None:
+                if time.monotonic() - self.lastAct > self.TIMEOUT_PERIOD:
+                    self.disconnect()
+                    raise ConnectionError("Timed out waiting for replies.")
+                self.waitForSocket(self.TIMEOUT_PERIOD)
+                continue
+            if 'id' not in obj or obj['id'] not in self.inFlight or obj['id'] in self.keepalives:
+                self.handleUnsolicited(obj)
+                continue
+            self.inFlight.remove(obj['id'])
+            if obj['id'] in ids:
+                replies[obj['id']] = obj
+            else:
+                self.replies[obj['id']] = obj
+        return replies
+
+    def keepalive(self):
+        if time.monotonic() - self.lastSend >= self.KEEPALIVE_PERIOD:
+            self.keepalives.add(self.sendPipelined('get-version'))
+
+    def poll(self):
+        # handles whatever has arrived without waiting
+        obj = self.receive()
+        while obj is not None:
+            self.handleUnsolicited(obj)
+            obj = self.receive()
+
+    def handleUnsolicited(self, obj):
+        if 'id' in obj and obj['id'] in self.keepalives:
+            self.keepalives.remove(obj['id'])
+            self.inFlight.discard(obj['id'])
+        else:
+            self.handleResponse(obj)
+
+    def receive(self):
+        if self.socket is None:
+            raise ConnectionError("Socket isn't open.")
+        try:
+            self.socket.flush()
+            obj = self.socket.getJSONAsObj()
+        except ConnectionError as e:
+            self.disconnect()
+            raise e
+        if obj is not None:
+            self.lastAct = time.monotonic()
+            self.print_debug("server --> " + repr(obj))
+        return obj
 
     def versionCheck(self):
         self.sendCommand('get-version')
@@ -179,15 +327,15 @@ class MPVVJRequest:
         self.sendCommand('add-items', {'items': nameList})
 
     def deleteItems(self, items):
-        itemList = MPVVJUtils.parseRanges(items)
+        itemList = MPVVJUtils.parseRangeSpecs(items)
         self.sendCommand('delete-items', {'items': itemList})
 
     def setPlayed(self, items):
-        itemList = MPVVJUtils.parseRanges(items)
+        itemList = MPVVJUtils.parseRangeSpecs(items)
         self.sendCommand('set-played', {'items': itemList, 'value': True})
 
     def setNotPlayed(self, items):
-        itemList = MPVVJUtils.parseRanges(items)
+        itemList = MPVVJUtils.parseRangeSpecs(items)
         self.sendCommand('set-played', {'items': itemList, 'value': False})
 
     def track(self, track):
@@ -196,6 +344,9 @@ class MPVVJRequest:
     def trackNum(self, track):
         self.sendCommand('track-absolute', {'item': track})
 
+    def trackName(self, name):
+        self.sendCommand('track-by-name', {'name': name})
+
     def loopFile(self):
         self.sendCommand('loop-file')
 
@@ -253,7 +404,7 @@ class MPVVJRequest:
             except ValueError:
                 raise ValueError("'pos' must be an integer.")
 
-        moveList = MPVVJUtils.parseRanges(args)
+        moveList = MPVVJUtils.parseRangeSpecs(args)
         self.sendCommand('move-items', {'items': moveList, 'playlist': playlist, 'location': dest})
 
     def format(self, format):
@@ -288,8 +439,23 @@ class MPVVJRequest:
 
         self.sendCommand('get-properties', {'properties': formatVars})
 
-    def list(self):
-        self.sendCommand('list')
+    def list(self, entries=None, aroundCue=None, ifVersion=None):
+        args = {}
+        if entries != None:
+            specs = MPVVJUtils.parseRangeSpecs(entries)
+            if len(specs) != 1:
+                raise ValueError("Only one range can be listed.")
+            if type(specs[0]) == list:
+                args['offset'] = specs[0][0]
+                args['limit'] = specs[0][1] - specs[0][0] + 1
+            else:
+                args['offset'] = specs[0]
+                args['limit'] = 1
+        if aroundCue != None:
+            args['around-cue'] = aroundCue
+        if ifVersion != None:
+            args['if-version'] = ifVersion
+        self.sendCommand('list', args)
 
     def clear(self):
         self.sendCommand('clear')
@@ -297,6 +463,9 @@ class MPVVJRequest:
     def killServer(self):
         self.sendCommand('kill')
 
+    def stats(self):
+        self.sendCommand('get-stats')
+
     def TVIntervals(self, intervals):
         self.sendCommand('tv-intervals', {'intervals': intervals})
 
@@ -306,6 +475,9 @@ class MPVVJRequest:
     def TVMode(self):
         self.sendCommand('tv-mode')
 
+    def crossfade(self, seconds):
+        self.sendCommand('crossfade', {'seconds': seconds})
+
     def status(self):
         self.format("""\
 %artist% - %title%
@@ -313,174 +485,181 @@ class MPVVJRequest:
 speed: %speed%x volume: %volume%%% muted: %muted% repeat: %repeat% single: %single%""")
 
     def checkForResponse(self):
-        if self.socket is not None:
-            obj = None
-            try:
-                obj = self.socket.getJSONAsObj()
-            except ConnectionRefusedError as e:
-                self.disconnect()
-                raise e
-            except ConnectionError as e:
-                self.disconnect()
-                raise e
-
-            if obj != None:
-                self.lastAct = time.monotonic()
-                self.print_debug("server --> " + repr(obj))
-                if 'event' in obj:
-                    if obj['event'] == 'list':
-                        playlists = []
-                        playlist = None
-                        currentPlaylist = None
-                        playingPlaylist = None
-                        selectedPlaylist = None
-                        interPlaylist = None
-                        cued = None
-                        playing = None
-                        try:
-                            playlists = obj['playlists']
-                        except KeyError:
-                            pass
-                        try:
-                            playlist = obj['playlist']
-                        except KeyError:
-                            pass
-                        try:
-                            currentPlaylist = obj['current-playlist']
-                        except KeyError:
-                            pass
-                        try:
-                            playingPlaylist = obj['playing-playlist']
-                        except KeyError:
-                            pass
-                        try:
-                            selectedPlaylist = obj['selected-playlist']
-                        except KeyError:
-                            pass
-                        try:
-                            interPlaylist = obj['inter-playlist']
-                        except KeyError:
-                            pass
-                        try:
-                            cued = obj['cued']
-                        except KeyError:
-                            pass
+        obj = self.receive()
+        if obj != None:
+            return self.handleResponse(obj)
+
+    def handleResponse(self, obj):
+        if 'event' in obj:
+            if obj['event'] == 'batch':
+                if 'results' in obj:
+                    response = True
+                    for result in obj['results']:
+                        for message in result:
+                            if not self.handleResponse(message):
+                                response = False
+                    if 'rolled-back' in obj and obj['rolled-back']:
+                        self.print("Batch failed, changes rolled back.")
+                    return response
+                else:
+                    raise KeyError("'batch' without 'results'")
+            elif obj['event'] == 'list':
+                if obj.get('not-modified'):
+                    self.print("Not modified since version " + str(obj['version']) + ".")
+                    return True
+                playlists = []
+                playlist = None
+                currentPlaylist = None
+                playingPlaylist = None
+                selectedPlaylist = None
+                interPlaylist = None
+                cued = None
+                playing = None
+                playlistsOffset = 0
+                playlistOffset = 0
+                playlistTotal = None
+                try:
+                    playlists = obj['playlists']
+                except KeyError:
+                    pass
+                try:
+                    playlist = obj['playlist']
+                except KeyError:
+                    pass
+                try:
+                    currentPlaylist = obj['current-playlist']
+                except KeyError:
+                    pass
+                try:
+                    playingPlaylist = obj['playing-playlist']
+                except KeyError:
+                    pass
+                try:
+                    selectedPlaylist = obj['selected-playlist']
+                except KeyError:
+                    pass
+                try:
+                    interPlaylist = obj['inter-playlist']
+                except KeyError:
+                    pass
+                try:
+                    cued = obj['cued']
+                except KeyError:
+                    pass
+                try:
+                    playing = obj['playing']
+                except KeyError:
+                    pass
+                try:
+                    playlistsOffset = obj['playlists-offset']
+                except KeyError:
+                    pass
+                try:
+                    playlistOffset = obj['playlist-offset']
+                except KeyError:
+                    pass
+                try:
+                    playlistTotal = obj['playlist-total']
+                except KeyError:
+                    pass
+                # build it all up and print it at once, it can be long
+                lines = []
+                longest = 8
+                for i in playlists:
+                    length = 0
+                    try:
+                        length = len(i['name'])
+                    except KeyError:
+                        i['name'] = "*** No name? ***"
+                        length = len(i['name'])
+                    longest = max(length, longest)
+                lines.append("L S S C I P Playlist")
+                lines.append("- - - - - -" + "{:-<{}}".format('', longest))
+                for i in enumerate(playlists, playlistsOffset):
+                    line = ["  ", "  ", "  ", "  ", "  ", "  ", i[1]['name']]
+                    if i[1].get('loop'):
+                        line[0] = "L "
+                    if i[1].get('shuffle'):
+                        line[1] = "S "
+                    if i[0] == selectedPlaylist:
+                        line[2] = "* "
+                    if i[0] == currentPlaylist:
+                        line[3] = "* "
+                    if i[0] == interPlaylist:
+                        line[4] = "* "
+                    if i[0] == playingPlaylist:
+                        line[5] = "> "
+                    lines.append(''.join(line))
+                if playlist != None:
+                    if playlistTotal == None:
+                        playlistTotal = playlistOffset + len(playlist)
+                    digits = MPVVJUtils.numDigits(playlistTotal)
+                    longest = 4
+                    for i in playlist:
+                        length = 0
                         try:
-                            playing = obj['playing']
+                            length = len(i['name'])
                         except KeyError:
-                            pass
-                        longest = 8
-                        for i in playlists:
-                            length = 0
-                            try:
-                                length = len(i['name'])
-                            except KeyError:
-                                i['name'] = "*** No name? ***"
-                                length = len(i['name'])
-                            longest = max(length, longest)
-                        self.print("L S S C I P Playlist")
-                        self.print("- - - - - -" + "{:-<{}}".format('', longest))
-                        for i in enumerate(playlists):
-                            try:
-                                if i[1]['loop']:
-                                    self.print("L ", end='')
-                                else:
-                                    self.print("  ", end='')
-                            except KeyError:
-                                self.print("  ", end='')
-                            try:
-                                if i[1]['shuffle']:
-                                    self.print("S ", end='')
-                                else:
-                                    self.print("  ", end='')
-                            except KeyError:
-                                self.print("  ", end='')
-                            if i[0] == selectedPlaylist:
-                                self.print("* ", end='')
-                            else:
-                                self.print("  ", end='')
-                            if i[0] == currentPlaylist:
-                                self.print("* ", end='')
-                            else:
-                                self.print("  ", end='')
-                            if i[0] == interPlaylist:
-                                self.print("* ", end='')
-                            else:
-                                self.print("  ", end='')
-                            if i[0] == playingPlaylist:
-                                self.print("> ", end='')
-                            else:
-                                self.print("  ", end='')
-                            self.print(i[1]['name'])
-                        if playlist != None:
-                            digits = MPVVJUtils.numDigits(len(playlist))
-                            longest = 4
-                            for i in playlist:
-                                length = 0
-                                try:
-                                    length = len(i['name'])
-                                except KeyError:
-                                    i['name'] = "*** No name? ***"
-                                    length = len(i['name'])
-                                longest = max(length, longest)
-                            self.print()
-                            self.print("P C P " + "{:>{}}".format('#', digits) + " Name")
-                            self.print("- - - " + "{:-<{}} {:-<{}}".format('', digits, '', longest))
-                            for i in enumerate(playlist):
-                                try:
-                                    if i[1]['played']:
-                                        self.print("* ", end='')
-                                    else:
-                                        self.print("  ", end='')
-                                except KeyError:
-                                    self.print("  ", end='')
-                                if i[0] == cued:
-                                    self.print("* ", end='')
-                                else:
-                                    self.print("  ", end='')
-                                if i[0] == playing:
-                                    self.print("> ", end='')
-                                else:
-                                    self.print("  ", end='')
-                                self.print("{:>{}} ".format(i[0], digits), end='')
-                                try:
-                                    self.print(i[1]['name'])
-                                except KeyError:
-                                    self.print("*** No name? ***")
-                    elif obj['event'] == 'get-properties':
-                        if 'properties' in obj:
-                            if self.formatStringParts != None:
-                                while len(self.formatStringParts) > 0 and len(obj['properties']) > 0:
-                                    if len(self.formatStringParts) > 0:
-                                        self.print(self.formatStringParts[0], end='')
-                                        self.formatStringParts = self.formatStringParts[1:]
-                                    if len(obj['properties']) > 0:
-                                        self.print(str(obj['properties'][0]), end='')
-                                        obj['properties'] = obj['properties'][1:]
-                                self.print()
-                                self.formatStringParts = None
-                            else:
-                                raise ValueError("Got properties back unexpectedly")
-                        else:
-                            raise KeyError("'get-properties' without 'properties'")
-                    else:
-                        self.print(obj['event'] + " OK")
-                    return True
-                if 'error' in obj:
-                    if 'message' in obj:
-                        self.print("Error: " + obj['message'])
+                            i['name'] = "*** No name? ***"
+                            length = len(i['name'])
+                        longest = max(length, longest)
+                    lines.append("")
+                    lines.append("P C P " + "{:>{}}".format('#', digits) + " Name")
+                    lines.append("- - - " + "{:-<{}} {:-<{}}".format('', digits, '', longest))
+                    for i in enumerate(playlist, playlistOffset):
+                        line = ["  ", "  ", "  ", "{:>{}} ".format(i[0], digits), i[1]['name']]
+                        if i[1].get('played'):
+                            line[0] = "* "
+                        if i[0] == cued:
+                            line[1] = "* "
+                        if i[0] == playing:
+                            line[2] = "> "
+                        lines.append(''.join(line))
+                    if len(playlist) < playlistTotal:
+                        lines.append("(" + str(len(playlist)) + " of " + str(playlistTotal) + " items)")
+                self.print('\n'.join(lines))
+            elif obj['event'] == 'get-stats':
+                if 'data' in obj:
+                    for stat in sorted(obj['data']):
+                        self.print(stat + ": " + str(obj['data'][stat]))
+                else:
+                    raise KeyError("'get-stats' without 'data'")
+            elif obj['event'] == 'get-properties':
+                if 'properties' in obj:
+                    if self.formatStringParts != None:
+                        while len(self.formatStringParts) > 0 and len(obj['properties']) > 0:
+                            if len(self.formatStringParts) > 0:
+                                self.print(self.formatStringParts[0], end='')
+                                self.formatStringParts = self.formatStringParts[1:]
+                            if len(obj['properties']) > 0:
+                                self.print(str(obj['properties'][0]), end='')
+                                obj['properties'] = obj['properties'][1:]
+                        self.print()
+                        self.formatStringParts = None
                     else:
-                        self.print("Unspecified error.")
-                    return False
+                        raise ValueError("Got properties back unexpectedly")
                 else:
-                    raise ValueError("JSON statement with nothing to do.")
+                    raise KeyError("'get-properties' without 'properties'")
+            else:
+                self.print(obj['event'] + " OK")
+            return True
+        if 'error' in obj:
+            if 'message' in obj:
+                self.print("Error: " + obj['message'])
+            else:
+                self.print("Unspecified error.")
+            return False
         else:
-            raise ConnectionError("Socket isn't open.")
-
-    def waitForResponse(self):
-        response = None
-        while response == None:
-            response = self.checkForResponse()
-            time.sleep(1/self.TPS)
-
-        return response
+            raise ValueError("JSON statement with nothing to do.")
+
+    def waitForResponse(self, reqID=None):
+        # with reqID, anything else arriving first is handled along the way
+        while True:
+            obj = self.receive()
+            if obj is None:
+                self.waitForSocket(self.TIMEOUT_PERIOD)
+            elif reqID is None or ('id' in obj and obj['id'] == reqID):
+                self.inFlight.discard(reqID)
+                return self.handleResponse(obj)
+            else:
+                self.handleUnsolicited(obj)
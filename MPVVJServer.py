@@ -18,8 +18,12 @@
 
 import time
 import json
+import copy
 import random
 import signal
+import selectors
+import socket
+import collections
 import os
 import os.path
 import argparse
@@ -28,11 +32,11 @@ import MPVVJState
 import JSONSocket
 import MPV
 import MPVVJUtils
+import MPVVJPrefetch
 
 # TODO
 # bugs and crashes
 
-TPS = 20
 DEFAULT_MPV = "/usr/bin/mpv"
 DEFAULT_SOCKET = "/tmp/mpvsocket"
 DEFAULT_PORT = 12345
@@ -46,58 +50,252 @@ def hupHandler(signum, frame):
     except NameError:
         return
 
-    if server.socket is not None:
-        server.reconnectSocket()
-        print("Listening socket forcibly closed and reopened")
+    if len(server.getListeners()) > 0:
+        # done at the top of the next tick(), the signal wakes the selector
+        server.rebindPending = True
 
 
 class PlaylistStop(BaseException):
     pass
 
 
+class MPVVJClient():
+    def __init__(self, sock, clientID):
+        self.socket = sock
+        self.name = "client " + str(clientID)
+        self.lastAct = time.monotonic()
+
+    def isConnected(self):
+        return self.socket is not None and self.socket.connected
+
+    def send(self, obj):
+        return self.socket.sendObjAsJSON(obj)
+
+    def queued(self):
+        return self.socket.sendqueued
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class MPVVJTaggedClient():
+    # replies to a command carrying an 'id' go out through this, wherever the
+    # client ends up stored while the command waits on mpv
+    def __init__(self, client, tag):
+        self.client = client
+        self.tag = tag
+        self.name = client.name
+
+    def isConnected(self):
+        return self.client.isConnected()
+
+    def send(self, obj):
+        obj['id'] = self.tag
+        return self.client.send(obj)
+
+    def queued(self):
+        return self.client.queued()
+
+    def close(self):
+        self.client.close()
+
+
+class MPVVJBatchResult():
+    # stands in for the client while one command of a batch runs so its
+    # replies are collected instead of sent
+    def __init__(self, batch):
+        self.batch = batch
+        self.name = batch.client.name + " batch"
+        self.messages = []
+
+    def isConnected(self):
+        return True
+
+    def send(self, obj):
+        self.messages.append(obj)
+        if self.batch.waiting is self:
+            self.batch.waiting = None
+            self.batch.server.batchesReady.append(self.batch)
+        return True
+
+    def queued(self):
+        return 0
+
+    def close(self):
+        pass
+
+    def failed(self):
+        for message in self.messages:
+            if 'error' in message and message['error'] == 'failure':
+                return True
+        return False
+
+
+class MPVVJProperties():
+    # one get-properties request, answered from what mpv last sent about the
+    # properties the server observes, or once what it had to ask mpv for has
+    # come back.  Reads of the same property by other requests in flight at
+    # the same time are shared.
+    def __init__(self, server, client, needed, maxAge=None):
+        self.server = server
+        self.client = client
+        # (property, value) with the value None until mpv has answered
+        self.needed = needed
+        # values mpv sent longer ago than this many seconds are asked for again
+        self.maxAge = maxAge
+        self.outstanding = 0
+        self.done = False
+
+    def filled(self):
+        for prop in self.needed:
+            if prop[1] is None:
+                return False
+        return True
+
+    def request(self, mpv):
+        now = time.monotonic()
+        for prop in enumerate(self.needed):
+            if prop[1][1] is None:
+                propReq = self.server.MPV_PROPERTY_REQUEST[prop[1][0]]
+                # mpv keeps the server up to date on what's read from now
+                # on, on both decks so it's all there already for whichever
+                # goes on air
+                for deck in self.server.getDecks():
+                    deck.read(propReq[0], propReq[1])
+                mirrored = mpv.getMirrored(propReq[0], propReq[1])
+                if mirrored != None and (self.maxAge == None or now - mirrored[1] <= self.maxAge):
+                    self.setValue(prop[0], mirrored[0], propReq[2])
+                else:
+                    self.outstanding += 1
+                    mpv.request(propReq[0], [propReq[1]], self.setter(prop[0], propReq[2]), shared=True)
+        if self.outstanding == 0:
+            self.send()
+
+    def setValue(self, idx, data, convert):
+        if data != None and convert != None:
+            data = convert(data)
+        if data == None:
+            data = self.server.REPLACEMENT_NONE
+        self.needed[idx] = (self.needed[idx][0], data)
+
+    def setter(self, idx, convert):
+        def setProperty(reply):
+            if self.done:
+                return
+            if reply['error'] == 'terminated':
+                self.fail("MPV terminated before all properties were gathered.")
+                return
+            if reply['error'] == 'timeout':
+                self.fail("MPV didn't answer in time.")
+                return
+            data = None
+            if reply['error'] == 'success':
+                data = reply.get('data')
+            self.setValue(idx, data, convert)
+            self.outstanding -= 1
+            if self.outstanding == 0:
+                self.send()
+        return setProperty
+
+    def send(self):
+        self.done = True
+        props = []
+        for prop in self.needed:
+            props.append(prop[1])
+        self.server.sendEventResponse(self.client, 'get-properties', {'properties': props})
+
+    def fail(self, message):
+        self.done = True
+        self.server.sendFailureResponse(self.client, "get-properties: " + message)
+
+
+class MPVVJBatch():
+    def __init__(self, server, client, commands, atomic, stopOnFailure):
+        self.server = server
+        self.client = client
+        self.commands = commands
+        self.atomic = atomic
+        self.stopOnFailure = stopOnFailure or atomic
+        self.results = []
+        self.waiting = None
+        self.snapshot = None
+        if atomic:
+            self.snapshot = (copy.deepcopy(server.state), copy.deepcopy(server.mpvopts))
+
+    def resume(self):
+        # runs commands until the batch is done or one is waiting on mpv, in
+        # which case the reply arriving puts the batch back in batchesReady
+        while True:
+            if len(self.results) > 0 and self.results[-1].failed() and self.stopOnFailure:
+                break
+            if len(self.results) == len(self.commands):
+                break
+            result = MPVVJBatchResult(self)
+            self.results.append(result)
+            self.server.handleClientObj(result, self.commands[len(self.results) - 1])
+            if len(result.messages) == 0:
+                self.waiting = result
+                return
+
+        resp = {'results': []}
+        for result in self.results:
+            resp['results'].append(result.messages)
+        if self.atomic:
+            resp['rolled-back'] = False
+            if self.results[-1].failed():
+                # versions handed out during the batch mustn't come around again
+                version = self.server.state.getVersion()
+                self.server.state, self.server.mpvopts = self.snapshot
+                self.server.state.clock.now = version
+                self.server.state.touch()
+                resp['rolled-back'] = True
+        self.server.sendEventResponse(self.client, 'batch', resp)
+
+
 class MPVVJServer():
     RETRIES = 3
     TIMEOUT = 45
+    CONNECT_INTERVAL = 1
+    MESSAGE_BUDGET = 64
+    # seconds between volume changes while crossfading
+    CROSSFADE_STEP = 0.05
+    # seconds a property get-properties read stays observed after the last read
+    OBSERVE_IDLE = 10
+    # the standby deck's socket is the live one's path with this on the end
+    STANDBY_SUFFIX = '.b'
+    # most bytes warmed ahead of upcoming items at once
+    PREFETCH_BUDGET = 67108864
     VERSION = 0
 
+    # commands which can't go in a batch, those which wait on mpv, and those
+    # which act on mpv or the server straight away where rolling back the
+    # state wouldn't undo them, so neither can go in an atomic one
+    BATCH_FORBIDDEN = ('batch', 'kill')
+    BATCH_DEFERRED = ('run-mpv', 'mpv-command', 'get-properties')
+    BATCH_IRREVERSIBLE = ('play', 'stop', 'terminate-mpv', 'crossfade')
+
     REPLACEMENT_NONE = 'N/A'
 
+    # how each property is read from mpv and what turns the value in to
+    # what's sent on
     MPV_PROPERTY_REQUEST = {
-        'title':        ('get_property',        'metadata/by-key/title',        0),
-        'artist':       ('get_property',        'metadata/by-key/artist',       1),
-        'album':        ('get_property',        'metadata/by-key/album',        2),
-        'albumartist':  ('get_property',        'metadata/by-key/album_artist', 3),
-        'genre':        ('get_property',        'metadata/by-key/genre',        4),
-        'year':         ('get_property',        'metadata/by-key/date',         5),
-        'status':       ('get_property',        'pause',                        6),
-        'time':         ('get_property_string', 'time-pos',                     7),
-        'precisetime':  ('get_property_string', 'time-pos',                     8),
-        'length':       ('get_property',        'duration',                     9),
-        'percentage':   ('get_property',        'percent-pos',                  10),
-        'speed':        ('get_property_string', 'speed',                        11),
-        'volume':       ('get_property_string', 'volume',                       12),
-        'muted':        ('get_property',        'mute',                         13),
-        'frame':        ('get_property',        'estimated-frame-number',       14)
-    }
-
-    MPV_COMMAND_REQUEST_ID = 15
-
-    MPV_PROPERTY_SET = {
-        0: ('title',        None),
-        1: ('artist',       None),
-        2: ('album',        None),
-        3: ('albumartist',  None),
-        4: ('genre',        None),
-        5: ('year',         None),
-        6: ('status',       MPVVJUtils.statusStr),
-        7: ('time',         MPVVJUtils.toTime),
-        8: ('precisetime',  MPVVJUtils.toPreciseTime),
-        9: ('length',       MPVVJUtils.toTime),
-        10: ('percentage',  MPVVJUtils.roundTenth),
-        11: ('speed',       MPVVJUtils.roundTenth),
-        12: ('volume',      MPVVJUtils.roundTenth),
-        13: ('muted',       MPVVJUtils.boolYesNo),
-        14: ('frame',       None)
+        'title':        ('get_property',        'metadata/by-key/title',        None),
+        'artist':       ('get_property',        'metadata/by-key/artist',       None),
+        'album':        ('get_property',        'metadata/by-key/album',        None),
+        'albumartist':  ('get_property',        'metadata/by-key/album_artist', None),
+        'genre':        ('get_property',        'metadata/by-key/genre',        None),
+        'year':         ('get_property',        'metadata/by-key/date',         None),
+        'status':       ('get_property',        'pause',                        MPVVJUtils.statusStr),
+        'time':         ('get_property_string', 'time-pos',                     MPVVJUtils.toTime),
+        'precisetime':  ('get_property_string', 'time-pos',                     MPVVJUtils.toPreciseTime),
+        'length':       ('get_property',        'duration',                     MPVVJUtils.toTime),
+        'percentage':   ('get_property',        'percent-pos',                  MPVVJUtils.roundTenth),
+        'speed':        ('get_property_string', 'speed',                        MPVVJUtils.roundTenth),
+        'volume':       ('get_property_string', 'volume',                       MPVVJUtils.roundTenth),
+        'muted':        ('get_property',        'mute',                         MPVVJUtils.boolYesNo),
+        'frame':        ('get_property',        'estimated-frame-number',       None)
     }
 
     def print(self, text):
@@ -108,52 +306,271 @@ class MPVVJServer():
         if not self.quiet and self.verbose:
             print(text)
 
-    def __init__(self, mpvPath, socketPath, bindAddress, port, quiet, verbose):
+    def __init__(self, mpvPath, socketPath, bindAddress, port, quiet, verbose,
+                 budget=MESSAGE_BUDGET, controlPath=None, tcp=True,
+                 dualDeck=False, crossfade=0,
+                 prefetch=0, prefetchBudget=PREFETCH_BUDGET):
+        if type(budget) != int:
+            raise TypeError
+        if budget < 1:
+            raise ValueError("budget must be at least 1.")
+        if type(dualDeck) != bool:
+            raise TypeError
+        if type(crossfade) != int and type(crossfade) != float:
+            raise TypeError
+        if crossfade < 0:
+            raise ValueError("crossfade must be at least 0.")
+        if type(prefetch) != int or type(prefetchBudget) != int:
+            raise TypeError
+        if prefetch < 0:
+            raise ValueError("prefetch can't be negative.")
+        if controlPath is not None and type(controlPath) != str:
+            raise TypeError
+        if type(tcp) != bool:
+            raise TypeError
+        if controlPath is None and not tcp:
+            raise ValueError("Nothing to listen on.")
         self.mpvPath = mpvPath
         self.socketPath = socketPath
         self.bindAddress = bindAddress
         self.port = port
+        self.controlPath = controlPath
+        self.tcp = tcp
         self.quiet = quiet
         self.verbose = verbose
+        self.budget = budget
+        self.stats = {'client-messages': 0, 'client-backlog': 0, 'client-backlog-max': 0,
+                      'client-backpressure': 0, 'client-send-queued': 0,
+                      'mpv-messages': 0, 'mpv-backlog': 0, 'mpv-backlog-max': 0}
         self.mpvopts = []
         self.state = MPVVJState.MPVVJState()
         self.socket = None
-        self.reconnectSocket()
+        self.controlSocket = None
+        self.clients = []
+        self.nextClientID = 0
         self.mpv = None
         self.connected = False
         self.playing = False
         self.path = os.getcwd()
-        signal.signal(signal.SIGHUP, hupHandler)
+        # how many items ahead in each playlist which might play next have
+        # their start read in to the page cache, and the state's version
+        # when that was last looked at
+        self.prefetch = prefetch
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = MPVVJPrefetch.MPVVJPrefetcher(self.path, prefetchBudget)
+        self.prefetchVersion = None
+        # the item put in mpv's playlist after the playing one so mpv goes
+        # straight on to it, mpv's ID for it once loadfile has answered, and
+        # the state's version when it was queued, None while not playing.
+        # starting counts files loaded in place of what was playing which
+        # mpv hasn't started yet.
+        self.queued = None
+        self.queuedEntry = None
+        self.queuedRequest = None
+        self.queuedVersion = None
+        self.starting = 0
+        # in dual deck mode mpv is the deck on air and standby is the other,
+        # which has the item cued next loaded and paused once it's known when
+        # what's on air ends.  See resetDecks() for the rest.
+        self.dualDeck = dualDeck
+        self.crossfade = crossfade
+        self.standby = None
+        self.resetDecks()
 
-        self.lastAct = None
         self.lastConnectionAttempt = 0
-        
-        self.neededProperties = None
-        self.waitForCommand = False
+        self.mpvClient = None
+
+        # get-properties requests waiting on a connection to mpv
+        self.propertiesWaiting = collections.deque()
+        # batches whose command waiting on mpv has been answered
+        self.batchesReady = collections.deque()
+
+        self.startTransport()
+
+    def startTransport(self):
+        self.selector = selectors.DefaultSelector()
+        self.selectorEvents = {}
+        self.rebindPending = False
+        self.reconnectSocket()
+        signal.signal(signal.SIGHUP, hupHandler)
+
+        # signals interrupt the selector through this pair, so a SIGHUP which
+        # replaces the listening socket is picked up right away
+        self.wakeRead, self.wakeWrite = socket.socketpair()
+        self.wakeRead.setblocking(False)
+        self.wakeWrite.setblocking(False)
+        signal.set_wakeup_fd(self.wakeWrite.fileno())
+        self.selector.register(self.wakeRead, selectors.EVENT_READ)
 
     def disconnectSocket(self):
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        self.closeListeners()
+
+    def closeListeners(self):
         if self.socket is not None:
             self.socket.close()
+            self.socket = None
+        if self.controlSocket is not None:
+            self.controlSocket.close()
+            self.controlSocket = None
 
     def reconnectSocket(self):
-        self.disconnectSocket()
-        self.print("Binding to " + self.bindAddress + " (" + str(self.port) + ").")
-        self.socket = JSONSocket.JSONTCPSocket(listening=True, host=self.bindAddress,
-                                               port=self.port)
-        self.lastAct = None
+        # clients already connected stay connected
+        self.closeListeners()
+        if self.tcp:
+            self.print("Binding to " + self.bindAddress + " (" + str(self.port) + ").")
+            self.socket = JSONSocket.JSONTCPSocket(listening=True, host=self.bindAddress,
+                                                   port=self.port)
+        if self.controlPath is not None:
+            self.print("Binding to " + self.controlPath + ".")
+            self.controlSocket = JSONSocket.JSONUnixSocket(listening=True, path=self.controlPath)
+
+    def getListeners(self):
+        listeners = []
+        if self.socket is not None:
+            listeners.append(self.socket)
+        if self.controlSocket is not None:
+            listeners.append(self.controlSocket)
+        return listeners
+
+    def acceptClients(self):
+        for listener in self.getListeners():
+            while True:
+                sock = listener.acceptConnection()
+                if sock is None:
+                    break
+                client = MPVVJClient(sock, self.nextClientID)
+                self.nextClientID += 1
+                self.clients.append(client)
+                self.print_debug(client.name + " connected from " + repr(sock.IP))
+
+    def dropClient(self, client, reason):
+        self.print(client.name + ": " + reason)
+        client.close()
+        self.clients.remove(client)
 
     def terminateMpv(self):
         if self.mpv is not None:
-            self.mpv.terminate()
+            for mpv in self.getDecks():
+                mpv.terminate()
             self.mpv = None
+            self.standby = None
             self.connected = False
             self.playing = False
+            self.dropQueued()
+            self.resetDecks()
+            self.starting = 0
 
     def cleanUp(self):
         self.terminateMpv()
+        self.stopPrefetch()
         self.disconnectSocket()
+        signal.set_wakeup_fd(-1)
+        self.selector.close()
+        self.wakeRead.close()
+        self.wakeWrite.close()
+
+    def updateSelector(self):
+        wanted = {}
+        sockets = self.getListeners()
+        for client in self.clients:
+            sockets.append(client.socket)
+        for mpv in self.getDecks():
+            sockets.append(mpv.socket)
+        for sock in sockets:
+            if sock is None:
+                continue
+            fileobj, events = sock.getSelectable()
+            if fileobj is not None:
+                wanted[fileobj] = events
+
+        # unregister stale sockets first, a replacement may reuse the same fd
+        for fileobj in list(self.selectorEvents):
+            if fileobj not in wanted:
+                self.selector.unregister(fileobj)
+                del self.selectorEvents[fileobj]
+        for fileobj, events in wanted.items():
+            if fileobj not in self.selectorEvents:
+                self.selector.register(fileobj, events)
+            elif self.selectorEvents[fileobj] != events:
+                self.selector.modify(fileobj, events)
+            self.selectorEvents[fileobj] = events
+
+    def getTimeout(self):
+        # work which tick() will do without any socket becoming ready
+        for client in self.clients:
+            if client.socket.hasLine() and not client.socket.backlogged():
+                return 0
+        if len(self.propertiesWaiting) > 0:
+            if self.mpv is None or self.decksConnected():
+                return 0
+        if self.mpvClient is not None and self.mpv is None:
+            return 0
+        if self.queuedVersion is not None and self.queuedVersion != self.state.getVersion():
+            return 0
+        if self.standbyVersion is not None and self.standbyVersion != self.state.getVersion():
+            return 0
+        if self.prefetcher is not None and self.prefetchVersion != self.state.getVersion():
+            return 0
+        if len(self.batchesReady) > 0:
+            return 0
+
+        now = time.monotonic()
+        timeout = None
+        decks = self.getDecks()
+        for mpv in decks:
+            if mpv.socket is None:
+                timeout = max(0, self.lastConnectionAttempt + self.CONNECT_INTERVAL - now)
+            elif mpv.socket.hasLine():
+                return 0
+        if len(decks) > 0 and timeout is None:
+            if not self.connected:
+                return 0
+            # wake to time out requests mpv never answered and to switch decks
+            deadline = self.nextWake()
+            if deadline is not None:
+                timeout = max(0, deadline - now)
+        for client in self.clients:
+            deadline = max(0, client.lastAct + MPVVJServer.TIMEOUT - now)
+            if timeout is None or deadline < timeout:
+                timeout = deadline
+        return timeout
+
+    def flushSockets(self):
+        for client in list(self.clients):
+            try:
+                client.socket.flush()
+            except ConnectionError as e:
+                self.dropClient(client, "Connection error: " + e.args[0])
+        for mpv in self.getDecks():
+            if mpv.socket is None:
+                continue
+            try:
+                mpv.socket.flush()
+            except ConnectionError as e:
+                self.print("MPV connection error: " + e.args[0])
+                self.clientMpvUnexpectedTerminated()
+                break
+
+    def wait(self):
+        self.flushSockets()
+        self.updateSelector()
+        timeout = self.getTimeout()
+        if timeout == 0:
+            return
 
-    def sendResponse(self, responseType, value, args=None):
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.wakeRead:
+                try:
+                    while self.wakeRead.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+    def sendResponse(self, client, responseType, value, args=None):
         if args is None:
             args = {responseType: value}
         else:
@@ -161,35 +578,40 @@ class MPVVJServer():
                 raise TypeError
             args.update({responseType: value})
 
-        if self.socket is not None and self.socket.connected:
-            self.print_debug("client <-- " + repr(args))
-            try:
-                self.socket.sendObjAsJSON(args)
-            except BrokenPipeError:
-                self.reconnectSocket()
-                self.print("Broken pipe, connection dropped.")
+        if client is not None and client.isConnected():
+            self.print_debug(client.name + " <-- " + repr(args))
+            if not client.send(args):
+                self.stats['client-backpressure'] += 1
+                self.print_debug(client.name + " is backlogged")
         else:
             self.print_debug("nobody <-- " + repr(args))
 
-    def sendStatusResponse(self, status, args=None):
-        self.sendResponse('error', status, args)
+    def sendStatusResponse(self, client, status, args=None):
+        self.sendResponse(client, 'error', status, args)
 
-    def sendEventResponse(self, event, args=None):
-        self.sendResponse('event', event, args)
+    def sendEventResponse(self, client, event, args=None):
+        self.sendResponse(client, 'event', event, args)
+
+    def broadcastEventResponse(self, event, args=None):
+        for client in self.clients:
+            if args is None:
+                self.sendEventResponse(client, event)
+            else:
+                self.sendEventResponse(client, event, dict(args))
 
-    def sendSuccessResponse(self, data=None):
+    def sendSuccessResponse(self, client, data=None):
         if data is None:
-            self.sendStatusResponse('success')
+            self.sendStatusResponse(client, 'success')
         else:
-            self.sendStatusResponse('success', {'data': data})
+            self.sendStatusResponse(client, 'success', {'data': data})
 
-    def sendFailureResponse(self, message=None):
+    def sendFailureResponse(self, client, message=None):
         if message is None:
-            self.sendStatusResponse('failure')
+            self.sendStatusResponse(client, 'failure')
         else:
             if type(message) != str:
                 raise TypeError
-            self.sendStatusResponse('failure', {'message': message})
+            self.sendStatusResponse(client, 'failure', {'message': message})
 
     def playCurrentAndAdvance(self):
         # since hopefully there's no other way for mpv to emit a 'start-file' event
@@ -198,484 +620,1016 @@ class MPVVJServer():
         current = self.state.getCurrentCuedName()
         if current is None:
             raise PlaylistStop
+        self.prefetchUsed(current)
+        if self.standby is not None:
+            self.stopDecks()
+            self.mpv.play(current)
+            self.state.setCurrentPlaying()
+            # advanced once it's known when this goes off air
+            self.advancePending = True
+            return
         self.mpv.play(current)
+        self.starting += 1
         self.state.setCurrentPlaying()
         self.state.advance()
+        self.queueNext()
+
+    def playNext(self):
+        try:
+            self.playCurrentAndAdvance()
+        except PlaylistStop:
+            self.stop()
+        except ValueError as e:
+            self.stop()
+            self.print("State error: " + e.args[0])
+
+    def queueNext(self):
+        try:
+            cued = self.state.getCurrentCuedName()
+        except ValueError:
+            cued = None
+        self.queued = cued
+        self.queuedEntry = None
+        self.queuedRequest = None
+        self.queuedVersion = self.state.getVersion()
+        if cued is None:
+            return
+
+        def appended(reply):
+            if reply['request_id'] != self.queuedRequest:
+                return
+            self.queuedRequest = None
+            if reply['error'] == 'success' and type(reply.get('data')) == dict:
+                self.queuedEntry = reply['data'].get('playlist_entry_id')
+        self.queuedRequest = self.mpv.append(cued, appended)
+
+    def dropQueued(self):
+        if self.queued is not None and self.mpv is not None and self.mpv.socket is not None:
+            self.mpv.clearQueue()
+        self.queued = None
+        self.queuedEntry = None
+        self.queuedRequest = None
+        self.queuedVersion = None
+
+    def syncQueued(self):
+        # edits, re-cues and anything else which changes what's cued next
+        # change what's queued in mpv to match
+        if self.queuedVersion is None or self.queuedVersion == self.state.getVersion():
+            return
+        try:
+            cued = self.state.getCurrentCuedName()
+        except ValueError:
+            cued = None
+        if cued == self.queued:
+            self.queuedVersion = self.state.getVersion()
+            return
+        self.dropQueued()
+        self.queueNext()
+
+    def startedQueued(self, obj):
+        # mpv answers loadfile before it can start what it loaded, so
+        # anything starting before that is something else
+        if self.queued is None or self.queuedRequest is not None:
+            return False
+        if self.queuedEntry is not None and 'playlist_entry_id' in obj:
+            return obj['playlist_entry_id'] == self.queuedEntry
+        # older mpv doesn't say which entry started, but once what was
+        # loaded has started the next start is the queued one
+        return self.starting == 0
+
+    def getDecks(self):
+        decks = []
+        if self.mpv is not None:
+            decks.append(self.mpv)
+        if self.standby is not None:
+            decks.append(self.standby)
+        return decks
+
+    def decksConnected(self):
+        decks = self.getDecks()
+        for mpv in decks:
+            if mpv.socket is None:
+                return False
+        return len(decks) > 0
 
-    def requestReplacementVar(self, var):
-        propReq = self.MPV_PROPERTY_REQUEST[var]
-        self.mpv.sendCommand(propReq[0], [propReq[1]], request_id=propReq[2])
-
-    def setReplacementVar(self, reqID, data):
-        if self.neededProperties == None:
-            raise RuntimeError("Got data from MPV but no properties needed.")
-        prop = self.MPV_PROPERTY_SET[reqID]
-        for neededProp in enumerate(self.neededProperties):
-            if prop[0] == neededProp[1][0]:
-                if prop[1] != None:
-                    data = prop[1](data)
-                if data == None:
-                    self.neededProperties[neededProp[0]] = (prop[0], self.REPLACEMENT_NONE)
+    def resetDecks(self):
+        # what's loaded on the standby deck, the state's version when it was,
+        # mpv's ID for it once loadfile has answered, and whether it started
+        # and is showing its first frame
+        self.standbyItem = None
+        self.standbyVersion = None
+        self.standbyEntry = None
+        self.standbyRequest = None
+        self.standbyStarted = False
+        self.standbyReady = False
+        # when the item on air ends by the clock, once the live deck has said
+        # how long is left, and whether it's already on its last frame
+        self.liveEndsAt = None
+        self.liveRequest = None
+        self.liveEnded = False
+        # the state isn't advanced past what's on air until liveEndsAt is
+        # known, so TV mode goes by when the next item will be on air
+        self.advancePending = False
+        # crossfade in progress as [start, length, outgoing deck, next step]
+        self.fade = None
+
+    def stopDecks(self):
+        # the live deck is left to the caller
+        if self.standby is not None and self.standby.socket is not None:
+            self.standby.stop()
+        self.resetDecks()
+
+    def nextWake(self):
+        # the soonest an mpv request times out, a property goes unobserved or
+        # the decks need attention
+        wake = None
+        for mpv in self.getDecks():
+            for deadline in (mpv.nextDeadline(), mpv.nextUnobserve(self.OBSERVE_IDLE)):
+                if deadline is not None and (wake is None or deadline < wake):
+                    wake = deadline
+        deadline = None
+        if self.standby is None or not self.playing:
+            pass
+        elif self.fade is not None:
+            deadline = self.fade[3]
+        elif self.advancePending:
+            if self.liveEnded or self.liveEndsAt is not None:
+                # now
+                deadline = 0
+        elif self.liveEnded and (self.standbyReady or self.standbyItem is None):
+            deadline = 0
+        elif self.standbyReady and self.liveEndsAt is not None:
+            deadline = self.liveEndsAt - self.crossfade
+        if deadline is not None and (wake is None or deadline < wake):
+            wake = deadline
+        return wake
+
+    def scheduleSwitch(self):
+        # asks the live deck how long it has left, which is also redone
+        # whenever it seeks or is paused and played again
+        live = self.mpv
+        self.liveEndsAt = None
+
+        def remaining(reply):
+            if live is not self.mpv or reply['request_id'] != self.liveRequest:
+                return
+            self.liveRequest = None
+            if reply['error'] == 'success' and type(reply.get('data')) in (int, float):
+                self.liveEndsAt = time.monotonic() + reply['data']
+        self.liveRequest = live.request('get_property', ['playtime-remaining'], remaining)
+
+    def preloadNext(self):
+        try:
+            cued = self.state.getCurrentCuedName()
+        except ValueError:
+            cued = None
+        standby = self.standby
+        self.standbyItem = cued
+        self.standbyVersion = self.state.getVersion()
+        self.standbyEntry = None
+        self.standbyRequest = None
+        self.standbyStarted = False
+        self.standbyReady = False
+        if cued is None:
+            standby.stop()
+            return
+
+        def loaded(reply):
+            if standby is not self.standby or reply['request_id'] != self.standbyRequest:
+                return
+            self.standbyRequest = None
+            if reply['error'] == 'success' and type(reply.get('data')) == dict:
+                self.standbyEntry = reply['data'].get('playlist_entry_id')
+        self.prefetchUsed(cued)
+        self.standbyRequest = standby.preload(cued, loaded)
+
+    def switchDecks(self, now):
+        incoming = self.standby
+        outgoing = self.mpv
+        self.resetDecks()
+        if self.crossfade > 0:
+            incoming.goLive(0)
+            self.fade = [now, self.crossfade, outgoing, now]
+        else:
+            incoming.goLive(100)
+            outgoing.stop()
+        outgoing.lower()
+        self.mpv = incoming
+        self.standby = outgoing
+        self.advancePending = True
+        self.state.setCurrentPlaying()
+        self.scheduleSwitch()
+
+    def updateFade(self, now):
+        start, length, outgoing, step = self.fade
+        if now < step:
+            return
+        done = min(1, (now - start) / length)
+        self.mpv.setVolume(round(done * 100))
+        outgoing.setVolume(round((1 - done) * 100))
+        if done < 1:
+            self.fade[3] = now + self.CROSSFADE_STEP
+        else:
+            outgoing.stop()
+            self.fade = None
+
+    def updateDecks(self):
+        # runs dual deck mode along with everything else done after a message
+        if self.standby is None or not self.playing:
+            return
+        now = time.monotonic()
+        if self.fade is not None:
+            self.updateFade(now)
+            if self.fade is not None:
+                # the standby deck is still fading out
+                return
+        try:
+            if self.advancePending:
+                if self.liveEndsAt is None and not self.liveEnded:
+                    return
+                airTime = None
+                if self.liveEndsAt is not None:
+                    airTime = max(now, self.liveEndsAt - self.crossfade)
+                self.advancePending = False
+                self.state.advance(airTime)
+                self.preloadNext()
+            elif self.standbyVersion != self.state.getVersion():
+                # edits, re-cues and anything else which changes what's cued
+                # next change what's waiting on the standby deck to match
+                try:
+                    cued = self.state.getCurrentCuedName()
+                except ValueError:
+                    cued = None
+                if cued == self.standbyItem:
+                    self.standbyVersion = self.state.getVersion()
                 else:
-                    self.neededProperties[neededProp[0]] = (prop[0], data)
+                    self.preloadNext()
 
-    def sendPlaylists(self):
-        self.sendEventResponse('new-playlists', {'playlists': self.state.getPlaylists()})
+            if self.standbyItem is None:
+                if self.liveEnded:
+                    self.stop()
+            elif self.standbyReady:
+                if self.liveEnded or (self.liveEndsAt is not None and
+                                      now >= self.liveEndsAt - self.crossfade):
+                    self.switchDecks(now)
+        except ValueError as e:
+            self.print("State error: " + e.args[0])
+            self.stopAfterError()
 
-    def sendPlaylist(self, pl):
-        self.sendEventResponse('add-entries', {'playlist': pl.name, 'entries': pl.getEntries()})
-        self.sendEventResponse('cue-item', {'playlist': pl.name, 'item': pl.currentCue})
+    def stopAfterError(self):
+        try:
+            self.stop()
+        except ValueError:
+            pass
 
-    def sendMpvOpts(self):
-        self.sendEventResponse('set-mpv-opts', {'opts': self.state.mpvopts})
+    def handleDeckEvent(self, obj, mpv):
+        if not self.playing:
+            return
+        event = obj['event']
+        if mpv is self.mpv:
+            if event == 'playback-restart':
+                # started or seeked
+                self.scheduleSwitch()
+            elif event == 'property-change' and obj.get('name') == 'pause':
+                if obj.get('data') == True:
+                    # nothing ends while paused
+                    self.liveEndsAt = None
+                    self.liveRequest = None
+                else:
+                    self.scheduleSwitch()
+            elif event == 'property-change' and obj.get('name') == 'eof-reached':
+                if obj.get('data') == True:
+                    self.liveEnded = True
+            elif event == 'end-file' and obj.get('reason') == 'error':
+                self.liveEnded = True
+        elif mpv is self.standby and self.standbyItem is not None:
+            if event == 'start-file':
+                # mpv answers loadfile before it can start what it loaded, so
+                # anything starting before that is something else
+                if self.standbyRequest is None:
+                    if self.standbyEntry is None or 'playlist_entry_id' not in obj or \
+                       obj['playlist_entry_id'] == self.standbyEntry:
+                        self.standbyStarted = True
+            elif event == 'playback-restart':
+                if self.standbyStarted:
+                    self.standbyReady = True
+            elif event == 'end-file' and obj.get('reason') == 'error' and self.standbyStarted:
+                self.print("Couldn't load " + self.standbyItem + ", skipping it.")
+                try:
+                    self.state.advance()
+                    self.preloadNext()
+                except ValueError as e:
+                    self.print("State error: " + e.args[0])
+                    self.stopAfterError()
 
-    def sendProperties(self):
-        props = []
-        for prop in self.neededProperties:
-            props.append(prop[1])
-        self.sendEventResponse('get-properties', {'properties': props})
+    def updatePrefetch(self):
+        # a new plan is only made when what's coming up changed
+        if self.prefetcher is None or self.prefetchVersion == self.state.getVersion():
+            return
+        self.prefetchVersion = self.state.getVersion()
+        if self.standby is None:
+            self.prefetcher.plan(self.state.getUpcoming(self.prefetch))
+            return
+        # a deck loads what's cued as soon as it's cued, so the plan goes one
+        # further for the next to be warmed before then
+        names = self.state.getUpcoming(self.prefetch + 1)
+        try:
+            cued = self.state.getCurrentCuedName()
+        except ValueError:
+            cued = None
+        if cued in names:
+            names.remove(cued)
+        self.prefetcher.plan(names)
+
+    def prefetchUsed(self, name):
+        if self.prefetcher is not None:
+            self.prefetcher.used(name)
+
+    def stopPrefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+            self.prefetcher = None
+
+    def sendPlaylists(self, client):
+        self.sendEventResponse(client, 'new-playlists', {'playlists': JSONSocket.JSONFragment(self.state.getPlaylistsJSON()), 'version': self.state.getVersion()})
+
+    def sendPlaylist(self, client, pl):
+        self.sendEventResponse(client, 'add-entries', {'playlist': pl.name, 'entries': JSONSocket.JSONFragment(pl.getItemsJSON())})
+        self.sendEventResponse(client, 'cue-item', {'playlist': pl.name, 'item': pl.currentCue})
+
+    def sendMpvOpts(self, client):
+        self.sendEventResponse(client, 'set-mpv-opts', {'opts': self.mpvopts})
+
+    def checkIfVersion(self, client, command, obj):
+        # clients which have everything up to 'if-version' get a short reply
+        # and nothing else.  Returns True if that was sent or it failed.
+        if 'if-version' not in obj:
+            return False
+        if type(obj['if-version']) != int:
+            self.sendFailureResponse(client, command + ": 'if-version' is not an integer.")
+            return True
+        if obj['if-version'] != self.state.getVersion():
+            return False
+        self.sendEventResponse(client, command, {'not-modified': True, 'version': obj['if-version']})
+        return True
+
+    def sendStats(self, client):
+        queued = 0
+        for other in self.clients:
+            queued += other.queued()
+        self.stats['clients'] = len(self.clients)
+        self.stats['client-send-queued'] = queued
+        if self.prefetcher is not None:
+            self.stats.update(self.prefetcher.getStats())
+        self.sendEventResponse(client, 'get-stats', {'data': self.stats})
+
+    def updateBacklog(self, channel, backlog):
+        # backlog is what's left buffered after a wakeup used its whole budget
+        self.stats[channel + '-backlog'] = backlog
+        if backlog > self.stats[channel + '-backlog-max']:
+            self.stats[channel + '-backlog-max'] = backlog
+        if backlog > 0:
+            self.print_debug(channel + " backlog: " + str(backlog))
+
+    def queueProperties(self, client, needed, maxAge=None):
+        props = MPVVJProperties(self, client, needed, maxAge)
+        if props.filled():
+            props.send()
+        elif self.mpv is not None and self.mpv.socket is not None:
+            props.request(self.mpv)
+        else:
+            self.propertiesWaiting.append(props)
 
     def clientMpvUnexpectedTerminated(self):
-        self.mpv.terminate()
+        # losing either deck loses both
+        for mpv in self.getDecks():
+            mpv.terminate()
         self.mpv = None
+        self.standby = None
         self.connected = False
         self.playing = False
-        self.sendEventResponse('mpv-unexpected-termination')
+        self.dropQueued()
+        self.resetDecks()
+        self.starting = 0
+        self.broadcastEventResponse('mpv-unexpected-termination')
 
     def stop(self):
         self.playing = False
+        self.dropQueued()
+        if self.standby is not None:
+            # decks hold their last frame until they're told otherwise
+            if self.mpv.socket is not None:
+                self.mpv.stop()
+            self.stopDecks()
         self.state.stop()
 
-    def tick(self):
-        def checkPropertiesFilled():
-            for prop in self.neededProperties:
-                if prop[1] == None:
-                    return
-            self.sendProperties()
-            self.neededProperties = None
-        if self.neededProperties != None:
-            checkPropertiesFilled()
-
-        if self.mpv is not None:
-            if self.mpv.checkMPVRunning():
-                if self.mpv.socket is None:
-                    if time.monotonic() - self.lastConnectionAttempt >= 1:
-                        self.lastConnectionAttempt = time.monotonic()
-                        try:
-                            self.mpv.connect()
-                        except ConnectionRefusedError:
-                            self.print("Connection refused, socket not ready?")
-                        except FileNotFoundError:
-                            self.print("File not found, waiting on mpv...")
-                else:
-                    if not self.connected:
-                        self.sendEventResponse("run-mpv")
-                        self.connected = True
-                    if self.neededProperties != None:
-                        for prop in enumerate(self.neededProperties):
-                            if prop[1][1] == None and prop[1][2] == False:
-                                self.requestReplacementVar(prop[1][0])
-                                self.neededProperties[prop[0]] = (prop[1][0], prop[1][1], True)
+    def handleMpvObj(self, obj, mpv=None):
+        if mpv is None:
+            mpv = self.mpv
+        self.print_debug("MPV --> " + repr(obj))
+        if 'event' in obj:
+            if obj['event'] == 'property-change':
+                mpv.propertyChanged(obj)
+            if self.standby is not None:
+                self.handleDeckEvent(obj, mpv)
+            elif obj['event'] == 'idle':
+                # only once mpv ran out of items, which is the end of the
+                # playlist unless the next one was queued too late
+                if self.playing:
+                    self.playNext()
+            elif obj['event'] == 'start-file':
+                self.playing = True
+                if self.startedQueued(obj):
+                    # mpv went on to the queued item by itself
+                    self.starting = 0
+                    mpv.removePlayed()
+                    # mpv only opens what's queued once it starts
+                    self.prefetchUsed(self.queued)
                     try:
-                        obj = self.mpv.getNextObj()
-
-                        if obj is not None:
-                            self.print_debug("MPV --> " + repr(obj))
-                            if 'event' in obj:
-                                if obj['event'] == 'idle':
-                                    if self.playing:
-                                        try:
-                                            self.playCurrentAndAdvance()
-                                        except PlaylistStop:
-                                            self.stop()
-                                        except ValueError as e:
-                                            self.stop()
-                                            self.print("State error: " + e.args[0])
-                                elif obj['event'] == 'start-file':
-                                    self.playing = True
-                            elif 'error' in obj:
-                                if 'request_id' in obj:
-                                    if obj['request_id'] != self.MPV_COMMAND_REQUEST_ID:
-                                        if obj['error'] == 'success':
-                                            self.setReplacementVar(obj['request_id'], obj['data'])
-                                        else:
-                                            self.setReplacementVar(obj['request_id'], None)
-                                    else:
-                                        if self.waitForCommand:
-                                            if obj['error'] == 'success':
-                                                self.sendEventResponse('mpv-command')
-                                            else:
-                                                self.sendFailureResponse("mpv-command: " + obj['error'])
-                                            self.waitForCommand = False
-                                        else:
-                                            self.print("Got command response when not waiting for one?")
-                    except ConnectionError as e:
-                        self.print("MPV connection error: " + e.args[0])
-                        self.clientMpvUnexpectedTerminated()
-            else:
-                self.print("MPV terminated unexpectedly.")
-                self.clientMpvUnexpectedTerminated()
-        else:
-            if self.neededProperties != None:
-                if self.socket.connected:
-                    self.sendFailureResponse("get-properties: MPV terminated before all properties were gathered.")
-                self.neededProperties = None
-            if self.waitForCommand:
-                if self.socket.connected:
-                    self.sendFailureResponse("mpv-command: MPV terminated before response.")
-                self.waitForCommand = False
-
-        if not self.socket.connected:
-            self.socket.accept()
-        else:
-            if self.lastAct is None:
-                self.lastAct = time.monotonic()
-            obj = None
-            try:
-                obj = self.socket.getJSONAsObj()
-                self.lastAct = time.monotonic()
-            except json.decoder.JSONDecodeError as e:
-                self.sendFailureResponse("Bad JSON: " + e.args[0])
-            except ConnectionError as e:
-                self.print("Client connection error: " + e.args[0])
-                self.reconnectSocket()
+                        self.state.setCurrentPlaying()
+                        self.state.advance()
+                        self.queueNext()
+                    except ValueError as e:
+                        self.stop()
+                        self.print("State error: " + e.args[0])
+                elif self.starting > 0:
+                    self.starting -= 1
+                elif self.queued is not None:
+                    # something taken out of mpv's playlist just too late
+                    # started, so play what the state has cued instead
+                    self.playNext()
+        elif 'error' in obj:
+            if not mpv.handleReply(obj):
+                self.print_debug("MPV reply to nothing waiting on one.")
+
+    def handleClientObj(self, client, obj):
+        self.print_debug(client.name + " --> " + repr(obj))
+        if 'id' in obj:
+            if type(obj['id']) != int and type(obj['id']) != str:
+                self.sendFailureResponse(client, "'id' must be an integer or string.")
                 return True
-            if obj is None:
-                if time.monotonic() - self.lastAct > MPVVJServer.TIMEOUT:
-                    self.print("Client connection timed out!")
-                    self.reconnectSocket()
-            else:
-                self.lastAct = time.monotonic()
-                self.print_debug("client --> " + repr(obj))
-                if 'command' in obj:
-                    if obj['command'] == 'get-all-state':
-                        self.sendPlaylists()
-                        for pl in self.state.playlists:
-                            if (len(pl.entries) != 0):
-                                self.sendPlaylist(pl)
-                        self.sendMpvOpts()
-                    elif obj['command'] == 'get-version':
-                        self.sendEventResponse(obj['command'], {'data': self.VERSION})
-                    elif obj['command'] == 'set-mpv-opts':
-                        command = obj['command']
-                        del obj['command']
-                        if 'opts' in obj:
-                            if type(obj['opts']) == list:
-                                def checkOptions(options):
-                                    for opt in options:
-                                        if type(opt) != list:
-                                            self.sendFailureResponse(command + ": Option item is not a list.")
-                                            return False
-                                        if len(opt) != 2:
-                                            self.sendFailureResponse(command + ": Option must contain the key and value.")
-                                            return False
-                                        if type(opt[0]) != str or type(opt[1]) != str:
-                                            self.sendFailureResponse(command + ": Option keys and values must be strings.")
-                                            return False
-                                    return True
-                                if checkOptions(obj['opts']):
-                                    self.mpvopts = obj['opts']
-                                    self.sendEventResponse(command)
+            client = MPVVJTaggedClient(client, obj['id'])
+        if 'command' in obj:
+            if obj['command'] == 'get-all-state':
+                if self.checkIfVersion(client, obj['command'], obj):
+                    return True
+                self.sendPlaylists(client)
+                for pl in self.state.playlists:
+                    if len(pl) != 0:
+                        self.sendPlaylist(client, pl)
+                self.sendMpvOpts(client)
+            elif obj['command'] == 'get-version':
+                self.sendEventResponse(client, obj['command'], {'data': self.VERSION})
+            elif obj['command'] == 'get-stats':
+                self.sendStats(client)
+            elif obj['command'] == 'batch':
+                command = obj['command']
+                if 'commands' not in obj:
+                    self.sendFailureResponse(client, command + ": No 'commands'.")
+                    return True
+                if type(obj['commands']) != list:
+                    self.sendFailureResponse(client, command + ": 'commands' is not a list.")
+                    return True
+                if len(obj['commands']) == 0:
+                    self.sendFailureResponse(client, command + ": 'commands' is empty.")
+                    return True
+                atomic = False
+                if 'atomic' in obj:
+                    if type(obj['atomic']) != bool:
+                        self.sendFailureResponse(client, command + ": 'atomic' is not a bool.")
+                        return True
+                    atomic = obj['atomic']
+                stopOnFailure = False
+                if 'stop-on-failure' in obj:
+                    if type(obj['stop-on-failure']) != bool:
+                        self.sendFailureResponse(client, command + ": 'stop-on-failure' is not a bool.")
+                        return True
+                    stopOnFailure = obj['stop-on-failure']
+                for sub in obj['commands']:
+                    if type(sub) != dict:
+                        self.sendFailureResponse(client, command + ": Command is not an object.")
+                        return True
+                    if 'command' in sub:
+                        if sub['command'] in self.BATCH_FORBIDDEN:
+                            self.sendFailureResponse(client, command + ": " + str(sub['command']) + " can't be batched.")
+                            return True
+                        if atomic and (sub['command'] in self.BATCH_DEFERRED or
+                                       sub['command'] in self.BATCH_IRREVERSIBLE):
+                            self.sendFailureResponse(client, command + ": " + str(sub['command']) + " can't be in an atomic batch.")
+                            return True
+                MPVVJBatch(self, client, obj['commands'], atomic, stopOnFailure).resume()
+            elif obj['command'] == 'set-mpv-opts':
+                command = obj['command']
+                del obj['command']
+                if 'opts' in obj:
+                    if type(obj['opts']) == list:
+                        def checkOptions(options):
+                            for opt in options:
+                                if type(opt) != list:
+                                    self.sendFailureResponse(client, command + ": Option item is not a list.")
+                                    return False
+                                if len(opt) != 2:
+                                    self.sendFailureResponse(client, command + ": Option must contain the key and value.")
+                                    return False
+                                if type(opt[0]) != str or type(opt[1]) != str:
+                                    self.sendFailureResponse(client, command + ": Option keys and values must be strings.")
+                                    return False
+                            return True
+                        if checkOptions(obj['opts']):
+                            self.mpvopts = obj['opts']
+                            self.state.touch()
+                            self.sendEventResponse(client, command)
+                    else:
+                        self.sendFailureResponse(client, command + ": 'opts' is not a list.")
+                else:
+                    self.sendFailureResponse(client, command + ": No 'opts'.")
+            elif obj['command'] == 'run-mpv':
+                command = obj['command']
+                if self.mpv is None:
+                    if self.dualDeck:
+                        self.mpv = MPV.MPVDeck(self.mpvPath, self.socketPath, self.mpvopts)
+                        self.standby = MPV.MPVDeck(self.mpvPath, self.socketPath + self.STANDBY_SUFFIX, self.mpvopts)
+                    else:
+                        self.mpv = MPV.MPV(self.mpvPath, self.socketPath, self.mpvopts)
+                    self.lastConnectionAttempt = time.monotonic()
+                    self.mpvClient = client
+                    # client gets notified once a connection to MPV is established
+                else:
+                    self.sendFailureResponse(client, command + ": MPV is already running.")
+            elif obj['command'] == 'terminate-mpv':
+                command = obj['command']
+                self.terminateMpv()
+                self.sendEventResponse(client, command)
+            elif obj['command'] == 'new-playlists':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.newPlaylists(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'delete-playlists':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.deletePlaylists(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'select-playlist':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.setSelectedPlaylist(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'toggle-looping':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.togglePlaylistLooping()
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'toggle-shuffle':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.togglePlaylistShuffle()
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'add-items':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.addItems(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'delete-items':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.deleteItems(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'set-played':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.setPlayed(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'track-relative':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.setPlaylistCurrentItemRelative(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'track-absolute':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.setPlaylistCurrentItem(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'track-by-name':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.setPlaylistCurrentItemByName(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'loop-file':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.toggleFileLooping()
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)                    
+            elif obj['command'] == 'mpv-command':
+                command = obj['command']
+                if 'mpv' not in obj:
+                    self.sendFailureResponse(client, command + ": No 'mpv'.")
+                elif self.mpv is None or self.mpv.socket is None:
+                    self.sendFailureResponse(client, command + ": MPV isn't running.")
+                else:
+                    # any number can be waiting, each reply finds its own client
+                    def commandReplied(reply, client=client):
+                        if reply['error'] == 'success':
+                            if 'data' in reply:
+                                self.sendEventResponse(client, command, {'data': reply['data']})
                             else:
-                                self.sendFailureResponse(command + ": 'opts' is not a list.")
-                        else:
-                            self.sendFailureResponse(command + ": No 'opts'.")
-                    elif obj['command'] == 'run-mpv':
-                        command = obj['command']
-                        if self.mpv is None:
-                            self.mpv = MPV.MPV(self.mpvPath, self.socketPath, self.mpvopts)
-                            self.lastConnectionAttempt = time.monotonic()
-                            # client gets notified once a connection to MPV is established
-                        else:
-                            self.sendFailureResponse(command + ": MPV is already running.")
-                    elif obj['command'] == 'terminate-mpv':
-                        command = obj['command']
-                        self.terminateMpv()
-                        self.sendEventResponse(command)
-                    elif obj['command'] == 'new-playlists':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.newPlaylists(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'delete-playlists':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.deletePlaylists(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'select-playlist':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.setSelectedPlaylist(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'toggle-looping':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.togglePlaylistLooping()
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
+                                self.sendEventResponse(client, command)
+                        elif reply['error'] == 'terminated':
+                            self.sendFailureResponse(client, command + ": MPV terminated before response.")
+                        elif reply['error'] == 'timeout':
+                            self.sendFailureResponse(client, command + ": MPV didn't answer in time.")
                         else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'toggle-shuffle':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.togglePlaylistShuffle()
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'add-items':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.addItems(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'delete-items':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.deleteItems(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'set-played':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.setPlayed(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'track-relative':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.setPlaylistCurrentItemRelative(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'track-absolute':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.setPlaylistCurrentItem(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'loop-file':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.toggleFileLooping()
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)                    
-                    elif obj['command'] == 'mpv-command':
-                        command = obj['command']
-                        if 'mpv' not in obj:
-                            self.sendFailureResponse("No 'mpv'.")
-                        self.mpv.sendCommand(obj['mpv'][0], obj['mpv'][1:], request_id=self.MPV_COMMAND_REQUEST_ID)
-                        self.waitForCommand = True
-                    elif obj['command'] == 'cue-playlist':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.setCurrentPlaylist(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'play':
-                        command = obj['command']
-                        if self.mpv is not None:
-                            try:
-                                self.playCurrentAndAdvance()
-                                self.playing = True
-                                self.sendEventResponse(command)
-                            except ValueError as e:
-                                try:
-                                    self.stop()
-                                except ValueError:
-                                    pass
-                                self.sendFailureResponse(command + ": " + e.args[0])
-                            except PlaylistStop:
-                                self.sendFailureResponse(command + ": End of playlist reached.")
-                        else:
-                            self.sendFailureResponse(command + ": MPV isn't running.")
-                    elif obj['command'] == 'stop':
-                        command = obj['command']
-                        if self.playing:
-                            self.mpv.stop()
-                            self.playing = False
-                            self.sendEventResponse(command)
-                        else:
-                            self.sendFailureResponse(command + ": Already stopped.")
-                    elif obj['command'] == 'move-items':
-                        command = obj['command']
-                        del obj['command']
-                        ret = self.state.moveItems(obj)
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
-                        else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'get-properties':
-                        command = obj['command']
-                        if 'properties' not in obj:
-                            self.sendFailureResponse(command + ": No 'properties'.")
-                        if type(obj['properties']) != list:
-                            self.sendFailureResponse(command + ": 'properties' is not a list.")
-                        if len(obj['properties']) == 0:
-                            self.sendFailureResponse(command + ": 'properties' is empty.")
-                        for prop in obj['properties']:
-                            if type(prop) != str:
-                                self.sendFailureResponse(command + ": Property is not a string.")
-                        self.neededProperties = []
-                        for prop in obj['properties']:
-                            if prop == 'file':
-                                try:
-                                    name = self.state.getCurrentPlayingName()
-                                    try:
-                                        slash = name.rindex('/')
-                                        self.neededProperties.append((prop, name[slash+1:]))
-                                    except ValueError:
-                                        self.neededProperties.append((prop, name))
-                                except ValueError:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                            elif prop == 'path':
-                                try:
-                                    self.neededProperties.append((prop, self.state.getCurrentPlayingName()))
-                                except ValueError:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                            elif prop == 'playlistlength':
-                                try:
-                                    self.neededProperties.append((prop, self.state.getCurrentPlaylistLength()))
-                                except ValueError:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                            elif prop == 'position':
-                                try:
-                                    self.neededProperties.append((prop, self.state.getCurrentPlaylistPlayingPos()))
-                                except ValueError:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                            elif prop == 'playlistslength':
-                                try:
-                                    self.neededProperties.append((prop, self.state.getPlaylistsCount()))
-                                except ValueError:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                            elif prop == 'currentname':
-                                try:
-                                    self.neededProperties.append((prop, self.state.getCurrentPlaylistName()))
-                                except ValueError:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                            elif prop == 'currentposition':
-                                if self.state.currentPlaylist == None:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                                else:
-                                    self.neededProperties.append((prop, self.state.currentPlaylist))
-                            elif prop == 'selectedname':
-                                try:
-                                    self.neededProperties.append((prop, self.state.getSelectedPlaylistName()))
-                                except ValueError:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                            elif prop == 'selectedposition':
-                                if self.state.selectedPlaylist == None:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                                else:
-                                    self.neededProperties.append((prop, self.state.selectedPlaylist))
-                            elif prop == 'repeat':
-                                try:
-                                    self.neededProperties.append((prop, MPVVJUtils.boolYesNo(self.state.getCurrentPlaylistLooping())))
-                                except ValueError:
-                                    self.neededProperties.append((prop, self.REPLACEMENT_NONE))
-                            elif prop == 'single':
-                                self.neededProperties.append((prop, MPVVJUtils.boolYesNo(self.state.loopFile)))
-                            elif prop == 'maininterval':
-                                self.neededProperties.append((prop, self.state.TVMainTime))
-                            elif prop == 'interinterval':
-                                self.neededProperties.append((prop, self.state.TVInterTime))
-                            elif prop == 'interplaylist':
-                                self.neededProperties.append((prop, self.state.getInterPlaylistName()))
-                            elif prop == 'tvmode':
-                                self.neededProperties.append((prop, MPVVJUtils.boolYesNo(self.state.TVMode)))
-                            else:
-                                if prop not in self.MPV_PROPERTY_REQUEST:
-                                    self.sendFailureResponse(command + ": Unrecognized property: " + prop)
-                                    self.neededProperties = None
-                                    break
-                                else:
-                                    self.neededProperties.append((prop, None, False))
-                    elif obj['command'] == 'list':
-                        command = obj['command']
-                        playlists = self.state.getPlaylists()
-                        playlist = self.state.getPlaylist()
-                        currentPlaylist = self.state.currentPlaylist
-                        playingPlaylist = self.state.playingPlaylist
-                        selectedPlaylist = self.state.selectedPlaylist
-                        interPlaylist = self.state.interPlaylist
-                        selectedCued = None
+                            self.sendFailureResponse(client, command + ": " + reply['error'])
+                    self.mpv.request(obj['mpv'][0], obj['mpv'][1:], commandReplied)
+            elif obj['command'] == 'cue-playlist':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.setCurrentPlaylist(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'play':
+                command = obj['command']
+                if self.mpv is not None:
+                    try:
+                        self.playCurrentAndAdvance()
+                        self.playing = True
+                        self.sendEventResponse(client, command)
+                    except ValueError as e:
                         try:
-                            selectedCued = self.state.getSelectedPlaylistCuedPos()
+                            self.stop()
                         except ValueError:
                             pass
-                        selectedPlaying = None
+                        self.sendFailureResponse(client, command + ": " + e.args[0])
+                    except PlaylistStop:
+                        self.sendFailureResponse(client, command + ": End of playlist reached.")
+                else:
+                    self.sendFailureResponse(client, command + ": MPV isn't running.")
+            elif obj['command'] == 'stop':
+                command = obj['command']
+                if self.playing:
+                    self.mpv.stop()
+                    self.playing = False
+                    self.dropQueued()
+                    self.stopDecks()
+                    self.sendEventResponse(client, command)
+                else:
+                    self.sendFailureResponse(client, command + ": Already stopped.")
+            elif obj['command'] == 'move-items':
+                command = obj['command']
+                del obj['command']
+                ret = self.state.moveItems(obj)
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'get-properties':
+                command = obj['command']
+                if 'properties' not in obj:
+                    self.sendFailureResponse(client, command + ": No 'properties'.")
+                    return True
+                if type(obj['properties']) != list:
+                    self.sendFailureResponse(client, command + ": 'properties' is not a list.")
+                    return True
+                if len(obj['properties']) == 0:
+                    self.sendFailureResponse(client, command + ": 'properties' is empty.")
+                    return True
+                maxAge = None
+                if 'max-age' in obj:
+                    if type(obj['max-age']) != int and type(obj['max-age']) != float:
+                        self.sendFailureResponse(client, command + ": 'max-age' is not a number.")
+                        return True
+                    if obj['max-age'] < 0:
+                        self.sendFailureResponse(client, command + ": 'max-age' is negative.")
+                        return True
+                    maxAge = obj['max-age']
+                for prop in obj['properties']:
+                    if type(prop) != str:
+                        self.sendFailureResponse(client, command + ": Property is not a string.")
+                        return True
+                needed = []
+                for prop in obj['properties']:
+                    if prop == 'file':
                         try:
-                            selectedPlaying = self.state.getSelectedPlaylistPlayingPos()
+                            name = self.state.getCurrentPlayingName()
+                            try:
+                                slash = name.rindex('/')
+                                needed.append((prop, name[slash+1:]))
+                            except ValueError:
+                                needed.append((prop, name))
                         except ValueError:
-                            pass
-
-                        resp = {'playlists': playlists, 'current-playlist': currentPlaylist, 'playing-playlist': playingPlaylist, 'selected-playlist': selectedPlaylist, 'inter-playlist': interPlaylist, 'cued': selectedCued, 'playing': selectedPlaying,}
-
-                        if playlist != None:
-                            resp['playlist'] = playlist
-
-                        self.sendEventResponse(command, resp)
-                    elif obj['command'] == 'clear':
-                        command = obj['command']
-                        self.state = MPVVJState.MPVVJState()
-                        self.sendEventResponse(command)
-                    elif obj['command'] == 'kill':
-                        command = obj['command']
-                        self.sendEventResponse(command)
-                        self.cleanUp()
-                        return False
-                    elif obj['command'] == 'tv-intervals':
-                        command = obj['command']
-                        if 'intervals' not in obj:
-                            self.sendFailureResponse(command + ": No 'intervals'.")
-                        if type(obj['intervals']) != list:
-                            self.sendFailureResponse(command + ": 'intervals' is not a list.")
-                        if len(obj['intervals']) != 2:
-                            self.sendFailureResponse(command + ": 'intervals' is not a list of 2 items.")
-                        ret = self.state.setIntervals(obj['intervals'][0], obj['intervals'][1])
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
+                            needed.append((prop, self.REPLACEMENT_NONE))
+                    elif prop == 'path':
+                        try:
+                            needed.append((prop, self.state.getCurrentPlayingName()))
+                        except ValueError:
+                            needed.append((prop, self.REPLACEMENT_NONE))
+                    elif prop == 'playlistlength':
+                        try:
+                            needed.append((prop, self.state.getCurrentPlaylistLength()))
+                        except ValueError:
+                            needed.append((prop, self.REPLACEMENT_NONE))
+                    elif prop == 'position':
+                        try:
+                            needed.append((prop, self.state.getCurrentPlaylistPlayingPos()))
+                        except ValueError:
+                            needed.append((prop, self.REPLACEMENT_NONE))
+                    elif prop == 'playlistslength':
+                        try:
+                            needed.append((prop, self.state.getPlaylistsCount()))
+                        except ValueError:
+                            needed.append((prop, self.REPLACEMENT_NONE))
+                    elif prop == 'currentname':
+                        try:
+                            needed.append((prop, self.state.getCurrentPlaylistName()))
+                        except ValueError:
+                            needed.append((prop, self.REPLACEMENT_NONE))
+                    elif prop == 'currentposition':
+                        if self.state.currentPlaylist == None:
+                            needed.append((prop, self.REPLACEMENT_NONE))
                         else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'tv-playlist':
-                        command = obj['command']
-                        if 'playlist' not in obj:
-                            self.sendFailureResponse(command + ": No 'playlist'.")
-                        ret = self.state.setInterPlaylist(obj['playlist'])
-                        if ret is not None:
-                            self.sendFailureResponse(command + ": " + ret)
+                            needed.append((prop, self.state.getPlaylistPos(self.state.currentPlaylist)))
+                    elif prop == 'selectedname':
+                        try:
+                            needed.append((prop, self.state.getSelectedPlaylistName()))
+                        except ValueError:
+                            needed.append((prop, self.REPLACEMENT_NONE))
+                    elif prop == 'selectedposition':
+                        if self.state.selectedPlaylist == None:
+                            needed.append((prop, self.REPLACEMENT_NONE))
                         else:
-                            self.sendEventResponse(command)
-                    elif obj['command'] == 'tv-mode':
-                        command = obj['command']
-                        self.state.toggleTVMode()
-                        self.sendEventResponse(command)
+                            needed.append((prop, self.state.getPlaylistPos(self.state.selectedPlaylist)))
+                    elif prop == 'repeat':
+                        try:
+                            needed.append((prop, MPVVJUtils.boolYesNo(self.state.getCurrentPlaylistLooping())))
+                        except ValueError:
+                            needed.append((prop, self.REPLACEMENT_NONE))
+                    elif prop == 'single':
+                        needed.append((prop, MPVVJUtils.boolYesNo(self.state.loopFile)))
+                    elif prop == 'maininterval':
+                        needed.append((prop, self.state.TVMainTime))
+                    elif prop == 'interinterval':
+                        needed.append((prop, self.state.TVInterTime))
+                    elif prop == 'interplaylist':
+                        needed.append((prop, self.state.getInterPlaylistName()))
+                    elif prop == 'tvmode':
+                        needed.append((prop, MPVVJUtils.boolYesNo(self.state.TVMode)))
                     else:
-                        self.sendFailureResponse("Unknown action!")
+                        if prop not in self.MPV_PROPERTY_REQUEST:
+                            self.sendFailureResponse(client, command + ": Unrecognized property: " + prop)
+                            needed = None
+                            break
+                        else:
+                            needed.append((prop, None))
+                if needed is not None:
+                    self.queueProperties(client, needed, maxAge)
+            elif obj['command'] == 'list':
+                command = obj['command']
+                if self.checkIfVersion(client, command, obj):
+                    return True
+                playlistsWindow, playlistWindow = self.state.getListWindows(obj)
+                if type(playlistsWindow) == str:
+                    self.sendFailureResponse(client, command + ": " + playlistsWindow)
+                    return True
+                # the encoded lists are kept between calls and go out as they are
+                playlists = JSONSocket.JSONFragment(self.state.getPlaylistsJSON(*playlistsWindow))
+                playlist = self.state.getPlaylistJSON(*playlistWindow)
+                currentPlaylist = self.state.getPlaylistPos(self.state.currentPlaylist)
+                playingPlaylist = self.state.getPlaylistPos(self.state.playingPlaylist)
+                selectedPlaylist = self.state.getPlaylistPos(self.state.selectedPlaylist)
+                interPlaylist = self.state.getPlaylistPos(self.state.interPlaylist)
+                selectedCued = None
+                try:
+                    selectedCued = self.state.getSelectedPlaylistCuedPos()
+                except ValueError:
+                    pass
+                selectedPlaying = None
+                try:
+                    selectedPlaying = self.state.getSelectedPlaylistPlayingPos()
+                except ValueError:
+                    pass
+
+                resp = {'playlists': playlists, 'current-playlist': currentPlaylist, 'playing-playlist': playingPlaylist, 'selected-playlist': selectedPlaylist, 'inter-playlist': interPlaylist, 'cued': selectedCued, 'playing': selectedPlaying,}
+                # positions are always in the whole list, the offsets say
+                # where the windows start
+                resp['playlists-offset'] = playlistsWindow[0]
+                resp['playlists-total'] = self.state.getPlaylistsCount()
+                resp['version'] = self.state.getVersion()
+
+                if playlist != None:
+                    resp['playlist'] = JSONSocket.JSONFragment(playlist)
+                    resp['playlist-offset'] = playlistWindow[0]
+                    resp['playlist-total'] = len(self.state.getSelected())
+
+                self.sendEventResponse(client, command, resp)
+            elif obj['command'] == 'clear':
+                command = obj['command']
+                # keep counting from the old clock so old versions never match
+                self.state = MPVVJState.MPVVJState(self.state.clock)
+                self.state.touch()
+                self.sendEventResponse(client, command)
+            elif obj['command'] == 'kill':
+                command = obj['command']
+                self.sendEventResponse(client, command)
+                self.cleanUp()
+                return False
+            elif obj['command'] == 'tv-intervals':
+                command = obj['command']
+                if 'intervals' not in obj:
+                    self.sendFailureResponse(client, command + ": No 'intervals'.")
+                if type(obj['intervals']) != list:
+                    self.sendFailureResponse(client, command + ": 'intervals' is not a list.")
+                if len(obj['intervals']) != 2:
+                    self.sendFailureResponse(client, command + ": 'intervals' is not a list of 2 items.")
+                ret = self.state.setIntervals(obj['intervals'][0], obj['intervals'][1])
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
+                else:
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'tv-playlist':
+                command = obj['command']
+                if 'playlist' not in obj:
+                    self.sendFailureResponse(client, command + ": No 'playlist'.")
+                ret = self.state.setInterPlaylist(obj['playlist'])
+                if ret is not None:
+                    self.sendFailureResponse(client, command + ": " + ret)
                 else:
-                    self.sendFailureResponse("JSON statement with nothing to do!")
+                    self.sendEventResponse(client, command)
+            elif obj['command'] == 'tv-mode':
+                command = obj['command']
+                self.state.toggleTVMode()
+                self.sendEventResponse(client, command)
+            elif obj['command'] == 'crossfade':
+                command = obj['command']
+                if not self.dualDeck:
+                    self.sendFailureResponse(client, command + ": Server isn't in dual deck mode.")
+                elif 'seconds' not in obj:
+                    self.sendFailureResponse(client, command + ": No 'seconds'.")
+                elif type(obj['seconds']) not in (int, float) or obj['seconds'] < 0:
+                    self.sendFailureResponse(client, command + ": 'seconds' must be a number of at least 0.")
+                else:
+                    # from the next switch on, 0 cuts straight over
+                    self.crossfade = obj['seconds']
+                    self.sendEventResponse(client, command)
+            else:
+                self.sendFailureResponse(client, "Unknown action!")
+        else:
+            self.sendFailureResponse(client, "JSON statement with nothing to do!")
+        return True
+
+    def tickClient(self, client):
+        for count in range(self.budget):
+            # leave requests unread while replies pile up unsent
+            if client.socket.backlogged():
+                break
+            obj = None
+            try:
+                obj = client.socket.getJSONAsObj()
+            except json.decoder.JSONDecodeError as e:
+                self.sendFailureResponse(client, "Bad JSON: " + e.args[0])
+                continue
+            except ConnectionError as e:
+                self.dropClient(client, "Connection error: " + e.args[0])
+                return 0
+            if obj is None:
+                break
+            client.lastAct = time.monotonic()
+            self.stats['client-messages'] += 1
+            if not self.handleClientObj(client, obj):
+                return None
+        else:
+            return client.socket.pendingLines()
+
+        if time.monotonic() - client.lastAct > MPVVJServer.TIMEOUT:
+            self.dropClient(client, "Connection timed out!")
+        return 0
+
+    def updateMpvRequests(self):
+        # sends off what mpv needs to be asked and gives up on what it didn't
+        # answer in time, called whenever a message from a client or mpv was
+        # handled.  Requests in flight when mpv goes are failed by
+        # MPV.terminate().
+        if self.mpv is None:
+            while len(self.propertiesWaiting) > 0:
+                self.propertiesWaiting.popleft().fail("MPV terminated before all properties were gathered.")
+            if self.mpvClient is not None:
+                self.sendFailureResponse(self.mpvClient, "run-mpv: MPV terminated before a connection was made.")
+                self.mpvClient = None
+        elif self.decksConnected():
+            if not self.connected:
+                if self.standby is not None:
+                    # decks are switched on what these say
+                    for mpv in self.getDecks():
+                        mpv.observe('get_property', 'pause')
+                        mpv.observe('get_property', 'eof-reached')
+                self.sendEventResponse(self.mpvClient, "run-mpv")
+                self.mpvClient = None
+                self.connected = True
+            while len(self.propertiesWaiting) > 0:
+                self.propertiesWaiting.popleft().request(self.mpv)
+            now = time.monotonic()
+            for mpv in self.getDecks():
+                mpv.expireRequests(now)
+                mpv.unobserveUnread(now, self.OBSERVE_IDLE)
+            self.syncQueued()
+            self.updateDecks()
+        self.updatePrefetch()
+
+        # batches carry on from replies which arrived above or from mpv, and
+        # what they go on to run may need answering too
+        if len(self.batchesReady) > 0:
+            while len(self.batchesReady) > 0:
+                self.batchesReady.popleft().resume()
+            self.updateMpvRequests()
+
+    def tick(self):
+        if self.rebindPending:
+            self.rebindPending = False
+            self.reconnectSocket()
+            self.print("Listening socket forcibly closed and reopened")
+
+        self.updateMpvRequests()
+
+        connecting = time.monotonic() - self.lastConnectionAttempt >= self.CONNECT_INTERVAL
+        backlog = 0
+        for mpv in self.getDecks():
+            if self.mpv is None:
+                break
+            if not mpv.checkMPVRunning():
+                self.print("MPV terminated unexpectedly.")
+                self.clientMpvUnexpectedTerminated()
+            elif mpv.socket is None:
+                if connecting:
+                    self.lastConnectionAttempt = time.monotonic()
+                    try:
+                        mpv.connect()
+                    except ConnectionRefusedError:
+                        self.print("Connection refused, socket not ready?")
+                    except FileNotFoundError:
+                        self.print("File not found, waiting on mpv...")
+            else:
+                try:
+                    for count in range(self.budget):
+                        obj = mpv.getNextObj()
+                        if obj is None:
+                            break
+                        self.stats['mpv-messages'] += 1
+                        self.handleMpvObj(obj, mpv)
+                        if self.mpv is None:
+                            break
+                    else:
+                        backlog += mpv.socket.pendingLines()
+                except ConnectionError as e:
+                    self.print("MPV connection error: " + e.args[0])
+                    self.clientMpvUnexpectedTerminated()
+        if self.mpv is not None:
+            self.updateBacklog('mpv', backlog)
+
+        self.acceptClients()
+        backlog = 0
+        for client in list(self.clients):
+            clientBacklog = self.tickClient(client)
+            if clientBacklog is None:
+                return False
+            backlog += clientBacklog
+        self.updateBacklog('client', backlog)
         return True
 
 
@@ -692,16 +1646,55 @@ if __name__ == '__main__':
                         help="Address to bind to.", default=DEFAULT_BIND_ADDRESS)
     parser.add_argument('--bind-port', metavar="<port>", type=int,
                         help="Port to bind to.", default=DEFAULT_PORT)
+    parser.add_argument('--control-socket', metavar="<PATH>", type=str,
+                        help="Also listen for local clients on a Unix socket at this path.",
+                        default=None)
+    parser.add_argument('--no-tcp', action='store_true',
+                        help="Don't listen on TCP, only on --control-socket.")
+    parser.add_argument('--message-budget', metavar="<count>", type=int,
+                        help="Most messages to handle from each of the client and mpv per wakeup.",
+                        default=MPVVJServer.MESSAGE_BUDGET)
+    parser.add_argument('--engine', choices=('select', 'asyncio'),
+                        help="Event loop to run the server on.  asyncio doesn't keep the backlog counters.",
+                        default='select')
+    parser.add_argument('--dual-deck', action='store_true',
+                        help="Run two mpvs, loading the next item on one while the other plays.")
+    parser.add_argument('--crossfade', metavar="<seconds>", type=float,
+                        help="Seconds decks crossfade for in dual deck mode, 0 cuts straight over.",
+                        default=0)
+    parser.add_argument('--prefetch', metavar="<count>", type=int,
+                        help="Items ahead in the cued and intermission playlists to read the start of in to the page cache, 0 for none.",
+                        default=0)
+    parser.add_argument('--prefetch-budget', metavar="<bytes>", type=int,
+                        help="Most bytes to read ahead of upcoming items at once.",
+                        default=MPVVJServer.PREFETCH_BUDGET)
     args = parser.parse_args()
+    if args.no_tcp and args.control_socket is None:
+        parser.error("--no-tcp needs --control-socket.")
+    if args.crossfade < 0:
+        parser.error("--crossfade can't be negative.")
+    if args.prefetch < 0:
+        parser.error("--prefetch can't be negative.")
 
-    server = MPVVJServer(args.mpv_path, args.mpv_socket_path,
+    serverClass = MPVVJServer
+    if args.engine == 'asyncio':
+        # imported here as it subclasses this module's server
+        import MPVVJAsyncServer
+        serverClass = MPVVJAsyncServer.MPVVJAsyncServer
+    server = serverClass(args.mpv_path, args.mpv_socket_path,
                          args.bind_address, args.bind_port,
-                         args.quiet, args.verbose)
+                         args.quiet, args.verbose, args.message_budget,
+                         args.control_socket, not args.no_tcp,
+                         args.dual_deck, args.crossfade,
+                         args.prefetch, args.prefetch_budget)
     random.seed(time.time())
 
     try:
-        while server.tick():
-            time.sleep(1 / TPS)
+        if args.engine == 'asyncio':
+            server.run()
+        else:
+            while server.tick():
+                server.wait()
     except BaseException as e:
         server.cleanUp()
         raise e
@@ -17,10 +17,196 @@
 
 
 import random
+import json
 import time
+import array
+import itertools
+import collections
+
+
+class PathStore:
+    # Names of entries in every playlist, each kept once and handed out as
+    # an integer handle, which lasts as long as something holds a reference.
+    # Directory prefixes are kept once as strings. The rest of each name is
+    # kept as UTF-8 in one bytearray and found through an open addressing
+    # hash table of handles, so a name costs its bytes plus a few array
+    # slots instead of a string and a dict entry.
+    EMPTY = 0xFFFFFFFF
+    DELETED = 0xFFFFFFFE
+
+    def __init__(self):
+        self.dirs = {}
+        self.dirPaths = []
+        self.dirRefs = array.array('I')
+        self.freeDirs = []
+        self.data = bytearray()
+        self.garbage = 0
+        # where the rest of each name starts in data and how long it is, names
+        # may hold any character so nothing marks where one ends
+        self.offsets = array.array('Q')
+        self.lengths = array.array('I')
+        self.fileDirs = array.array('I')
+        self.hashes = array.array('q')
+        self.refs = array.array('I')
+        self.free = []
+        self.table = array.array('I', (self.EMPTY,)) * 8
+        self.used = 0
+
+    def __len__(self):
+        return len(self.refs) - len(self.free)
+
+    def getBase(self, handle):
+        offset = self.offsets[handle]
+        return self.data[offset:offset + self.lengths[handle]]
+
+    def probe(self, nameHash, dirID, base):
+        # returns the handle if it's there, and the slot it's in or should go
+        table = self.table
+        hashes = self.hashes
+        mask = len(table) - 1
+        slot = nameHash & mask
+        insert = None
+        while True:
+            handle = table[slot]
+            if handle == self.EMPTY:
+                if insert == None:
+                    insert = slot
+                return None, insert
+            if handle == self.DELETED:
+                if insert == None:
+                    insert = slot
+            elif hashes[handle] == nameHash and self.fileDirs[handle] == dirID and \
+                 self.lengths[handle] == len(base) and self.data.startswith(base, self.offsets[handle]):
+                return handle, slot
+            slot = (slot + 1) & mask
+
+    def find(self, name):
+        split = name.rfind('/') + 1
+        dirID = self.dirs.get(name[:split])
+        if dirID == None:
+            return None
+        return self.probe(hash(name), dirID, name[split:].encode('utf-8', 'surrogatepass'))[0]
+
+    def add(self, name):
+        if type(name) != str:
+            raise TypeError
+        nameHash = hash(name)
+        split = name.rfind('/') + 1
+        prefix = name[:split]
+        base = name[split:].encode('utf-8', 'surrogatepass')
+        dirID = self.dirs.get(prefix)
+        handle, slot = self.probe(nameHash, dirID, base)
+        if handle != None:
+            self.refs[handle] += 1
+            return handle
+
+        if dirID == None:
+            if len(self.freeDirs) > 0:
+                dirID = self.freeDirs.pop()
+                self.dirPaths[dirID] = prefix
+            else:
+                dirID = len(self.dirPaths)
+                self.dirPaths.append(prefix)
+                self.dirRefs.append(0)
+            self.dirs[prefix] = dirID
+        self.dirRefs[dirID] += 1
+
+        offset = len(self.data)
+        self.data += base
+        if len(self.free) > 0:
+            handle = self.free.pop()
+            self.offsets[handle] = offset
+            self.lengths[handle] = len(base)
+            self.fileDirs[handle] = dirID
+            self.hashes[handle] = nameHash
+            self.refs[handle] = 1
+        else:
+            handle = len(self.refs)
+            self.offsets.append(offset)
+            self.lengths.append(len(base))
+            self.fileDirs.append(dirID)
+            self.hashes.append(nameHash)
+            self.refs.append(1)
+
+        if self.table[slot] == self.EMPTY:
+            self.used += 1
+        self.table[slot] = handle
+        # keep at least a third of the table empty
+        if self.used * 3 >= len(self.table) * 2:
+            self.resize()
+        return handle
+
+    def resize(self):
+        size = 8
+        while size < len(self) * 3:
+            size *= 2
+        table = array.array('I', (self.EMPTY,)) * size
+        mask = size - 1
+        for handle in range(len(self.refs)):
+            if self.refs[handle] > 0:
+                slot = self.hashes[handle] & mask
+                while table[slot] != self.EMPTY:
+                    slot = (slot + 1) & mask
+                table[slot] = handle
+        self.table = table
+        self.used = len(self)
+
+    def compact(self):
+        data = bytearray()
+        for handle in range(len(self.refs)):
+            if self.refs[handle] > 0:
+                offset = self.offsets[handle]
+                self.offsets[handle] = len(data)
+                data += self.data[offset:offset + self.lengths[handle]]
+        self.data = data
+        self.garbage = 0
+
+    def ref(self, handle):
+        self.refs[handle] += 1
+
+    def release(self, handle):
+        self.refs[handle] -= 1
+        if self.refs[handle] > 0:
+            return
+
+        table = self.table
+        mask = len(table) - 1
+        slot = self.hashes[handle] & mask
+        while table[slot] != handle:
+            slot = (slot + 1) & mask
+        table[slot] = self.DELETED
+        self.free.append(handle)
+
+        self.garbage += self.lengths[handle]
+        if self.garbage * 2 > len(self.data):
+            self.compact()
+
+        dirID = self.fileDirs[handle]
+        self.dirRefs[dirID] -= 1
+        if self.dirRefs[dirID] == 0:
+            del self.dirs[self.dirPaths[dirID]]
+            self.dirPaths[dirID] = None
+            self.freeDirs.append(dirID)
+
+    def name(self, handle):
+        return self.dirPaths[self.fileDirs[handle]] + self.getBase(handle).decode('utf-8', 'surrogatepass')
+
+
+class VersionClock:
+    # shared by the state and its playlists, ticked on every change so a
+    # version says both that something changed and when
+    def __init__(self):
+        self.now = 0
+
+    def tick(self):
+        self.now += 1
+        return self.now
 
 
 class PlaylistEntry:
+    # playlists don't keep these, they're handed out as a view of one entry
+    __slots__ = ('name', 'played')
+
     def __init__(self, name, played=False):
         if type(name) != str or type(played) != bool:
             raise TypeError
@@ -30,51 +216,139 @@ class PlaylistEntry:
     def __eq__(self, value):
         return self.name == value
 
-    def setPlayed(self, value):
-        if type(value) != bool:
-            raise TypeError
-        self.played = value
-
 
 class Playlist:
-    def __init__(self, name, loop, shuffle):
+    # largest generation an array('I') holds everywhere
+    GENERATION_MAX = 0xFFFFFFFF
+    # turns a mask of entries to keep in to one of entries to drop
+    FLIP = bytes.maketrans(b'\x00\x01', b'\x01\x00')
+
+    def __init__(self, name, loop, shuffle, ID=None, store=None, clock=None):
         if type(name) != str or type(loop) != bool or type(shuffle) != bool:
             raise TypeError
+        if ID is not None and type(ID) != int:
+            raise TypeError
+        if store == None:
+            store = PathStore()
+        if clock == None:
+            clock = VersionClock()
+        self.ID = ID
         self.name = name
-        self.items = []
+        # entries are kept as an array of handles to names in the store and
+        # an array of the generation each was played in. An entry is played
+        # if its generation is the playlist's, so marking everything unplayed
+        # is moving on to the next generation.
+        self.store = store
+        self.handles = array.array('I')
+        self.generation = 1
+        self.playedGens = array.array('I')
+        # how many times each handle appears, and where, built on the first
+        # lookup by name. The counts are kept up to date after that and the
+        # positions rebuilt on the next lookup after anything but an append.
+        # Most names appear once so they get a bare position, and a list
+        # past that.
+        self.counts = None
+        self.positions = None
+        # positions not yet played, drawn from in random order for shuffle,
+        # and where each position sits in the pool or -1. Built on the first
+        # shuffled advance and rebuilt after anything but an append.
+        self.pool = None
+        self.poolSlots = None
         self.playingItem = None
         self.currentCue = None
         self.loop = loop
         self.shuffle = shuffle
+        # the version is the clock's time at the last change, and the
+        # encoded summary and entries are kept until then
+        self.clock = clock
+        self.version = clock.tick()
+        self.summaryJSON = None
+        self.itemsJSON = None
+
+    def touch(self, items=True):
+        self.version = self.clock.tick()
+        self.summaryJSON = None
+        if items:
+            self.itemsJSON = None
 
     def __len__(self):
-        return len(self.items)
+        return len(self.handles)
 
     def __contains__(self, key):
-        for item in self.items:
-            if item == key:
-                return True
-        return False
+        handle = self.store.find(key)
+        if handle == None:
+            return False
+        if self.counts == None:
+            self.counts = collections.Counter(self.handles)
+        return handle in self.counts
 
     def __getitem__(self, key):
-        for item in enumerate(self.items):
-            if item[1] == key:
-                return item
-        return KeyError
+        positions = self.find(key)
+        if len(positions) == 0:
+            raise KeyError(key)
+        return positions[0], PlaylistEntry(key, self.isPlayed(positions[0]))
+
+    def find(self, name):
+        if name not in self:
+            return []
+        if self.positions == None:
+            self.positions = {}
+            for item in enumerate(self.handles):
+                self.addPosition(item[1], item[0])
+        positions = self.positions[self.store.find(name)]
+        if type(positions) == int:
+            return [positions]
+        return positions
+
+    def addPosition(self, handle, idx):
+        positions = self.positions.get(handle)
+        if positions == None:
+            self.positions[handle] = idx
+        elif type(positions) == int:
+            self.positions[handle] = [positions, idx]
+        else:
+            positions.append(idx)
 
     def __delitem__(self, key):
-        item = self[key]
-        del self.items[item[0]]
+        pos = self[key][0]
+        self.deleteEntries(((pos, pos + 1),))
+
+    def shiftCues(self, idx, count):
+        # count entries went in at idx
+        if self.currentCue != None and self.currentCue >= idx:
+            self.currentCue += count
+        if self.playingItem != None and self.playingItem >= idx:
+            self.playingItem += count
 
     def insertEntry(self, value, played=False, idx=-1):
+        if type(value) != str or type(played) != bool:
+            raise TypeError
         empty = False
         if len(self) == 0:
             empty = True
 
-        if idx < 0:
-            self.items.append(PlaylistEntry(value, played))
+        self.touch()
+        handle = self.store.add(value)
+        gen = 0
+        if played:
+            gen = self.generation
+        if idx < 0 or idx == len(self.handles):
+            self.handles.append(handle)
+            self.playedGens.append(gen)
+            if self.positions != None:
+                self.addPosition(handle, len(self.handles) - 1)
+            if self.pool != None:
+                self.poolSlots.append(-1)
+                if not played:
+                    self.poolAdd(len(self.handles) - 1)
         else:
-            self.items.insert(idx, PlaylistEntry(value, played))
+            self.handles.insert(idx, handle)
+            self.playedGens.insert(idx, gen)
+            self.positions = None
+            self.pool = None
+            self.shiftCues(idx, 1)
+        if self.counts != None:
+            self.counts[handle] += 1
 
         if empty:
             if self.shuffle:
@@ -82,79 +356,215 @@ class Playlist:
             else:
                 self.currentCue = 0
 
-    def noneEntryByIndex(self, idx):
-        self.items[idx] = None
-        if self.currentCue != None:
-            if idx == self.currentCue:
+    def insertEntries(self, names, idx=-1):
+        # unplayed, spliced in all at once
+        self.insertHandles(array.array('I', [self.store.add(name) for name in names]), idx)
+
+    def insertHandles(self, handles, idx=-1):
+        # the references to the handles are handed over to the playlist
+        if len(handles) == 0:
+            return
+        self.touch()
+        empty = False
+        if len(self) == 0:
+            empty = True
+
+        if idx < 0 or idx >= len(self.handles):
+            idx = len(self.handles)
+            if self.positions != None:
+                for item in enumerate(handles, idx):
+                    self.addPosition(item[1], item[0])
+            if self.pool != None:
+                self.poolSlots.extend(itertools.repeat(-1, len(handles)))
+                for pos in range(idx, idx + len(handles)):
+                    self.poolAdd(pos)
+        else:
+            self.positions = None
+            self.pool = None
+            self.shiftCues(idx, len(handles))
+        self.handles[idx:idx] = handles
+        self.playedGens[idx:idx] = array.array('I', bytes(len(handles) * self.playedGens.itemsize))
+        if self.counts != None:
+            self.counts.update(handles)
+
+        if empty:
+            if self.shuffle:
+                self.currentCue = random.randrange(len(self))
+            else:
+                self.currentCue = 0
+
+    def deleteEntries(self, ranges):
+        # ranges are (start, stop) pairs in range, overlaps are only deleted once
+        keep = bytearray(b'\x01') * len(self.handles)
+        for item in ranges:
+            keep[item[0]:item[1]] = bytes(item[1] - item[0])
+        if 0 not in keep:
+            return
+        self.touch()
+
+        counts = self.counts
+        for handle in itertools.compress(self.handles, keep.translate(self.FLIP)):
+            if counts != None:
+                if counts[handle] == 1:
+                    del counts[handle]
+                else:
+                    counts[handle] -= 1
+            self.store.release(handle)
+        self.handles = array.array('I', itertools.compress(self.handles, keep))
+        self.playedGens = array.array('I', itertools.compress(self.playedGens, keep))
+        self.positions = None
+        self.pool = None
+
+        # a deleted cue is left at -1, a deleted playing item isn't in the
+        # playlist any more
+        if self.currentCue != None and self.currentCue >= 0:
+            if not keep[self.currentCue]:
                 self.currentCue = -1
-            elif idx < self.currentCue:
-                self.currentCue -= 1
+            else:
+                self.currentCue -= keep.count(0, 0, self.currentCue)
+        if self.playingItem != None:
+            if not keep[self.playingItem]:
+                self.playingItem = None
+            else:
+                self.playingItem -= keep.count(0, 0, self.playingItem)
 
-    def deleteNones(self):
-        while True:
-            try:
-                idx = self.items.index(None)
-                del self.items[idx]
-            except ValueError:
-                break
+    def releaseEntries(self):
+        # give the names back to the store when the playlist goes away
+        self.touch()
+        for handle in self.handles:
+            self.store.release(handle)
+        self.handles = array.array('I')
+        self.playedGens = array.array('I')
 
-    def getItems(self):
+    def getName(self, idx):
+        return self.store.name(self.handles[idx])
+
+    def getItems(self, start=0, stop=None):
         items = []
-        for item in self.items:
-            items.append({'name': item.name, 'played': item.played})
+        gen = self.generation
+        name = self.store.name
+        for item in zip(self.handles[start:stop], self.playedGens[start:stop]):
+            items.append({'name': name(item[0]), 'played': item[1] == gen})
 
         return items
 
+    def getSummaryJSON(self):
+        if self.summaryJSON == None:
+            self.summaryJSON = json.dumps({'name': self.name, 'current': self.currentCue, 'loop': self.loop, 'shuffle': self.shuffle})
+        return self.summaryJSON
+
+    def getItemsJSON(self, start=0, stop=None):
+        # only the whole list is kept, windows in to it are encoded each time
+        if start == 0 and (stop == None or stop >= len(self.handles)):
+            if self.itemsJSON == None:
+                self.itemsJSON = json.dumps(self.getItems())
+            return self.itemsJSON
+        return json.dumps(self.getItems(start, stop))
+
     def setCurrent(self, idx):
-        if idx < 0 or idx > len(self.items) - 1:
+        if idx < 0 or idx > len(self.handles) - 1:
             raise IndexError
 
+        self.touch(False)
         self.currentCue = idx
 
     def getCurrentItemName(self):
         if self.currentCue == None:
             return None
-        return self.items[self.currentCue].name
+        return self.getName(self.currentCue)
 
     def getPlayingItemName(self):
         if self.playingItem == None:
             return None
-        return self.items[self.playingItem].name
+        return self.getName(self.playingItem)
+
+    def getUpcoming(self, count):
+        # the cued item and up to count - 1 after it, shuffled playlists can
+        # only say which is cued
+        if self.currentCue == None or count < 1:
+            return []
+        if self.shuffle:
+            return [self.getName(self.currentCue)]
+        cue = self.currentCue
+        if cue < 0:
+            cue += len(self.handles)
+        positions = list(range(cue, min(cue + count, len(self.handles))))
+        if self.loop:
+            positions.extend(range(min(count - len(positions), cue)))
+        return [self.getName(idx) for idx in positions]
 
     def setCurrentPlaying(self):
+        self.touch(False)
         self.playingItem = self.currentCue
 
     def stop(self):
+        self.touch(False)
         self.playingItem = None
 
+    def buildPool(self):
+        self.pool = []
+        self.poolSlots = [-1] * len(self.handles)
+        gen = self.generation
+        for item in enumerate(self.playedGens):
+            if item[1] != gen:
+                self.poolSlots[item[0]] = len(self.pool)
+                self.pool.append(item[0])
+
+    def poolAdd(self, idx):
+        if self.poolSlots[idx] < 0:
+            self.poolSlots[idx] = len(self.pool)
+            self.pool.append(idx)
+
+    def poolRemove(self, idx):
+        # move the last one in to the hole so removal stays O(1)
+        slot = self.poolSlots[idx]
+        if slot >= 0:
+            last = self.pool.pop()
+            if last != idx:
+                self.pool[slot] = last
+                self.poolSlots[last] = slot
+            self.poolSlots[idx] = -1
+
+    def isPlayed(self, idx):
+        return self.playedGens[idx] == self.generation
+
+    def resetPlayed(self):
+        self.touch()
+        self.generation += 1
+        if self.generation > self.GENERATION_MAX:
+            self.playedGens = array.array('I', bytes(len(self.playedGens) * self.playedGens.itemsize))
+            self.generation = 1
+        if self.pool != None:
+            self.pool = list(range(len(self.handles)))
+            self.poolSlots = list(range(len(self.handles)))
+
     def advance(self):
         if len(self) == 0:
             raise ValueError("Empty playlist.")
 
         # this function is only used for advancing after something has been played
         # so set this now
-        self.items[self.currentCue].setPlayed(True)
+        self.setPlayed(self.currentCue, True)
 
         if self.shuffle:
-            notPlayed = []
-            for item in enumerate(self.items):  # select an entry that hasn't been played
-                if not item[1].played:
-                    notPlayed.append(item[0])
+            if self.pool == None:
+                self.buildPool()
 
-            if len(notPlayed) == 0:
+            # select an entry that hasn't been played, positions leave the pool
+            # as they're played so each pass is a Fisher-Yates shuffle drawn
+            # one at a time
+            if len(self.pool) == 0:
                 if self.loop:
-                    for item in self.items:
-                        item.setPlayed(False)
-                        self.currentCue = random.randrange(len(self))
+                    self.resetPlayed()
+                    self.currentCue = random.randrange(len(self))
                 else:
                     self.currentCue = None
             else:
-                self.currentCue = notPlayed[random.randrange(len(notPlayed))]
+                self.currentCue = self.pool[random.randrange(len(self.pool))]
         else:
             if self.currentCue == len(self) - 1:
                 if self.loop:
-                    for item in self.items:
-                        item.setPlayed(False)
+                    self.resetPlayed()
                     self.currentCue = 0
                 else:
                     self.currentCue = None
@@ -162,6 +572,7 @@ class Playlist:
                 self.currentCue += 1
 
     def setLooping(self, value=None):
+        self.touch(False)
         if value == None:
             self.loop = not self.loop
         else:
@@ -170,6 +581,7 @@ class Playlist:
             self.loop = value
 
     def setShuffle(self, value=None):
+        self.touch(False)
         if value == None:
             self.shuffle = not self.shuffle
         else:
@@ -177,13 +589,56 @@ class Playlist:
                 raise TypeError
             self.shuffle = value
 
-    def setPlayed(self, index, value):
-        self.items[index].setPlayed(value)
+    def setPlayed(self, index, value=None):
+        if index < 0:
+            index += len(self.handles)
+        if value == None:
+            value = not self.isPlayed(index)
+        elif type(value) != bool:
+            raise TypeError
+        self.touch()
+        if value:
+            self.playedGens[index] = self.generation
+        else:
+            self.playedGens[index] = 0
+        if self.pool != None:
+            if value:
+                self.poolRemove(index)
+            else:
+                self.poolAdd(index)
+
+    def setPlayedRange(self, start, end, value):
+        # end is exclusive
+        if type(value) != bool:
+            raise TypeError
+        if end - start == 1:
+            self.setPlayed(start, value)
+            return
+        if not value and start == 0 and end == len(self.handles):
+            self.resetPlayed()
+            return
+        self.touch()
+        gen = 0
+        if value:
+            gen = self.generation
+        self.playedGens[start:end] = array.array('I', (gen,)) * (end - start)
+        self.pool = None
 
 
 class MPVVJState:
-    def __init__(self):
+    # selectedPlaylist, currentPlaylist, playingPlaylist and interPlaylist
+    # hold playlist IDs, which stay the same when other playlists are deleted.
+    # Clients only ever see positions in the playlists list.
+    def __init__(self, clock=None):
+        if clock == None:
+            clock = VersionClock()
         self.playlists = []
+        self.byName = {}
+        self.byID = {}
+        self.nextID = 0
+        self.positions = None
+        # names of entries in every playlist
+        self.store = PathStore()
         self.selectedPlaylist = None
         self.currentPlaylist = None
         self.playingPlaylist = None
@@ -194,47 +649,70 @@ class MPVVJState:
         self.TVMode = False
         self.lastMain = None
         self.lastInter = None
+        # playlists tick the same clock, so its time is the version of the
+        # whole state.  The encoded list of playlists is kept until it moves.
+        self.clock = clock
+        self.playlistsJSON = None
+        self.playlistsVersion = None
+
+    def touch(self):
+        self.clock.tick()
+
+    def getVersion(self):
+        return self.clock.now
 
     def __contains__(self, key):
-        for pl in self.playlists:
-            if pl.name == key:
-                return True
-        return False
+        return key in self.byName
 
     def __getitem__(self, key):
-        for pl in enumerate(self.playlists):
-            if pl[1].name == key:
-                return pl
-        raise KeyError
+        pl = self.byName[key]
+        return pl.ID, pl
+
+    def getPlaylistPos(self, ID):
+        if ID == None:
+            return None
+        # rebuilt only after playlists were added or removed
+        if self.positions == None:
+            self.positions = {}
+            for pl in enumerate(self.playlists):
+                self.positions[pl[1].ID] = pl[0]
+        return self.positions[ID]
 
     def getSelected(self):
         if self.selectedPlaylist == None:
             return None
-        return self.playlists[self.selectedPlaylist]
+        return self.byID[self.selectedPlaylist]
 
     def getCurrent(self):
         if self.currentPlaylist == None:
             return None
-        return self.playlists[self.currentPlaylist]
+        return self.byID[self.currentPlaylist]
 
     def getPlaying(self):
         if self.playingPlaylist == None:
             return None
-        return self.playlists[self.playingPlaylist]
+        return self.byID[self.playingPlaylist]
 
     def getInter(self):
         if self.interPlaylist == None:
             return None
-        return self.playlists[self.interPlaylist]
+        return self.byID[self.interPlaylist]
 
     def newPlaylist(self, name, loop, random):
-        self.playlists.append(Playlist(name, loop, random))
+        pl = Playlist(name, loop, random, self.nextID, self.store, self.clock)
+        self.nextID += 1
+        self.playlists.append(pl)
+        self.byName[name] = pl
+        self.byID[pl.ID] = pl
+        if self.positions != None:
+            self.positions[pl.ID] = len(self.playlists) - 1
 
     def newPlaylists(self, obj):
         if 'playlists' not in obj:
             return "No 'playlists'."
         if type(obj['playlists']) != list:
             return "'playlists' is not a list."
+        names = set()
         for item in enumerate(obj['playlists']):
             if type(item[1]) != dict:
                 return "'playlists' item not a dict."
@@ -255,11 +733,9 @@ class MPVVJState:
 
             if item[1]['name'] in self:
                 return "Playlist item '" + item[1]['name'] + "' already exists."
-            for item2 in enumerate(obj['playlists']):
-                if item[0] == item2[0]:
-                    continue
-                if item[1]['name'] == item2[1]['name']:
-                    return "Duplicate name '" + item[1]['name'] + "'."
+            if item[1]['name'] in names:
+                return "Duplicate name '" + item[1]['name'] + "'."
+            names.add(item[1]['name'])
 
         for item in obj['playlists']:
             loop = False
@@ -276,39 +752,43 @@ class MPVVJState:
             self.newPlaylist(item['name'], loop, shuffle)
         return None
 
-    def deletePlaylist(self, idx):
-        if self.currentPlaylist != None:
-            if self.currentPlaylist == idx:
-                self.currentPlaylist = None
-            elif self.currentPlaylist > idx:
-                self.currentPlaylist -= 1
+    def deletePlaylist(self, ID):
+        self.deletePlaylistIDs((ID,))
 
-        if self.selectedPlaylist != None:
-            if self.selectedPlaylist == idx:
+    def deletePlaylistIDs(self, IDs):
+        self.touch()
+        for ID in IDs:
+            if self.currentPlaylist == ID:
+                self.currentPlaylist = None
+            if self.selectedPlaylist == ID:
                 self.selectedPlaylist = None
-            elif self.selectedPlaylist > idx:
-                self.selectedPlaylist -= 1
-
-        if self.playingPlaylist != None:
-            if self.playingPlaylist == idx:
+            if self.playingPlaylist == ID:
                 self.playingPlaylist = None
-            elif self.playingPlaylist > idx:
-                self.playingPlaylist -= 1
-
-        if self.interPlaylist != None:
-            if self.interPlaylist == idx:
+            if self.interPlaylist == ID:
                 self.interPlaylist = None
-            elif self.interPlaylist > idx:
-                self.interPlaylist -= 1
+            del self.byName[self.byID[ID].name]
 
-        del self.playlists[idx]
+        if len(IDs) == 1:
+            for ID in IDs:
+                # don't rebuild positions just to throw them away again
+                if self.positions != None:
+                    del self.playlists[self.positions[ID]]
+                else:
+                    self.playlists.remove(self.byID[ID])
+        else:
+            # one pass over the list rather than one per playlist
+            self.playlists = [pl for pl in self.playlists if pl.ID not in IDs]
+        for ID in IDs:
+            self.byID[ID].releaseEntries()
+            del self.byID[ID]
+        self.positions = None
 
     def deletePlaylists(self, obj):
         if 'playlists' not in obj:
             return "No 'playlists' list."
         if type(obj['playlists']) != list:
             return "'playlists' is not a list."
-        indices = []
+        IDs = set()
         for item in obj['playlists']:
             if type(item) != str:
                 return "'playlists' item not a string."
@@ -317,16 +797,16 @@ class MPVVJState:
                 pl = self[item]
             except KeyError:
                 return "Playlist " + item + " does not exist."
-            indices.append(pl[0])
+            IDs.add(pl[0])
 
-        for idx in indices:
-            self.deletePlaylist(idx)
+        self.deletePlaylistIDs(IDs)
         return None
 
     def setSelectedPlaylist(self, obj):
         if 'playlist' not in obj:
             return "No 'playlist'."
         if obj['playlist'] is None:
+            self.touch()
             self.selectedPlaylist = None
             return None
         if type(obj['playlist']) != str:
@@ -337,6 +817,7 @@ class MPVVJState:
         except KeyError:
             return "Playlist " + obj['playlist'] + " does not exist."
 
+        self.touch()
         self.selectedPlaylist = pl[0]
         return None
 
@@ -400,6 +881,41 @@ class MPVVJState:
                 location -= 1
         return None
 
+    def getItemRanges(self, items, length, negative=True):
+        # Items are indices or [start, end] ranges including the end, so
+        # clients don't have to spell out every index. Returns [start, stop]
+        # ranges in the order given, with negative indices counted from the
+        # end and neighbours joined up, or an error string.
+        low = 0
+        if negative:
+            low = -length
+        ranges = []
+        for item in items:
+            if type(item) == int:
+                start = item
+                end = item
+            elif type(item) == list and len(item) == 2 and type(item[0]) == int and type(item[1]) == int:
+                start = item[0]
+                end = item[1]
+            else:
+                return "Item is not an integer or [start, end] range."
+            if start < low or start > length - 1:
+                return "Item " + str(start) + " out of range."
+            if end < low or end > length - 1:
+                return "Item " + str(end) + " out of range."
+            if start < 0:
+                start += length
+            if end < 0:
+                end += length
+            if start > end:
+                return "Range " + repr(item) + " ends before it starts."
+
+            if len(ranges) > 0 and ranges[-1][1] == start:
+                ranges[-1][1] = end + 1
+            else:
+                ranges.append([start, end + 1])
+        return ranges
+
     def deleteItems(self, obj):
         selected = self.getSelected()
         if selected == None:
@@ -408,15 +924,11 @@ class MPVVJState:
             return "No 'items' list."
         if type(obj['items']) != list:
             return "'items' is not a list."
-        for item in obj['items']:
-            if type(item) != int:
-                return "Item is not an integer."
-            if item < 0 or item > len(selected) - 1:
-                return "Item " + str(item) + " out of range."
+        ranges = self.getItemRanges(obj['items'], len(selected), False)
+        if type(ranges) == str:
+            return ranges
 
-        for item in obj['items']:
-            selected.noneEntryByIndex(item)
-        selected.deleteNones()
+        selected.deleteEntries(ranges)
         return None
 
     def setPlaylistCurrentItemRelative(self, obj):
@@ -435,6 +947,30 @@ class MPVVJState:
         selected.setCurrent(relPos)
         return None
 
+    def setPlaylistCurrentItemByName(self, obj):
+        selected = self.getSelected()
+        if selected == None:
+            return "No playlist selected."
+        if 'name' not in obj:
+            return "No 'name'."
+        if type(obj['name']) != str:
+            return "'name' is not a string."
+        occurrence = 0
+        try:
+            if type(obj['occurrence']) != int:
+                return "'occurrence' is not an integer."
+            occurrence = obj['occurrence']
+        except KeyError:
+            pass
+        positions = selected.find(obj['name'])
+        if len(positions) == 0:
+            return "No item named " + obj['name'] + "."
+        if occurrence < -len(positions) or occurrence > len(positions) - 1:
+            return "'occurrence'=" + str(occurrence) + " out of range, " + obj['name'] + " appears " + str(len(positions)) + " times."
+
+        selected.setCurrent(positions[occurrence])
+        return None
+
     def setPlaylistCurrentItem(self, obj):
         selected = self.getSelected()
         if selected == None:
@@ -453,6 +989,7 @@ class MPVVJState:
         if 'playlist' not in obj:
             return "No 'playlist'."
         if obj['playlist'] is None:
+            self.touch()
             self.currentPlaylist = None
             return None
         if type(obj['playlist']) != str:
@@ -465,6 +1002,7 @@ class MPVVJState:
         if len(pl[1]) == 0:
             return "Playlist " + obj['playlist'] + " has no entries."
 
+        self.touch()
         self.currentPlaylist = pl[0]
         return None
 
@@ -509,44 +1047,104 @@ class MPVVJState:
         except KeyError:
             pass        
 
-        for item in obj['items']:
-            if type(item) != int:
-                return "Item is not an int."
-                if item < -srcPlaylistLen or item > srcPlaylistLen - 1:
-                    return "Item=" + item + " out of range."
-                if self.selectedPlaylist == playlist:
-                    if location >= 0 and location >= item:
-                        location -= 1
-                    elif location < 0 and location <= -(srcPlaylistLen - item) - 1:
-                        location += 1
-
-        items = []
-        for item in obj['items']:
-            items.append(selected.items[item])
-            selected.noneEntryByIndex(item)
-        selected.deleteNones()
-
-        for item in items:
-            playlist.insertEntry(item.name, False, location)
-            if location >= 0:
-                location += 1
+        ranges = self.getItemRanges(obj['items'], srcPlaylistLen)
+        if type(ranges) == str:
+            return ranges
+
+        # the location is where the items go after they've been taken out
+        handles = array.array('I')
+        taken = bytearray(srcPlaylistLen)
+        for item in ranges:
+            if taken.find(1, item[0], item[1]) < 0:
+                handles.extend(selected.handles[item[0]:item[1]])
+                taken[item[0]:item[1]] = b'\x01' * (item[1] - item[0])
             else:
-                location -= 1
+                for idx in range(item[0], item[1]):
+                    if not taken[idx]:
+                        handles.append(selected.handles[idx])
+                        taken[idx] = 1
+        for handle in handles:
+            self.store.ref(handle)
+        selected.deleteEntries(ranges)
+        playlist.insertHandles(handles, location)
         return None
 
-    def getPlaylists(self):
+    def getPlaylists(self, start=0, stop=None):
         playlists = []
-        for pl in self.playlists:
+        for pl in self.playlists[start:stop]:
             playlists.append({'name': pl.name, 'current': pl.currentCue, 'loop': pl.loop, 'shuffle': pl.shuffle})
 
         return playlists
 
-    def getPlaylist(self):
+    def getPlaylist(self, start=0, stop=None):
+        selected = self.getSelected()
+        if selected == None:
+            return None
+
+        return selected.getItems(start, stop)
+
+    def getPlaylistsJSON(self, start=0, stop=None):
+        if start == 0 and (stop == None or stop >= len(self.playlists)):
+            if self.playlistsVersion != self.clock.now:
+                self.playlistsJSON = '[' + ', '.join([pl.getSummaryJSON() for pl in self.playlists]) + ']'
+                self.playlistsVersion = self.clock.now
+            return self.playlistsJSON
+        return '[' + ', '.join([pl.getSummaryJSON() for pl in self.playlists[start:stop]]) + ']'
+
+    def getPlaylistJSON(self, start=0, stop=None):
         selected = self.getSelected()
         if selected == None:
             return None
 
-        return selected.getItems()
+        return selected.getItemsJSON(start, stop)
+
+    def getWindow(self, obj, offsetKey, limitKey, length):
+        # returns [start, stop] of the part of a list asked for, all of it if
+        # neither key is there, or an error string
+        start = 0
+        stop = length
+        if offsetKey in obj:
+            if type(obj[offsetKey]) != int:
+                return "'" + offsetKey + "' is not an integer."
+            if obj[offsetKey] < 0:
+                return "'" + offsetKey + "' is negative."
+            start = min(obj[offsetKey], length)
+        if limitKey in obj:
+            if type(obj[limitKey]) != int:
+                return "'" + limitKey + "' is not an integer."
+            if obj[limitKey] < 0:
+                return "'" + limitKey + "' is negative."
+            stop = min(start + obj[limitKey], length)
+        return [start, stop]
+
+    def getListWindows(self, obj):
+        # windows in to the playlists and the selected playlist for 'list'
+        playlists = self.getWindow(obj, 'playlists-offset', 'playlists-limit', len(self.playlists))
+        if type(playlists) == str:
+            return playlists, None
+
+        selected = self.getSelected()
+        length = 0
+        if selected != None:
+            length = len(selected)
+        if 'around-cue' in obj:
+            if 'offset' in obj or 'limit' in obj:
+                return "'around-cue' can't be used with 'offset' or 'limit'.", None
+            if type(obj['around-cue']) != int:
+                return "'around-cue' is not an integer.", None
+            if obj['around-cue'] < 0:
+                return "'around-cue' is negative.", None
+            cue = 0
+            if selected != None and selected.currentCue != None and selected.currentCue >= 0:
+                cue = selected.currentCue
+            start = max(cue - obj['around-cue'], 0)
+            entries = [start, min(cue + obj['around-cue'] + 1, length)]
+        else:
+            entries = self.getWindow(obj, 'offset', 'limit', length)
+            if type(entries) == str:
+                return entries, None
+
+        return playlists, entries
 
     def setPlayed(self, obj):
         selected = self.getSelected()
@@ -556,12 +1154,9 @@ class MPVVJState:
             return "No 'item'."
         if type(obj['items']) != list:
             return "'items' is not a list."
-        playlistLen = len(selected)
-        for item in obj['items']:
-            if type(item) != int:
-                return "Item isn't an int."
-            if item < -playlistLen or item > playlistLen - 1:
-                return "Index " + str(item) + " is out of range."
+        ranges = self.getItemRanges(obj['items'], len(selected))
+        if type(ranges) == str:
+            return ranges
 
         value = None
         try:
@@ -570,8 +1165,12 @@ class MPVVJState:
             value = obj['value']
         except KeyError:
             pass
-        for item in obj['items']:
-            selected.setPlayed(item, value)
+        for item in ranges:
+            if value == None:
+                for idx in range(item[0], item[1]):
+                    selected.setPlayed(idx)
+            else:
+                selected.setPlayedRange(item[0], item[1], value)
         return None
 
     def getCurrentCuedName(self):
@@ -591,6 +1190,19 @@ class MPVVJState:
         except AttributeError:
             raise ValueError("No current playlist cued.")
 
+    def getUpcoming(self, count):
+        # what could be played next from the cued playlist and, in TV mode,
+        # from the intermission playlist too
+        names = []
+        current = self.getCurrent()
+        if current != None:
+            names.extend(current.getUpcoming(count))
+        if self.TVMode:
+            inter = self.getInter()
+            if inter != None and inter is not current:
+                names.extend(inter.getUpcoming(count))
+        return names
+
     def getCurrentPlayingName(self):
         try:
             return self.getPlaying().getPlayingItemName()
@@ -600,7 +1212,7 @@ class MPVVJState:
     def getCurrentPlaylistLength(self):
         try:
             return len(self.getCurrent())
-        except AttributeError:
+        except TypeError:
             raise ValueError("No current playlist cued.")
 
     def getCurrentPlaylistCuedPos(self):
@@ -649,6 +1261,7 @@ class MPVVJState:
             raise ValueError("No selected playlist.")
 
     def toggleFileLooping(self):
+        self.touch()
         self.loopFile = not self.loopFile
 
     def setCurrentPlaying(self):
@@ -658,6 +1271,7 @@ class MPVVJState:
                     self.getCurrent().setCurrentPlaying()
                 except AttributeError:
                     raise ValueError("No current playlist cued.")
+                self.touch()
                 self.playingPlaylist = self.currentPlaylist
                 return
             elif self.lastInter != None:
@@ -665,12 +1279,14 @@ class MPVVJState:
                     self.getInter().setCurrentPlaying()
                 except AttributeError:
                     raise ValueError("No intermission playlist selected.")
+                self.touch()
                 self.playingPlaylist = self.interPlaylist
                 return
         try:
             self.getCurrent().setCurrentPlaying()
         except AttributeError:
             raise ValueError("No current playlist cued.")
+        self.touch()
         self.playingPlaylist = self.currentPlaylist
 
     def setIntervals(self, main, inter):
@@ -678,6 +1294,7 @@ class MPVVJState:
             return "Interval is not an int."
         if main < 0 or inter < 0:
             return "Intervals must be greater than or equal to 0."
+        self.touch()
         self.TVMainTime = main
         self.TVInterTime = inter
 
@@ -692,6 +1309,7 @@ class MPVVJState:
         except KeyError:
             return "Playlist " + playlist + " does not exist."
 
+        self.touch()
         self.interPlaylist = pl[0]
         return None
 
@@ -699,6 +1317,7 @@ class MPVVJState:
         inter = self.getInter()
         if inter == None:
             raise ValueError("No intermission playlist selected.")        
+        self.touch()
         self.TVMode = not self.TVMode
         self.lastInter = None
         self.lastMain = None
@@ -708,9 +1327,13 @@ class MPVVJState:
             self.getPlaying().stop()
         except AttributeError:
             raise ValueError("No current playlist cued.")
+        self.touch()
         self.playingPlaylist = None
 
-    def advance(self):
+    def advance(self, now=None):
+        # now is when what gets cued goes on air, if that's known ahead of time
+        if now is None:
+            now = time.monotonic()
         current = self.getCurrent()
         if current == None:  # no playlist selected
             raise ValueError("No playlist selected.")
@@ -721,24 +1344,24 @@ class MPVVJState:
             if inter == None:
                 raise ValueError("No intermission playlist selected.")
             if self.lastMain != None:
-                if time.monotonic() - self.lastMain < self.TVMainTime:
+                if now - self.lastMain < self.TVMainTime:
                     current.advance()
                 else:
                     inter.advance()
-                    self.lastInter = time.monotonic()
+                    self.lastInter = now
                     self.lastMain = None
                 return
             elif self.lastInter != None:
-                if time.monotonic() - self.lastInter < self.TVInterTime:
+                if now - self.lastInter < self.TVInterTime:
                     inter.advance()
                 else:
                     current.advance()
-                    self.lastMain = time.monotonic()
+                    self.lastMain = now
                     self.lastInter = None
                 return
             else:
                 current.advance()
-                self.lastMain = time.monotonic()
+                self.lastMain = now
                 return
 
         current.advance()
@@ -26,39 +26,37 @@ def parseKeyValues(opts):
 
     return optsList
 
-def parseRanges(items):
+def parseRangeSpecs(items):
+    # like parseRanges but ranges are left as [start, end] for the server
     if type(items) != str:
         raise TypeError
-    itemList = []
+    specs = []
 
-    while len(items) > 0:
+    items = items.split(',')
+    if items[-1] == '': # nothing after the last comma
+        items.pop()
+    for item in items:
         try:
-            comma = items.index(',')
-            try:
-                dash = items.index('-', 0, comma)
-                start = int(items[:dash])
-                end = int(items[dash+1:comma])
-                if start > end:
-                    temp = start
-                    start = end
-                    end = temp
-                itemList.extend(range(start, end + 1))
-            except ValueError: #single value
-                itemList.append(int(items[:comma]))
-            items = items[comma+1:]
-        except ValueError: #no comma, last entry
-            try:
-                dash = items.index('-')
-                start = int(items[:dash])
-                end = int(items[dash+1:])
-                if start > end:
-                    temp = start
-                    start = end
-                    end = temp
-                itemList.extend(range(start, end + 1))
-            except ValueError: #single value
-                itemList.append(int(items))
-            items = ''
+            dash = item.index('-', 1)
+            start = int(item[:dash])
+            end = int(item[dash+1:])
+            if start > end:
+                temp = start
+                start = end
+                end = temp
+            specs.append([start, end])
+        except ValueError: #single value
+            specs.append(int(item))
+
+    return specs
+
+def parseRanges(items):
+    itemList = []
+    for spec in parseRangeSpecs(items):
+        if type(spec) == list:
+            itemList.extend(range(spec[0], spec[1] + 1))
+        else:
+            itemList.append(spec)
 
     return itemList
 